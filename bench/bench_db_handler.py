@@ -0,0 +1,176 @@
+'''
+Benchmarks logging build output to the database with `DBHandler` against
+the previous handler, which ran an `INSERT` and a `commit()` per record on
+the logging thread, and prints the results as JSON
+
+Usage:
+    python bench/bench_db_handler.py [--records 1000 10000] [--latency-ms 1]
+    python bench/bench_db_handler.py --database-url postgresql://... [--output results.json]
+
+Without `--database-url`, the handlers write to a stand-in connection that
+waits `--latency-ms` per round trip to the database, and `--row-us` per row
+copied. With `--database-url`, they write to a database migrated with
+`bin/migrate.sql`, under a build id of -1 whose rows are deleted afterwards.
+
+For each handler, `logging_seconds` is the time the logging calls took,
+which is what a build waits for, and `total_seconds` also includes
+writing the remaining records when the handler is closed.
+'''
+
+import argparse
+import json
+import logging
+import platform
+import sys
+
+from datetime import datetime
+from os import path
+from time import perf_counter, sleep
+from unittest.mock import patch
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+
+from log_utils import db_handler  # noqa: E402
+from log_utils.db_handler import DBHandler  # noqa: E402
+
+DEFAULT_RECORD_COUNTS = [1000, 10000]
+DEFAULT_LATENCY_MS = 1
+DEFAULT_ROW_US = 2
+BENCH_BUILD_ID = -1
+
+
+class StandInCursor():
+    def __init__(self, latency, row_cost):
+        self.latency = latency
+        self.row_cost = row_cost
+
+    def execute(self, stmt, args=None):
+        sleep(self.latency)
+
+    def copy_expert(self, stmt, data):
+        rows = data.read().count('\n')
+        sleep(self.latency + rows * self.row_cost)
+
+    def close(self):
+        pass
+
+
+class StandInConnection():
+    '''A database connection where every round trip takes `latency` seconds'''
+
+    def __init__(self, latency, row_cost):
+        self.latency = latency
+        self.row_cost = row_cost
+
+    def cursor(self):
+        return StandInCursor(self.latency, self.row_cost)
+
+    def commit(self):
+        sleep(self.latency)
+
+    def rollback(self):
+        sleep(self.latency)
+
+    def close(self):
+        pass
+
+
+class SyncDBHandler(logging.Handler):
+    '''The previous handler, writing every record before returning'''
+
+    def __init__(self, conn):
+        self.conn = conn
+        logging.Handler.__init__(self)
+
+    def emit(self, record):
+        now = datetime.now()
+        cursor = self.conn.cursor()
+        cursor.execute(
+            ('INSERT INTO buildlog '
+             '(build, source, output, "createdAt", "updatedAt") '
+             'VALUES (%s, %s, %s, %s, %s);'),
+            (BENCH_BUILD_ID, 'ALL', self.format(record), now, now)
+        )
+        self.conn.commit()
+        cursor.close()
+
+
+def time_handler(handler, count):
+    logger = logging.Logger('bench')
+    logger.addHandler(handler)
+
+    start = perf_counter()
+    for idx in range(count):
+        logger.info('Building site... %d files written', idx)
+    logged = perf_counter()
+    handler.close()
+    closed = perf_counter()
+
+    return logged - start, closed - start
+
+
+def run(record_counts, latency, row_cost, database_url):
+    db_connect = db_handler.psycopg2.connect
+
+    def connect(conn_url=None):
+        if database_url:
+            return db_connect(database_url)
+        return StandInConnection(latency, row_cost)
+
+    handlers = [
+        ('sync', lambda: SyncDBHandler(connect())),
+        ('batched', lambda: DBHandler(database_url, BENCH_BUILD_ID)),
+    ]
+
+    results = []
+    with patch.object(db_handler.psycopg2, 'connect', connect):
+        for count in record_counts:
+            for name, make_handler in handlers:
+                logging_seconds, total_seconds = time_handler(make_handler(), count)
+
+                results.append({
+                    'handler': name,
+                    'records': count,
+                    'logging_seconds': round(logging_seconds, 6),
+                    'total_seconds': round(total_seconds, 6),
+                    'records_per_second': round(count / total_seconds),
+                })
+
+                print(f'{name} records={count}: {logging_seconds:.3f}s logging, '
+                      f'{total_seconds:.3f}s total', file=sys.stderr)
+
+    if database_url:
+        conn = connect()
+        with conn.cursor() as cursor:
+            cursor.execute('DELETE FROM buildlog WHERE build = %s', (BENCH_BUILD_ID,))
+        conn.commit()
+        conn.close()
+
+    return {
+        'python': platform.python_version(),
+        'database': 'postgres' if database_url else 'stand-in',
+        'latency_ms': None if database_url else latency * 1000,
+        'row_us': None if database_url else row_cost * 1e6,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark database logging')
+    parser.add_argument('--records', nargs='+', type=int, default=DEFAULT_RECORD_COUNTS,
+                        help='Numbers of records to log')
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_LATENCY_MS,
+                        help='Round trip time of the stand-in database')
+    parser.add_argument('--row-us', type=float, default=DEFAULT_ROW_US,
+                        help='Time the stand-in database takes to copy a row')
+    parser.add_argument('--database-url', help='Benchmark against this database instead')
+    parser.add_argument('-o', '--output', help='Write the results to this file')
+    args = parser.parse_args()
+
+    report = run(args.records, args.latency_ms / 1000, args.row_us / 1e6, args.database_url)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,115 @@
+'''
+Benchmarks masking private values in log records with `LogFilter` against
+the previous filter, which replaced each value in turn, and prints the
+results as JSON
+
+Usage:
+    python bench/bench_log_filter.py [--values 3 30 100] [--lines 100000] [--output results.json]
+
+Each private value is a random token, like a decrypted user environment
+variable or a key, and about 1% of the log lines contain one of them.
+'''
+
+import argparse
+import json
+import logging
+import platform
+import random
+import string
+import sys
+
+from os import path
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+
+from log_utils.get_logger import LogFilter  # noqa: E402
+
+DEFAULT_VALUE_COUNTS = [3, 30, 100]
+DEFAULT_LINE_COUNT = 100000
+
+LINES = [
+    'Bundle complete! 42 Gemfile dependencies, 97 gems now installed.',
+    'Generating... done in 12.345 seconds.',
+    'added 1234 packages, and audited 1235 packages in 20s',
+    '      Regenerating: 1 file(s) changed at 2021-01-01 00:00:00',
+    'Writing to /tmp/work/site_repo/_site/assets/css/main.3f9a2c1b.css',
+]
+
+
+class ReplaceLogFilter(LogFilter):
+    '''The previous filter, masking the unformatted message value by value'''
+
+    def filter(self, record):
+        for priv_val in self.priv_vals:
+            record.msg = record.msg.replace(priv_val, self.mask)
+        return len(record.msg) > 0
+
+
+def random_value(rand):
+    return ''.join(rand.choice(string.ascii_letters + string.digits) for _ in range(32))
+
+
+def make_records(rand, values, count):
+    records = []
+    for idx in range(count):
+        msg = LINES[idx % len(LINES)]
+        if rand.random() < 0.01:
+            msg = f'{msg} {rand.choice(values)}'
+        records.append(logging.makeLogRecord({'msg': msg}))
+    return records
+
+
+def time_filter(log_filter, records):
+    start = perf_counter()
+    for record in records:
+        log_filter.filter(record)
+    return perf_counter() - start
+
+
+def run(value_counts, line_count, seed):
+    rand = random.Random(seed)
+    results = []
+
+    for value_count in value_counts:
+        values = [random_value(rand) for _ in range(value_count)]
+
+        for name, filter_class in [('replace', ReplaceLogFilter), ('compiled', LogFilter)]:
+            records = make_records(random.Random(seed), values, line_count)
+            total = time_filter(filter_class(values), records)
+
+            results.append({
+                'filter': name,
+                'values': value_count,
+                'lines': line_count,
+                'total_seconds': round(total, 6),
+                'per_line_us': round(total / line_count * 1e6, 4),
+            })
+
+            print(f'{name} values={value_count} lines={line_count}: {total:.3f}s',
+                  file=sys.stderr)
+
+    return {
+        'python': platform.python_version(),
+        'seed': seed,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark masking private values in logs')
+    parser.add_argument('--values', nargs='+', type=int, default=DEFAULT_VALUE_COUNTS,
+                        help='Numbers of private values to mask')
+    parser.add_argument('--lines', type=int, default=DEFAULT_LINE_COUNT,
+                        help='Number of log lines to filter')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='Write the results to this file')
+    args = parser.parse_args()
+
+    report = run(args.values, args.lines, args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
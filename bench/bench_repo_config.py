@@ -0,0 +1,218 @@
+'''
+Benchmarks the path matching of `repo_config` against synthetic configs and
+synthetic path sets, and prints the results as JSON
+
+Usage:
+    python bench/bench_repo_config.py [--paths 10000 100000] [--output results.json]
+
+Each scenario is a number of header rules and exclude globs, and each
+benchmark is timed for every path set size. The per path implementations
+used before the config was compiled (`find_first_matching_cfg` and
+`is_path_match`) are timed on at most `--baseline-limit` paths since they
+scale with the number of rules.
+'''
+
+import argparse
+import json
+import platform
+import random
+import sys
+
+from os import path
+from time import perf_counter
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+
+from repo_config.repo_config import (  # noqa: E402
+    RepoConfig, find_first_matching_cfg, is_path_match)
+
+# (header rules, exclude globs)
+DEFAULT_SCENARIOS = [(1, 1), (50, 20), (500, 200)]
+DEFAULT_PATH_COUNTS = [10000, 100000]
+DEFAULT_BASELINE_LIMIT = 10000
+
+SEGMENTS = [
+    'assets', 'css', 'js', 'images', 'docs', 'blog', 'posts', 'about', 'team',
+    'static', 'fonts', 'media', 'api', 'v1', 'v2', 'guides', 'news', 'events',
+]
+EXTENSIONS = ['html', 'css', 'js', 'png', 'jpg', 'svg', 'json', 'xml', 'txt', 'woff2', 'map']
+BASENAMES = ['index', 'main', 'app', 'style', 'logo', 'feed', 'sitemap', 'manifest', 'robots']
+
+
+def random_dir(rand, max_depth):
+    return '/' + '/'.join(rand.choice(SEGMENTS) for _ in range(rand.randint(1, max_depth)))
+
+
+def random_file(rand):
+    return f'{rand.choice(BASENAMES)}.{rand.choice(EXTENSIONS)}'
+
+
+def make_config(rand, rule_count, exclude_count):
+    '''A config with header rules and exclude globs of every supported kind'''
+    header_rules = []
+    for idx in range(rule_count):
+        kind = idx % 5
+        if kind == 0:
+            pattern = f'{random_dir(rand, 3)}/{random_file(rand)}'
+        elif kind == 1:
+            pattern = f'{random_dir(rand, 2)}/*'
+        elif kind == 2:
+            pattern = f'{random_dir(rand, 2)}/*.{rand.choice(EXTENSIONS)}'
+        elif kind == 3:
+            pattern = f'/:param{random_dir(rand, 2)}/*'
+        else:
+            pattern = f'/*.{rand.choice(EXTENSIONS)}'
+
+        header_rules.append({pattern: {'cache-control': f'max-age={idx}'}})
+
+    exclude_paths = []
+    for idx in range(exclude_count):
+        kind = idx % 4
+        if kind == 0:
+            exclude_paths.append(f'*/{random_file(rand)}')
+        elif kind == 1:
+            exclude_paths.append(f'{random_dir(rand, 2)}/*')
+        elif kind == 2:
+            exclude_paths.append(f'*.{rand.choice(EXTENSIONS)}.bak')
+        else:
+            exclude_paths.append(f'{random_dir(rand, 3)}/{random_file(rand)}')
+
+    return {
+        'headers': header_rules,
+        'excludePaths': exclude_paths,
+        'includePaths': ['/.well-known/security.txt'],
+    }
+
+
+def make_paths(rand, count, max_depth=8, files_per_dir=20):
+    '''
+    Paths of varying depth spread over a pool of directories, like the files
+    of a built site, a few of them under dotpaths
+    '''
+    dirnames = []
+    for _ in range(max(1, count // files_per_dir)):
+        dirname = random_dir(rand, max_depth)
+        if rand.random() < 0.01:
+            dirname += '/.hidden'
+        dirnames.append(dirname)
+
+    return [f'{rand.choice(dirnames)}/{random_file(rand)}' for _ in range(count)]
+
+
+def time_benchmark(func, paths, repeat):
+    '''The best total time of `repeat` runs of `func` over `paths`'''
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        func(paths)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmarks(config):
+    repo_config = RepoConfig(config=config, defaults={
+        'headers': {'cache-control': 'max-age=60'},
+        'excludePaths': ['*/Dockerfile', '*/docker-compose.yml'],
+    })
+    header_rules = config['headers']
+    exclude_paths = repo_config.exclude_paths()
+
+    def baseline_headers(paths):
+        for p in paths:
+            find_first_matching_cfg(header_rules, p)
+
+    def baseline_exclude(paths):
+        for p in paths:
+            is_path_match(exclude_paths, p)
+
+    def inclusion(paths):
+        for p in paths:
+            repo_config.is_path_included(p)
+
+    def headers(paths):
+        for p in paths:
+            repo_config.get_headers_for_path(p)
+
+    def classify_paths(paths):
+        repo_config.classify_paths(paths)
+
+    # (name, func, is baseline)
+    return [
+        ('match_path', baseline_headers, True),
+        ('is_path_match', baseline_exclude, True),
+        ('is_path_included', inclusion, False),
+        ('get_headers_for_path', headers, False),
+        ('classify_paths', classify_paths, False),
+    ]
+
+
+def run(scenarios, path_counts, baseline_limit, repeat, seed):
+    rand = random.Random(seed)
+    results = []
+
+    path_sets = dict((count, make_paths(rand, count)) for count in path_counts)
+
+    for rule_count, exclude_count in scenarios:
+        config = make_config(rand, rule_count, exclude_count)
+
+        for name, func, is_baseline in benchmarks(config):
+            timed_counts = set()
+            for count in path_counts:
+                paths = path_sets[count]
+                if is_baseline:
+                    paths = paths[:baseline_limit]
+
+                if len(paths) in timed_counts:
+                    continue
+                timed_counts.add(len(paths))
+
+                total = time_benchmark(func, paths, repeat)
+
+                results.append({
+                    'benchmark': name,
+                    'header_rules': rule_count,
+                    'exclude_paths': exclude_count,
+                    'paths': len(paths),
+                    'total_seconds': round(total, 6),
+                    'per_path_us': round(total / len(paths) * 1e6, 4),
+                })
+
+                print(f'{name} rules={rule_count} excludes={exclude_count} '
+                      f'paths={len(paths)}: {total:.3f}s', file=sys.stderr)
+
+    return {
+        'python': platform.python_version(),
+        'seed': seed,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def scenario(value):
+    rule_count, exclude_count = value.split(':')
+    return int(rule_count), int(exclude_count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark repo_config path matching')
+    parser.add_argument('--scenarios', nargs='+', type=scenario,
+                        default=DEFAULT_SCENARIOS, metavar='RULES:EXCLUDES',
+                        help='Numbers of header rules and exclude globs to benchmark')
+    parser.add_argument('--paths', nargs='+', type=int, default=DEFAULT_PATH_COUNTS,
+                        help='Sizes of the path sets, ie 10000 1000000')
+    parser.add_argument('--baseline-limit', type=int, default=DEFAULT_BASELINE_LIMIT,
+                        help='Maximum number of paths for the per path baselines')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of runs of each benchmark, the best is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='Write the results to this file')
+    args = parser.parse_args()
+
+    report = run(args.scenarios, args.paths, args.baseline_limit, args.repeat, args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -1,3 +1,5 @@
 CREATE TABLE IF NOT EXISTS buildlog (id serial PRIMARY KEY, build integer, source varchar, output varchar);
 ALTER TABLE buildlog ADD COLUMN IF NOT EXISTS "createdAt" timestamp;
 ALTER TABLE buildlog ADD COLUMN IF NOT EXISTS "updatedAt" timestamp;
+CREATE TABLE IF NOT EXISTS buildlog_chunk (id serial PRIMARY KEY, build integer, source varchar, "lineCount" integer, encoding varchar, output bytea, "createdAt" timestamp, "updatedAt" timestamp);
+CREATE INDEX IF NOT EXISTS buildlog_chunk_build_idx ON buildlog_chunk (build, id);
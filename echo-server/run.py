@@ -1,13 +1,19 @@
 # Reflects the requests from HTTP methods GET, POST, PUT, and DELETE
 #
 # Based on https://gist.github.com/1kastner/e083f9e813c0464e6a2ec8910553e632
+#
+# To try out clients against a failing or slow server, `?fail=N` answers the
+# first N requests to a path with a 503, and `?delay=S` waits S seconds
+# before answering. The requests received are kept in `server.requests`.
 
 import os
 import base64
 import json
 import threading
+import time
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
 
 
 def flush_print(s):
@@ -19,6 +25,11 @@ def decodeb64(s):
 
 
 class StoppableHTTPServer(HTTPServer):
+    def __init__(self, *args, **kwargs):
+        HTTPServer.__init__(self, *args, **kwargs)
+        self.requests = []
+        self.failures = {}
+
     def run(self):
         try:
             self.serve_forever()
@@ -29,11 +40,29 @@ class StoppableHTTPServer(HTTPServer):
 
 
 class RequestHandler(BaseHTTPRequestHandler):
+    def respond(self, payload=None):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        self.server.requests.append((self.command, self.path, payload))
+
+        if 'delay' in query:
+            time.sleep(float(query['delay'][0]))
+
+        status = 200
+        if 'fail' in query:
+            failures = self.server.failures.get(url.path, 0)
+            if failures < int(query['fail'][0]):
+                self.server.failures[url.path] = failures + 1
+                status = 503
+
+        self.send_response(status)
+        self.end_headers()
+
     def do_GET(self):
         flush_print(f"\n{self.command} {self.path}")
 
-        self.send_response(200)
-        self.end_headers()
+        self.respond()
 
     def do_POST(self):
         flush_print(f"\n{self.command} {self.path}")
@@ -54,8 +83,7 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         flush_print(f"  {payload}")
 
-        self.send_response(200)
-        self.end_headers()
+        self.respond(payload)
 
     do_PUT = do_POST
     do_DELETE = do_GET
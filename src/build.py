@@ -3,24 +3,29 @@
 import os
 import sys
 from datetime import datetime
+
+import boto3
 from stopit import TimeoutException, SignalTimeout as Timeout
 
-from common import CLONE_DIR_PATH
+from common import CLONE_DIR_PATH, WORKING_DIR_PATH
 
-from log_utils import delta_to_mins_secs, get_logger, init_logging
+from log_utils import delta_to_mins_secs, get_logger, init_logging, upload_log_archive
 from log_utils.remote_logs import (
-    post_build_complete, post_build_error,
-    post_build_timeout, post_build_processing
+    init_status_client, post_build_complete, post_build_error,
+    post_build_timeout, post_build_processing, Heartbeat, HEARTBEAT_INTERVAL
 )
 
 from crypto.decrypt import decrypt
 
 import repo_config
 
+from runner import write_usage_records
+
 from steps import (
     build_hugo, build_jekyll, build_static, download_hugo,
     fetch_repo, publish, run_build_script, fetch_commit_sha,
-    setup_bundler, setup_node, setup_ruby, StepException, update_repo
+    setup_bundler, setup_node, setup_ruby, RepoCache, Step, StepException, run_steps,
+    update_repo
 )
 
 
@@ -59,11 +64,32 @@ def build(
     commit_sha = None
 
     cache_control = os.getenv('CACHE_CONTROL', 'max-age=60')
+    defer_deletes = os.getenv('DEFER_DELETES', 'false').lower() == 'true'
+    redirect_map = os.getenv('REDIRECT_MAP', 'false').lower() == 'true'
+    publish_metrics_file = os.getenv('PUBLISH_METRICS_FILE')
+    usage_file = os.getenv('BUILD_USAGE_FILE')
+    heartbeat_interval = int(os.getenv('HEARTBEAT_INTERVAL', HEARTBEAT_INTERVAL))
+    db_log_chunk_lines = int(os.getenv('DB_LOG_CHUNK_LINES', '0'))
+    db_log_compress = os.getenv('DB_LOG_COMPRESS', 'false').lower() == 'true'
+    db_log_notify = os.getenv('DB_LOG_NOTIFY', 'false').lower() == 'true'
+    log_archive = os.getenv('LOG_ARCHIVE', 'false').lower() == 'true'
+    repo_cache_dir = os.getenv('REPO_CACHE_DIR')
+    repo_cache_max_mb = int(os.getenv('REPO_CACHE_MAX_MB', '10240'))
+    log_archive_bucket = os.getenv('LOG_ARCHIVE_BUCKET') or bucket
+    log_archive_prefix = os.getenv('LOG_ARCHIVE_PREFIX', '_build-logs')
     database_url = os.environ['DATABASE_URL']
     user_environment_variable_key = os.environ['USER_ENVIRONMENT_VARIABLE_KEY']
 
+    # statuses are posted in the background, and waited for at exit
+    init_status_client(blocking=False)
+
+    heartbeat = Heartbeat(status_callback, interval=heartbeat_interval)
+
     try:
         post_build_processing(status_callback)
+        if heartbeat_interval > 0:
+            heartbeat.start()
+
         # throw a timeout exception after TIMEOUT_SECONDS
         with Timeout(TIMEOUT_SECONDS, swallow_exc=False):
             build_info = f'{owner}/{repository}@id:{build_id}'
@@ -83,7 +109,12 @@ def build(
                 'repository': repository,
             }
 
-            init_logging(priv_vals, logattrs, database_url)
+            init_logging(priv_vals, logattrs, database_url,
+                         db_spill_path=WORKING_DIR_PATH / 'buildlog-spill.jsonl',
+                         db_chunk_lines=db_log_chunk_lines,
+                         db_compress=db_log_compress,
+                         db_notify=db_log_notify,
+                         archive_path=WORKING_DIR_PATH / 'build.log.gz' if log_archive else None)
 
             logger = get_logger('main')
 
@@ -99,8 +130,15 @@ def build(
             ##
             # FETCH
             #
+            repo_cache = None
+            if repo_cache_dir:
+                repo_cache = RepoCache(
+                    repo_cache_dir, owner, repository, max_bytes=repo_cache_max_mb * 1024 ** 2
+                )
+
+            heartbeat.update(step='fetch')
             run_step(
-                fetch_repo(owner, repository, branch, github_token),
+                fetch_repo(owner, repository, branch, github_token, repo_cache),
                 'There was a problem fetching the repository, see the above logs for details.'
             )
 
@@ -121,80 +159,104 @@ def build(
             )
 
             if federalist_config.full_clone():
+                heartbeat.update(step='update-repo')
                 run_step(
-                    update_repo(CLONE_DIR_PATH),
+                    update_repo(CLONE_DIR_PATH, repo_cache),
                     'There was a problem updating the repository, see the above logs for details.'
                 )
 
             ##
             # BUILD
             #
-            run_step(
-                setup_node(),
-                'There was a problem setting up Node, see the above logs for details.'
-            )
-
-            # Run the npm `federalist` task (if it is defined)
-            run_step(
-                run_build_script(
-                    branch, owner, repository, site_prefix, baseurl, decrypted_uevs
+            # Setting up Ruby and Bundler, or downloading Hugo, runs after the
+            # federalist script, as it reads files in the clone the script may
+            # write, ie .ruby-version, Gemfile or .hugo-version
+            steps = [
+                Step(
+                    'setup-node',
+                    setup_node,
+                    'There was a problem setting up Node, see the above logs for details.'
                 ),
-                'There was a problem running the federalist script, see the above logs for details.'
-            )
+                # Run the npm `federalist` task (if it is defined)
+                Step(
+                    'run-build-script',
+                    lambda: run_build_script(
+                        branch, owner, repository, site_prefix, baseurl, decrypted_uevs
+                    ),
+                    'There was a problem running the federalist script, see the above logs for details.',  # noqa: E501
+                    requires=['setup-node']
+                ),
+            ]
 
             # Run the appropriate build engine based on generator
             if generator == 'jekyll':
-                run_step(
-                    setup_ruby(),
-                    'There was a problem setting up Ruby, see the above logs for details.'
-                )
-
-                run_step(
-                    setup_bundler(),
-                    'There was a problem setting up Bundler, see the above logs for details.'
-                )
-
-                run_step(
-                    build_jekyll(
-                        branch, owner, repository, site_prefix, baseurl, config, decrypted_uevs
+                steps += [
+                    Step(
+                        'setup-ruby',
+                        setup_ruby,
+                        'There was a problem setting up Ruby, see the above logs for details.',
+                        requires=['run-build-script']
                     ),
-                    'There was a problem running Jekyll, see the above logs for details.'
-                )
+                    Step(
+                        'setup-bundler',
+                        setup_bundler,
+                        'There was a problem setting up Bundler, see the above logs for details.',
+                        requires=['setup-ruby']
+                    ),
+                    Step(
+                        'build-jekyll',
+                        lambda: build_jekyll(
+                            branch, owner, repository, site_prefix, baseurl, config,
+                            decrypted_uevs
+                        ),
+                        'There was a problem running Jekyll, see the above logs for details.',
+                        requires=['run-build-script', 'setup-bundler']
+                    ),
+                ]
 
             elif generator == 'hugo':
                 # extra: --hugo-version (not yet used)
-                run_step(
-                    download_hugo(),
-                    'There was a problem downloading Hugo, see the above logs for details.'
-                )
-
-                run_step(
-                    build_hugo(
-                        branch, owner, repository, site_prefix, baseurl, decrypted_uevs
+                steps += [
+                    Step(
+                        'download-hugo',
+                        download_hugo,
+                        'There was a problem downloading Hugo, see the above logs for details.',
+                        requires=['run-build-script']
                     ),
-                    'There was a problem running Hugo, see the above logs for details.'
-                )
+                    Step(
+                        'build-hugo',
+                        lambda: build_hugo(
+                            branch, owner, repository, site_prefix, baseurl, decrypted_uevs
+                        ),
+                        'There was a problem running Hugo, see the above logs for details.',
+                        requires=['run-build-script', 'download-hugo']
+                    ),
+                ]
+
+            run_steps(steps, on_running=lambda running: heartbeat.update(step=', '.join(running)))
 
-            elif generator == 'static':
+            if generator == 'static':
                 # no build arguments are needed
+                heartbeat.update(step='build-static')
                 build_static()
 
             elif (generator == 'node.js' or generator == 'script only'):
                 logger.info('build already ran in \'npm run federalist\'')
 
-            else:
-                raise ValueError(f'Invalid generator: {generator}')
-
             ##
             # PUBLISH
             #
+            heartbeat.update(step='publish')
             publish(baseurl, site_prefix, bucket, federalist_config, aws_default_region,
-                    aws_access_key_id, aws_secret_access_key)
+                    aws_access_key_id, aws_secret_access_key,
+                    defer_deletes=defer_deletes, redirect_map=redirect_map,
+                    metrics_file=publish_metrics_file, progress=heartbeat.update)
 
             delta_string = delta_to_mins_secs(datetime.now() - start_time)
             logger.info(f'Total build time: {delta_string}')
 
             # Finished!
+            heartbeat.stop()
             post_build_complete(status_callback, commit_sha)
 
             sys.exit(0)
@@ -205,11 +267,13 @@ def build(
         with a non-zero return code
         '''
         logger.error(str(err))
+        heartbeat.stop()
         post_build_error(status_callback, str(err), commit_sha)
         sys.exit(1)
 
     except TimeoutException:
         logger.warning(f'Build({build_info}) has timed out')
+        heartbeat.stop()
         post_build_timeout(status_callback, commit_sha)
 
     except Exception as err:  # pylint: disable=W0703
@@ -230,8 +294,32 @@ def build(
             'again and contact pages-support if it persists.'
         )
 
+        heartbeat.stop()
         post_build_error(status_callback, err_message, commit_sha)
 
+    finally:
+        if usage_file:
+            write_usage_records(usage_file)
+
+        if log_archive:
+            # the build status is already posted, failing to archive the
+            # log must not change the exit code of the build
+            try:
+                s3_client = boto3.client(
+                    service_name='s3',
+                    aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key,
+                    region_name=aws_default_region
+                )
+                log_archive_key = f'{log_archive_prefix}/{site_prefix}/{build_id}.log.gz'
+                upload_log_archive(s3_client, log_archive_bucket, log_archive_key)
+            except Exception as err:  # pylint: disable=W0703
+                msg = f'Failed to archive the build log: {err}'
+                if logger:
+                    logger.warning(msg)
+                else:
+                    print(msg)
+
 
 def decrypt_uevs(key, uevs):
     return [{
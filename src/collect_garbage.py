@@ -0,0 +1,34 @@
+'''
+Drains the stale object manifests written by publishes with deferred deletes
+
+Credentials are read from the standard AWS environment variables.
+'''
+
+import argparse
+import logging
+import sys
+
+import boto3
+
+from publishing.garbage import collect_garbage
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Delete stale objects recorded during publishes')
+    parser.add_argument('-b', '--bucket', dest='bucket', required=True,
+                        help='The S3 bucket to collect')
+    parser.add_argument('-s', '--site-prefix', dest='site_prefix',
+                        help='Only collect the manifest of this site prefix')
+    parser.add_argument('-r', '--region', dest='region',
+                        help='The AWS region of the bucket')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help='Only report what would be deleted')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    s3_client = boto3.client(service_name='s3', region_name=args.region)
+
+    stats = collect_garbage(args.bucket, s3_client, args.site_prefix, args.dry_run)
+
+    print(f'Deleted: {stats["deleted"]}, skipped: {stats["skipped"]}')
@@ -1,7 +1,7 @@
 '''Logging stuff'''
 
-from .get_logger import get_logger, init_logging
+from .get_logger import get_logger, init_logging, upload_log_archive
 from .delta_to_mins_secs import delta_to_mins_secs
 
 __all__ = [
-    'delta_to_mins_secs', 'get_logger', 'init_logging']
+    'delta_to_mins_secs', 'get_logger', 'init_logging', 'upload_log_archive']
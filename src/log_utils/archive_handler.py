@@ -0,0 +1,73 @@
+'''
+Writes the build log to a compressed file, uploaded once the build is done
+'''
+
+import gzip
+import logging
+
+from collections import deque
+from pathlib import Path
+
+# The number of last records kept to summarize the log
+DEFAULT_TAIL_LINES = 100
+
+
+class ArchiveHandler(logging.Handler):
+    '''
+    Streams formatted records to a gzip compressed file at `path`, and keeps
+    the last `tail_lines` records so they can be logged elsewhere once the
+    file is uploaded.
+    '''
+
+    def __init__(self, path, tail_lines=DEFAULT_TAIL_LINES):
+        logging.Handler.__init__(self)
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = gzip.open(self.path, 'wt', encoding='utf-8')
+
+        self.tail = deque(maxlen=tail_lines)
+        self.line_count = 0
+
+    def emit(self, record):
+        try:
+            self.file.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+            return
+
+        self.line_count += 1
+        self.tail.append(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            if not self.file.closed:
+                self.file.close()
+        finally:
+            self.release()
+
+        logging.Handler.close(self)
+
+    def upload(self, s3_client, bucket, key):
+        '''
+        Closes the file and uploads it as `key` in `bucket`, returns its
+        compressed size
+        '''
+        self.close()
+
+        s3_client.upload_file(
+            str(self.path), bucket, key,
+            ExtraArgs=dict(
+                ContentType='text/plain; charset=utf-8',
+                ContentEncoding='gzip',
+                ServerSideEncryption='AES256'
+            )
+        )
+
+        return self.path.stat().st_size
+
+    def summary_records(self, message):
+        '''A record of `message` followed by the last records logged'''
+        summary = logging.LogRecord('archive', logging.INFO, __file__, 0, message, None, None)
+        return [summary] + list(self.tail)
@@ -0,0 +1,101 @@
+'''
+Stores log lines in chunks of many lines per `buildlog_chunk` row
+'''
+
+import json
+import zlib
+
+# The most bytes of lines, before compression, stored in a single chunk
+DEFAULT_CHUNK_BYTES = 256 * 1024
+
+# Lines are stored as a JSON array, so lines containing newlines, like
+# tracebacks, are read back as they were logged
+ENCODING_JSON = 'json'
+ENCODING_JSON_ZLIB = 'json+zlib'
+
+
+def encode_chunk(lines, compress=False):
+    '''
+    Returns the encoding and the data of a chunk of lines
+
+    >>> encode_chunk(['one', 'two'])
+    ('json', b'["one","two"]')
+    '''
+    data = json.dumps(lines, separators=(',', ':')).encode('utf-8')
+    if compress:
+        return ENCODING_JSON_ZLIB, zlib.compress(data)
+    return ENCODING_JSON, data
+
+
+def decode_chunk(encoding, data):
+    '''
+    Returns the lines of a chunk
+
+    >>> decode_chunk(*encode_chunk(['one', 'two\\nthree'], compress=True))
+    ['one', 'two\\nthree']
+    '''
+    data = bytes(data)
+    if encoding == ENCODING_JSON_ZLIB:
+        data = zlib.decompress(data)
+    elif encoding != ENCODING_JSON:
+        raise ValueError(f'Unknown log chunk encoding: {encoding}')
+    return json.loads(data.decode('utf-8'))
+
+
+def chunk_rows(rows, compress=False, max_bytes=DEFAULT_CHUNK_BYTES):
+    '''
+    Groups `buildlog` rows, (build, source, output, createdAt, updatedAt),
+    of consecutive lines into `buildlog_chunk` rows, (build, source,
+    lineCount, encoding, output, createdAt, updatedAt), of at most
+    `max_bytes` of lines each. The data is hex encoded for COPY.
+
+    >>> rows = [(1, 'ALL', line, 't1', 't1') for line in ['one', 'two', 'three']]
+    >>> [row[2] for row in chunk_rows(rows, max_bytes=6)]
+    [2, 1]
+    '''
+    chunks = []
+    group = []
+    size = 0
+
+    for row in rows:
+        line_size = len(row[2].encode('utf-8'))
+        if group and (size + line_size > max_bytes or row[:2] != group[0][:2]):
+            chunks.append(group)
+            group = []
+            size = 0
+        group.append(row)
+        size += line_size
+
+    if group:
+        chunks.append(group)
+
+    result = []
+    for group in chunks:
+        encoding, data = encode_chunk([row[2] for row in group], compress)
+        build, source = group[0][:2]
+        result.append(
+            (build, source, len(group), encoding, '\\x' + data.hex(), group[0][3], group[-1][4])
+        )
+    return result
+
+
+def read_build_log(conn, build_id):
+    '''
+    Yields the lines logged for a build, from its chunks if it was logged
+    in chunks and otherwise from its `buildlog` rows
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            'SELECT encoding, output FROM buildlog_chunk WHERE build = %s ORDER BY id',
+            (build_id,)
+        )
+        chunks = cursor.fetchall()
+
+        if chunks:
+            for encoding, data in chunks:
+                yield from decode_chunk(encoding, data)
+            return
+
+        cursor.execute('SELECT output FROM buildlog WHERE build = %s ORDER BY id', (build_id,))
+        for (output,) in cursor:
+            yield output
@@ -1,14 +1,148 @@
-from datetime import datetime
+'''
+Writes log records to the `buildlog` table on a background thread
+'''
+
+import csv
+import io
+import json
 import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+
+from datetime import datetime
+from pathlib import Path
+from time import monotonic, sleep
+
 import psycopg2
 
+from .chunks import chunk_rows
+from .tail import channel
+
+# Queued records are written once there are this many of them...
+DEFAULT_BATCH_SIZE = 500
+
+# ...or once the oldest of them has waited this many seconds
+DEFAULT_FLUSH_INTERVAL = 1
+
+# The most records waiting to be written, to bound the memory used while the
+# database is slow or unavailable
+DEFAULT_MAX_QUEUE = 10000
+
+# How long logging waits for room in a full queue before dropping the record
+DEFAULT_PUT_TIMEOUT = 1
+
+# How long flushing or closing the handler waits for the queued records to
+# be written
+CLOSE_TIMEOUT = 30
+
+# How long to wait before reconnecting to the database after losing the
+# connection, doubled after every failed attempt up to MAX_RETRY_DELAY
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+
+# How long closing the handler keeps trying to write the spilled records
+REPLAY_TIMEOUT = 10
+
+# Errors meaning the connection to the database is unusable, the records
+# are spilled and retried on a new connection rather than discarded
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+COPY_STMT = (
+    'COPY buildlog (build, source, output, "createdAt", "updatedAt") '
+    'FROM STDIN WITH (FORMAT csv)'
+)
+
+CHUNK_COPY_STMT = (
+    'COPY buildlog_chunk '
+    '(build, source, "lineCount", encoding, output, "createdAt", "updatedAt") '
+    'FROM STDIN WITH (FORMAT csv)'
+)
+
+# The last id handed out by the sequence of a table's ids, by any session.
+# The ids of the rows copied afterwards are greater.
+LAST_ID_STMT = "SELECT pg_sequence_last_value(pg_get_serial_sequence(%s, 'id'))"
+
+# Notifies the listeners of `build_<id>` that the rows of the build with ids
+# after `after`, up to `last`, the id of the last row copied, were written.
+# Notifications are sent when the transaction commits.
+NOTIFY_STMT = (
+    'WITH batch AS ('
+    "SELECT currval(pg_get_serial_sequence(%(table)s, 'id')) AS last_id"
+    ') '
+    'SELECT last_id, pg_notify(%(channel)s, json_build_object('
+    "'table', %(table)s::text, 'after', %(after)s::bigint, 'last', last_id"
+    ')::text) FROM batch'
+)
+
+# Tells the writer thread to write the remaining records and stop
+CLOSE = object()
+
 
 class DBHandler(logging.Handler):
-    def __init__(self, conn_url, build_id):
+    '''
+    Queues formatted log records and writes them to the database from a
+    background thread, so logging does not wait on the database.
+
+    Records are written in order with a single `COPY` per batch, once
+    `batch_size` records are queued or the oldest queued record has waited
+    `flush_interval` seconds, and when the handler is flushed or closed.
+    `logging.shutdown`, which runs at exit, flushes and closes the handler.
+
+    At most `max_queue` records wait to be written. When the queue is full,
+    logging waits up to `put_timeout` seconds for room, and if there is still
+    none the record is dropped. Records are then dropped without waiting
+    until there is room again, and the number of dropped records is written
+    in their place.
+
+    If the connection to the database is lost, records are appended to the
+    `spill_path` file instead, a temporary file by default, while the writer
+    reconnects with an exponential backoff. Once reconnected, the spilled
+    records are written in order before any new record. The delivery
+    statistics are reported when the handler is closed, and the spill file
+    is kept if some records could not be written.
+
+    With `chunks`, each batch is written to `buildlog_chunk` rows of many
+    lines each instead of a `buildlog` row per line, compressed with
+    `compress`, see `log_utils.chunks`.
+
+    With `notify`, each batch also sends a `NOTIFY build_<build_id>` with the
+    table written to and the range of ids of the new rows, as JSON like
+    `{"table": "buildlog", "after": 120, "last": 170}`, so listeners can read
+    new lines as they are written, see `log_utils.tail`. The range can
+    include rows of other builds written at the same time.
+    '''
+
+    def __init__(self, conn_url, build_id, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_queue=DEFAULT_MAX_QUEUE,
+                 put_timeout=DEFAULT_PUT_TIMEOUT, spill_path=None, chunks=False,
+                 compress=False, notify=False):
         self.conn_url = conn_url
         self.build_id = build_id
         self.source = 'ALL'
 
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        self.chunks = chunks
+        self.compress = compress
+
+        self.notify = notify
+        self.last_id = None
+
+        self.spill_path = spill_path
+        self.spill_file = None
+        self.spill_offset = 0
+        self.pending = 0
+
+        self.retry_delay = RETRY_DELAY
+        self.next_retry = None
+
+        self.stats = dict(written=0, replayed=0, spilled=0, dropped=0, failed=0)
+
         self.conn = None
 
         try:
@@ -18,23 +152,286 @@ class DBHandler(logging.Handler):
 
         logging.Handler.__init__(self)
 
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.closed = False
+
+        self.writer = threading.Thread(target=self._write, name='db-log-writer', daemon=True)
+        self.writer.start()
+
     def emit(self, record):
+        if self.closed:
+            return
+
         try:
-            now = datetime.now()
-            self.exec(
-                ('INSERT INTO buildlog '
-                 '(build, source, output, "createdAt", "updatedAt") '
-                 'VALUES (%s, %s, %s, %s, %s);'),
-                (self.build_id, self.source, self.format(record), now, now)
+            created = datetime.fromtimestamp(record.created)
+            row = (
+                self.build_id,
+                self.source,
+                # Postgres text cannot contain NUL characters
+                self.format(record).replace('\x00', ''),
+                created,
+                created
             )
         except Exception:
             self.handleError(record)
+            return
+
+        try:
+            if self.dropped:
+                self.queue.put_nowait(self._dropped_row())
+                self.dropped = 0
+                self.queue.put_nowait(row)
+            else:
+                self.queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            self.stats['dropped'] += 1
+
+    def flush(self):
+        '''Waits until the records queued so far are written'''
+        if self.closed:
+            return
+
+        written = threading.Event()
+        try:
+            self.queue.put(written, timeout=CLOSE_TIMEOUT)
+        except queue.Full:
+            return
+        written.wait(CLOSE_TIMEOUT)
 
     def close(self):
-        self.conn.close()
+        '''Writes the queued records and closes the connection'''
+        if not self.closed:
+            self.closed = True
+            try:
+                if self.dropped:
+                    self.queue.put(self._dropped_row(), timeout=CLOSE_TIMEOUT)
+                self.queue.put(CLOSE, timeout=CLOSE_TIMEOUT)
+            except queue.Full:
+                pass
+            self.writer.join(CLOSE_TIMEOUT)
+
+            if not self.writer.is_alive():
+                if self.conn is not None:
+                    self.conn.close()
+                self._close_spill_file()
+                print(self.delivery_report(), file=sys.stderr)
+
+        logging.Handler.close(self)
+
+    def delivery_stats(self):
+        '''
+        The numbers of records written as they were logged, written after
+        being spilled, spilled, dropped because the queue was full, failed
+        to be written, and spilled but not written yet
+        '''
+        return dict(self.stats, undelivered=self.pending)
+
+    def delivery_report(self):
+        '''
+        >>> handler = DBHandler.__new__(DBHandler)
+        >>> handler.stats = dict(written=10, replayed=2, spilled=3, dropped=0, failed=0)
+        >>> handler.pending, handler.spill_path = 1, 'buildlog.jsonl'
+        >>> handler.delivery_report()
+        'Database logging: 12 lines written (2 after reconnecting), 0 dropped, 0 failed, \
+1 not written and kept in buildlog.jsonl'
+        '''
+        stats = self.delivery_stats()
+        report = f'Database logging: {stats["written"] + stats["replayed"]} lines written'
+        if stats['spilled']:
+            report += f' ({stats["replayed"]} after reconnecting)'
+        report += f', {stats["dropped"]} dropped, {stats["failed"]} failed'
+        if stats['undelivered']:
+            report += f', {stats["undelivered"]} not written and kept in {self.spill_path}'
+        return report
+
+    def _dropped_row(self):
+        now = datetime.now()
+        message = f'... {self.dropped} log lines dropped, the database was too slow ...'
+        return (self.build_id, self.source, message, now, now)
+
+    def _write(self):
+        batch = []
+        oldest = None
+
+        while True:
+            deadlines = []
+            if batch:
+                deadlines.append(oldest + self.flush_interval)
+            if self.pending:
+                deadlines.append(self.next_retry)
+
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - monotonic())
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple):
+                if not batch:
+                    oldest = monotonic()
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+
+            self._write_batch(batch)
+            batch = []
+
+            if item is CLOSE:
+                self._replay_before_close()
+                return
+
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def _write_batch(self, rows):
+        if rows:
+            if self.conn is None or self.pending:
+                self._spill(rows)
+            elif not self._deliver(rows, 'written'):
+                self._spill(rows)
+
+        if self.pending and monotonic() >= self.next_retry:
+            self._reconnect_and_replay()
+
+    def _deliver(self, rows, stat):
+        '''
+        Writes `rows` with a single COPY, returns False if the connection to
+        the database was lost
+        '''
+        table, stmt, copy_rows = 'buildlog', COPY_STMT, rows
+        if self.chunks:
+            table, stmt = 'buildlog_chunk', CHUNK_COPY_STMT
+            copy_rows = chunk_rows(rows, self.compress)
+
+        data = io.StringIO()
+        csv.writer(data).writerows(copy_rows)
+        data.seek(0)
+
+        try:
+            cursor = self.conn.cursor()
+            if self.notify and self.last_id is None:
+                cursor.execute(LAST_ID_STMT, (table,))
+                self.last_id = cursor.fetchone()[0] or 0
+            cursor.copy_expert(stmt, data)
+            if self.notify:
+                cursor.execute(NOTIFY_STMT, dict(
+                    table=table, channel=channel(self.build_id), after=self.last_id
+                ))
+                last_id = cursor.fetchone()[0]
+            self.conn.commit()
+            cursor.close()
+        except CONNECTION_ERRORS as err:
+            print(f'Lost the connection to the database, retrying: {err}', file=sys.stderr)
+            self._disconnect()
+            return False
+        except Exception as err:  # pylint: disable=W0703
+            try:
+                self.conn.rollback()
+            except Exception:  # pylint: disable=W0703
+                pass
+            print(f'Failed to write {len(rows)} log lines to the database: {err}',
+                  file=sys.stderr)
+            self.stats['failed'] += len(rows)
+            return True
+
+        if self.notify:
+            self.last_id = last_id
+        self.stats[stat] += len(rows)
+        return True
+
+    def _disconnect(self):
+        try:
+            self.conn.close()
+        except Exception:  # pylint: disable=W0703
+            pass
+        self.conn = None
+        self._schedule_retry()
+
+    def _schedule_retry(self):
+        self.next_retry = monotonic() + self.retry_delay
+        self.retry_delay = min(self.retry_delay * 2, MAX_RETRY_DELAY)
+
+    def _reconnect_and_replay(self):
+        if self.conn is None:
+            try:
+                self.conn = psycopg2.connect(self.conn_url)
+            except Exception:  # pylint: disable=W0703
+                self._schedule_retry()
+                return
+
+        if self._replay():
+            self.retry_delay = RETRY_DELAY
+
+    def _replay_before_close(self):
+        deadline = monotonic() + REPLAY_TIMEOUT
+        while self.pending and monotonic() < deadline:
+            self._reconnect_and_replay()
+            if self.pending:
+                sleep(max(0, min(self.next_retry, deadline) - monotonic()))
+
+    def _spill(self, rows):
+        try:
+            if self.spill_file is None:
+                if self.spill_path is None:
+                    fd, self.spill_path = tempfile.mkstemp(prefix='buildlog-', suffix='.jsonl')
+                    os.close(fd)
+                else:
+                    Path(self.spill_path).parent.mkdir(parents=True, exist_ok=True)
+                self.spill_file = open(self.spill_path, 'w', encoding='utf-8')
+
+            for row in rows:
+                self.spill_file.write(json.dumps([str(value) for value in row]) + '\n')
+            self.spill_file.flush()
+        except OSError as err:
+            print(f'Failed to spill {len(rows)} log lines to {self.spill_path}: {err}',
+                  file=sys.stderr)
+            self.stats['failed'] += len(rows)
+            return
+
+        self.pending += len(rows)
+        self.stats['spilled'] += len(rows)
+
+    def _replay(self):
+        '''
+        Writes the spilled records in order, returns False if the connection
+        to the database was lost again
+        '''
+        with open(self.spill_path, 'rb') as spill:
+            spill.seek(self.spill_offset)
+
+            while self.pending:
+                rows = []
+                while len(rows) < self.batch_size:
+                    line = spill.readline()
+                    if not line:
+                        break
+                    rows.append(json.loads(line))
+
+                if not rows:
+                    break
+
+                if not self._deliver(rows, 'replayed'):
+                    return False
+
+                self.spill_offset = spill.tell()
+                self.pending -= len(rows)
+
+        # everything was written, start over with an empty file
+        self.spill_file.seek(0)
+        self.spill_file.truncate()
+        self.spill_offset = 0
+        self.pending = 0
+        return True
+
+    def _close_spill_file(self):
+        if self.spill_file is None:
+            return
 
-    def exec(self, stmt, args):
-        cursor = self.conn.cursor()
-        cursor.execute(stmt, args)
-        self.conn.commit()
-        cursor.close()
+        self.spill_file.close()
+        if not self.pending:
+            os.remove(self.spill_path)
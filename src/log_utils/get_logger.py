@@ -3,22 +3,80 @@ Setup nice logs.
 Clients should use the `get_logger` method to get a logger instance.
 '''
 
+import re
 import sys
 import logging
 import logging.handlers
 
+from .archive_handler import ArchiveHandler
 from .db_handler import DBHandler
 
 DEFAULT_LOG_LEVEL = logging.INFO
 
+# How often chunks are written when logging in chunks, in seconds, unless
+# they fill up sooner
+CHUNK_FLUSH_INTERVAL = 5
+
 LOG_ATTRS = {}
 
+# The archive handler and the database handler, when logging to an archive
+LOG_ARCHIVE = None
+
+
+def values_pattern(values):
+    '''
+    A regular expression matching any of `values`, the longest one when
+    several match at the same position. The values are merged into a trie
+    so the expression branches on the next character instead of trying
+    every value in turn.
+
+    >>> values_pattern(['foo', 'foobar', 'bar', 'baz'])
+    '(?:ba(?:r|z)|foo(?:bar)?)'
+    '''
+    trie = {}
+    for value in values:
+        node = trie
+        for char in value:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def pattern(node):
+        parts = []
+        while True:
+            children = [(char, child) for char, child in node.items() if char]
+            if len(children) != 1 or '' in node:
+                break
+            char, node = children[0]
+            parts.append(re.escape(char))
+
+        if children:
+            group = '(?:' + '|'.join(
+                re.escape(char) + pattern(child) for char, child in sorted(children)
+            ) + ')'
+            # the optional group is greedy, so longer values win
+            parts.append(group + '?' if '' in node else group)
+
+        return ''.join(parts)
+
+    return pattern(trie)
+
 
 class LogFilter(logging.Filter):
     '''
     For every log message, replaces any of the values found in `priv_values`
     with the provided or default `mask` text. In addition, this prevents empty
     messages from being logged at all.
+
+    The values are compiled into a single regular expression, preferring
+    the longest value so a value containing another is masked whole, see
+    `values_pattern`. It is applied once per record to the message
+    formatted with its arguments and to its traceback, however many
+    handlers share the filter.
+
+    >>> log_filter = LogFilter(['secret', 'secret-token'], mask='***')
+    >>> record = logging.makeLogRecord({'msg': 'token: %s', 'args': ('secret-token',)})
+    >>> log_filter.filter(record), record.getMessage()
+    (True, 'token: ***')
     '''
     DEFAULT_MASK = '[PRIVATE VALUE HIDDEN]'
     INVALID_ACCESS_KEY = 'InvalidAccessKeyId'
@@ -26,11 +84,31 @@ class LogFilter(logging.Filter):
     def __init__(self, priv_vals, mask=DEFAULT_MASK):
         self.priv_vals = priv_vals
         self.mask = mask
+
+        values = [val for val in priv_vals if val]
+        self.matcher = re.compile(values_pattern(values)) if values else None
+        self.replacement = mask.replace('\\', '\\\\')
+
         logging.Filter.__init__(self)
 
+    def mask_values(self, text):
+        if self.matcher is None:
+            return text
+        return self.matcher.sub(self.replacement, text)
+
     def filter(self, record):
-        for priv_val in self.priv_vals:
-            record.msg = record.msg.replace(priv_val, self.mask)
+        if getattr(record, 'masked_by', None) is not self:
+            record.msg = self.mask_values(record.getMessage())
+            record.args = None
+
+            if record.exc_info and not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            if record.exc_text:
+                record.exc_text = self.mask_values(record.exc_text)
+            if record.stack_info:
+                record.stack_info = self.mask_values(record.stack_info)
+
+            record.masked_by = self
 
         if self.INVALID_ACCESS_KEY in record.msg:
             record.msg = (
@@ -79,9 +157,17 @@ def set_log_attrs(attrs):
     LOG_ATTRS = attrs
 
 
-def init_logging(private_values, attrs, db_url):
-    global LOG_ATTRS
+def init_logging(private_values, attrs, db_url, db_spill_path=None, db_chunk_lines=None,
+                 db_compress=False, db_notify=False, archive_path=None):
+    '''
+    Logs to stdout and to the database. With `archive_path`, the build log
+    is written to a compressed archive at that path instead of the
+    database, see `upload_log_archive`. With `db_notify`, listeners are
+    notified of the lines written to the database, see `log_utils.tail`.
+    '''
+    global LOG_ATTRS, LOG_ARCHIVE
     LOG_ATTRS = attrs
+    LOG_ARCHIVE = None
 
     date_fmt = '%Y-%m-%d %H:%M:%S'
     style_fmt = '{'
@@ -111,11 +197,65 @@ def init_logging(private_values, attrs, db_url):
     build_id = attrs['buildid']
     db_formatter = logging.Formatter(short_fmt, date_fmt, style_fmt)
 
-    db_handler = DBHandler(db_url, build_id)
+    db_options = {}
+    if db_chunk_lines:
+        db_options = dict(
+            chunks=True,
+            compress=db_compress,
+            batch_size=db_chunk_lines,
+            flush_interval=CHUNK_FLUSH_INTERVAL
+        )
+
+    db_handler = DBHandler(
+        db_url, build_id, spill_path=db_spill_path, notify=db_notify, **db_options
+    )
     db_handler.setFormatter(db_formatter)
     db_handler.setLevel(log_level)
     db_handler.addFilter(log_filter)
 
-    handlers.append(db_handler)
+    if archive_path:
+        archive_handler = ArchiveHandler(archive_path)
+        archive_handler.setFormatter(db_formatter)
+        archive_handler.setLevel(log_level)
+        archive_handler.addFilter(log_filter)
+
+        handlers.append(archive_handler)
+        LOG_ARCHIVE = (archive_handler, db_handler)
+    else:
+        handlers.append(db_handler)
 
     logging.basicConfig(level=log_level, handlers=handlers)
+
+
+def upload_log_archive(s3_client, bucket, key):
+    '''
+    When logging to an archive, uploads it as `key` in `bucket` and writes
+    a summary and the tail of the build log to the database, which gets
+    the records logged from then on.
+    '''
+    global LOG_ARCHIVE
+    if LOG_ARCHIVE is None:
+        return
+
+    archive_handler, db_handler = LOG_ARCHIVE
+    LOG_ARCHIVE = None
+
+    root = logging.getLogger()
+    root.removeHandler(archive_handler)
+
+    url = f's3://{bucket}/{key}'
+    try:
+        size = archive_handler.upload(s3_client, bucket, key)
+        message = (
+            f'The build log ({archive_handler.line_count} lines, {size} bytes compressed) '
+            f'was archived to {url}'
+        )
+    except Exception as err:  # pylint: disable=W0703
+        message = f'Failed to archive the build log to {url}: {err}'
+
+    message += f', the last {len(archive_handler.tail)} lines follow'
+
+    for record in archive_handler.summary_records(message):
+        db_handler.handle(record)
+
+    root.addHandler(db_handler)
@@ -1,10 +1,38 @@
 '''Functions for sending remote logs'''
 
+import atexit
 import base64
+import queue
+import random
+import sys
+import threading
+
+from time import monotonic, sleep
+
 import requests
 
 from .common import (STATUS_COMPLETE, STATUS_ERROR, STATUS_PROCESSING)
 
+# Seconds to connect to, and then to wait for a response from, the API
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+
+# Failed posts are attempted up to MAX_ATTEMPTS times, waiting a random
+# time of up to RETRY_BACKOFF seconds, doubled after every attempt
+MAX_ATTEMPTS = 4
+RETRY_BACKOFF = 0.5
+
+# Responses worth retrying, the API being unavailable or overloaded
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# How long the statuses posted in the background are waited for at exit
+FLUSH_TIMEOUT = 30
+
+# Heartbeats are posted at most every HEARTBEAT_INTERVAL seconds when the
+# progress changed, and at least every HEARTBEAT_KEEPALIVE seconds
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_KEEPALIVE = 5 * 60
+
 
 def b64string(text):
     '''
@@ -16,18 +44,189 @@ def b64string(text):
     return base64.b64encode(text.encode('utf-8')).decode('utf-8')
 
 
-def post_status(status_callback_url, status, output='', commit_sha=None):
+class StatusClient():
     '''
-    POSTs `status` and `output` to the `status_callback_url`
+    POSTs JSON payloads to the API over a single session, so connections
+    are kept alive between posts.
+
+    Each post times out after CONNECT_TIMEOUT and READ_TIMEOUT, and failed
+    posts are retried up to MAX_ATTEMPTS times with a jittered exponential
+    backoff. A post that still fails is reported on stderr rather than
+    failing the build.
+
+    Unless `blocking`, posts are queued and made in order by a background
+    worker, and the queued posts are waited for up to FLUSH_TIMEOUT
+    seconds at exit.
     '''
-    requests.post(
-        status_callback_url,
-        json={
-            'status': status,
-            'message': b64string(output),
-            'commit_sha': commit_sha,
-        }
-    )
+
+    def __init__(self, blocking=True):
+        self.blocking = blocking
+        self.session = requests.Session()
+
+        self.queue = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def post(self, url, payload):
+        if self.blocking:
+            self._post(url, payload)
+            return
+
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(
+                    target=self._work, name='status-client', daemon=True
+                )
+                self.worker.start()
+                atexit.register(self.flush)
+
+        self.queue.put((url, payload))
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        '''
+        Waits up to `timeout` seconds for the queued posts to be made,
+        returns whether they all were
+        '''
+        deadline = monotonic() + timeout
+
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    print(f'Gave up waiting for {self.queue.unfinished_tasks} build statuses '
+                          'to be posted', file=sys.stderr)
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+
+        return True
+
+    def _work(self):
+        while True:
+            url, payload = self.queue.get()
+            try:
+                self._post(url, payload)
+            except Exception as err:
+                # the worker keeps running, so the later statuses are posted
+                print(f'Failed to post the build status: {err}', file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    def _post(self, url, payload):
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                sleep(random.uniform(0, RETRY_BACKOFF * 2 ** (attempt - 1)))  # nosec
+
+            try:
+                response = self.session.post(
+                    url, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+                )
+            except requests.RequestException as err:
+                error = str(err)
+                continue
+
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+
+            error = f'{response.status_code} response'
+
+        print(f'Failed to post the build status after {MAX_ATTEMPTS} attempts: {error}',
+              file=sys.stderr)
+
+
+STATUS_CLIENT = StatusClient()
+
+
+def init_status_client(blocking=True):
+    '''
+    Replaces the client statuses are posted with, see `StatusClient`
+    '''
+    global STATUS_CLIENT
+    STATUS_CLIENT = StatusClient(blocking=blocking)
+    return STATUS_CLIENT
+
+
+class Heartbeat():
+    '''
+    Posts the progress of the build to `status_callback_url` from a
+    background thread while the build is processing.
+
+    The progress is a dict of the values passed to `update`, ie the current
+    step and the files and bytes published out of the total, along with
+    the elapsed seconds. Updates are coalesced: a heartbeat is posted at
+    most every `interval` seconds, and only if the progress changed since
+    the last one or `keepalive` seconds have passed.
+    '''
+
+    def __init__(self, status_callback_url, interval=HEARTBEAT_INTERVAL,
+                 keepalive=HEARTBEAT_KEEPALIVE):
+        self.status_callback_url = status_callback_url
+        self.interval = interval
+        self.keepalive = keepalive
+
+        self.start_time = monotonic()
+        self.last_post = self.start_time
+
+        self.progress = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+        # held while posting, so no heartbeat is posted once stopped
+        self.post_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+        self.thread.start()
+
+    def update(self, **progress):
+        with self.lock:
+            if any(self.progress.get(key) != value for key, value in progress.items()):
+                self.progress.update(progress)
+                self.changed = True
+
+    def stop(self):
+        '''
+        Stops posting heartbeats, call before posting the final status so it
+        is not followed by a heartbeat
+        '''
+        with self.post_lock:
+            self.stopped.set()
+
+    def beat(self):
+        '''Posts a heartbeat if it is due'''
+        now = monotonic()
+
+        with self.lock:
+            if not self.changed and now - self.last_post < self.keepalive:
+                return
+            progress = dict(self.progress, elapsed_seconds=round(now - self.start_time))
+            self.changed = False
+            self.last_post = now
+
+        with self.post_lock:
+            if not self.stopped.is_set():
+                post_status(self.status_callback_url, STATUS_PROCESSING, progress=progress)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.beat()
+
+
+def post_status(status_callback_url, status, output='', commit_sha=None, progress=None):
+    '''
+    POSTs `status` and `output`, and the `progress` of the build if any, to
+    the `status_callback_url`
+    '''
+    payload = {
+        'status': status,
+        'message': b64string(output),
+        'commit_sha': commit_sha,
+    }
+    if progress is not None:
+        payload['progress'] = progress
+
+    STATUS_CLIENT.post(status_callback_url, payload)
 
 
 def post_build_complete(status_callback_url, commit_sha):
@@ -0,0 +1,102 @@
+'''
+Follows the log of a build as it is written, using the notifications sent
+by `DBHandler` with `notify`
+'''
+
+import json
+import select
+
+from psycopg2 import sql
+
+from .chunks import decode_chunk
+
+# How long to wait for a notification before checking the connection again
+POLL_INTERVAL = 5
+
+# Greater than any row id
+MAX_ID = 2 ** 63 - 1
+
+NEW_ROWS_QUERIES = {
+    'buildlog': (
+        'SELECT id, output FROM buildlog '
+        'WHERE build = %s AND id > %s AND id <= %s ORDER BY id'
+    ),
+    'buildlog_chunk': (
+        'SELECT id, encoding, output FROM buildlog_chunk '
+        'WHERE build = %s AND id > %s AND id <= %s ORDER BY id'
+    ),
+}
+
+
+def channel(build_id):
+    '''
+    The channel notified of the new lines of a build
+
+    >>> channel(42)
+    'build_42'
+    '''
+    return f'build_{build_id}'
+
+
+def read_new_lines(cursor, build_id, table, after, last=MAX_ID):
+    '''
+    Returns the lines of a build in rows of `table` with ids after `after`,
+    up to `last`, and the id of the last of these rows
+    '''
+    cursor.execute(NEW_ROWS_QUERIES[table], (build_id, after, last))
+
+    lines = []
+    for row in cursor.fetchall():
+        if table == 'buildlog_chunk':
+            lines.extend(decode_chunk(row[1], row[2]))
+        else:
+            lines.append(row[1])
+        after = row[0]
+
+    return lines, after
+
+
+def tail_build_log(conn, build_id, idle_timeout=None):
+    '''
+    Yields the lines logged for a build so far, then the new lines as they
+    are written, until no lines were written for `idle_timeout` seconds if
+    given.
+
+    New rows are only read when a notification arrives, from after the last
+    row read, so a missed notification delays lines but does not lose them.
+    '''
+    # notifications are only received outside of transactions
+    conn.autocommit = True
+
+    with conn.cursor() as cursor:
+        # listen before reading the existing lines, so none are missed
+        cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(channel(build_id))))
+
+        last_ids = {}
+        for table in NEW_ROWS_QUERIES:
+            lines, last_ids[table] = read_new_lines(cursor, build_id, table, 0)
+            yield from lines
+
+        idle = 0
+        while idle_timeout is None or idle < idle_timeout:
+            timeout = POLL_INTERVAL
+            if idle_timeout is not None:
+                timeout = min(timeout, idle_timeout - idle)
+
+            if select.select([conn], [], [], timeout) == ([], [], []):
+                idle += timeout
+                continue
+
+            conn.poll()
+            while conn.notifies:
+                payload = json.loads(conn.notifies.pop(0).payload)
+                table = payload['table']
+                if table not in NEW_ROWS_QUERIES or payload['last'] <= last_ids[table]:
+                    continue
+
+                lines, last_ids[table] = read_new_lines(
+                    cursor, build_id, table, last_ids[table], payload['last']
+                )
+                if lines:
+                    idle = 0
+                yield from lines
@@ -0,0 +1,117 @@
+'''
+A small on-disk cache for remote assets added to every published site
+'''
+
+import json
+import os
+import time
+
+from email.utils import formatdate
+from os import path
+from urllib.parse import urlparse
+
+import requests
+
+from log_utils import get_logger
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60  # 1 day
+DEFAULT_TIMEOUT_SECONDS = 5
+
+
+class AssetCache():
+    '''
+    Fetches assets through a cache directory.
+
+    Cached copies are used as-is for `ttl` seconds, then revalidated with a
+    conditional request. If the remote cannot be reached within `timeout`
+    seconds, the cached copy is used regardless of its age.
+
+    The cache directory can be seeded with a copy of an asset, ie when
+    building the container image, in which case its mtime is used for the
+    `If-Modified-Since` header.
+    '''
+
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL_SECONDS,
+                 timeout=DEFAULT_TIMEOUT_SECONDS, session=None):
+        self.cache_dir = str(cache_dir)
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = session or requests.Session()
+
+    def asset_path(self, url):
+        '''The path of the cached copy of the asset at `url`'''
+        return path.join(self.cache_dir, path.basename(urlparse(url).path))
+
+    def get(self, url):
+        '''Returns the contents of the asset at `url` as bytes'''
+        logger = get_logger('asset-cache')
+
+        asset_path = self.asset_path(url)
+        meta_path = asset_path + '.json'
+
+        cached = path.isfile(asset_path)
+        if cached and time.time() - path.getmtime(asset_path) < self.ttl:
+            return self._read(asset_path)
+
+        headers = {}
+        if cached:
+            meta = self._read_meta(meta_path)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            headers['If-Modified-Since'] = meta.get(
+                'last_modified', formatdate(path.getmtime(asset_path), usegmt=True)
+            )
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+
+            if cached and response.status_code == 304:
+                # still fresh, restart the ttl
+                os.utime(asset_path)
+                return self._read(asset_path)
+
+            response.raise_for_status()
+        except requests.RequestException as err:
+            if not cached:
+                raise RuntimeError(f'Unable to fetch {url}: {err}')
+
+            logger.warning(f'Unable to revalidate {url}, using cached copy: {err}')
+            return self._read(asset_path)
+
+        self._write(asset_path, meta_path, response)
+
+        return response.content
+
+    def _read(self, asset_path):
+        with open(asset_path, 'rb') as asset_file:
+            return asset_file.read()
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, asset_path, meta_path, response):
+        meta = {}
+        if response.headers.get('ETag'):
+            meta['etag'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            meta['last_modified'] = response.headers['Last-Modified']
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            # write to a temporary file first so that concurrent readers
+            # never see a partial asset
+            tmp_path = f'{asset_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(response.content)
+            os.replace(tmp_path, asset_path)
+
+            with open(meta_path, 'w') as meta_file:
+                json.dump(meta, meta_file)
+        except OSError as err:
+            # caching is best effort
+            get_logger('asset-cache').warning(f'Unable to cache {asset_path}: {err}')
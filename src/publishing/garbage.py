@@ -0,0 +1,208 @@
+'''
+Deferred deletion ("garbage collection") of stale site objects
+
+Instead of deleting stale objects at the end of a publish, the publisher can
+record them in a per-site manifest object and return. The manifests are
+drained later, outside of any build, by `collect_garbage`.
+'''
+
+import json
+
+from datetime import datetime, timezone
+
+from log_utils import get_logger
+
+GC_MANIFEST_PREFIX = '_stale-objects'
+MAX_S3_KEYS_PER_DELETE = 1000
+
+
+def manifest_key(site_prefix):
+    '''
+    The key of the stale object manifest for a site
+
+    >>> manifest_key('site/owner/repo')
+    '_stale-objects/site/owner/repo.json'
+
+    >>> manifest_key('/preview/owner/repo/branch/')
+    '_stale-objects/preview/owner/repo/branch.json'
+    '''
+    return f'{GC_MANIFEST_PREFIX}/{site_prefix.strip("/")}.json'
+
+
+def load_manifest(bucket, key, s3_client):
+    '''
+    Returns a tuple of the parsed manifest and its ETag, or `(None, None)` if
+    the manifest does not exist.
+    '''
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return None, None
+
+    return json.loads(response['Body'].read()), response['ETag']
+
+
+def manifest_etag(bucket, key, s3_client):
+    '''Returns the current ETag of the manifest or None if it is gone'''
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+    except s3_client.exceptions.ClientError:
+        return None
+
+
+def record_stale_objects(bucket, site_prefix, stale_objects, live_keys, s3_client):
+    '''
+    Merges `stale_objects` into the site's manifest instead of deleting them.
+
+    Keys that are published again (present in `live_keys`) are dropped from
+    the manifest so that a later collection can never remove them. Keys
+    that are already recorded with the same content keep the time they were
+    first recorded, so the manifest is only rewritten when it changes.
+
+    Returns the number of keys pending deletion for the site.
+    '''
+    key = manifest_key(site_prefix)
+    manifest, _ = load_manifest(bucket, key, s3_client)
+    existing = manifest['objects'] if manifest else {}
+
+    recorded_at = datetime.now(timezone.utc).isoformat()
+
+    pending = {
+        s3_key: entry for s3_key, entry in existing.items()
+        if s3_key not in live_keys
+    }
+    for obj in stale_objects:
+        entry = pending.get(obj.s3_key)
+        if entry is None or entry['md5'] != obj.md5:
+            pending[obj.s3_key] = {'md5': obj.md5, 'recorded_at': recorded_at}
+
+    if pending == existing:
+        return len(pending)
+
+    if not pending:
+        s3_client.delete_object(Bucket=bucket, Key=key)
+        return 0
+
+    s3_client.put_object(
+        Body=json.dumps({'site_prefix': site_prefix, 'objects': pending}),
+        Bucket=bucket,
+        Key=key,
+        ContentType='application/json',
+        ServerSideEncryption='AES256',
+    )
+
+    return len(pending)
+
+
+def list_manifest_keys(bucket, s3_client, site_prefix=None):
+    '''Lists the keys of all manifests, or only the one for `site_prefix`'''
+    if site_prefix:
+        return [manifest_key(site_prefix)]
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    return [
+        obj['Key']
+        for page in paginator.paginate(Bucket=bucket, Prefix=f'{GC_MANIFEST_PREFIX}/')
+        for obj in page.get('Contents', [])
+    ]
+
+
+def list_remote_state(bucket, site_prefix, s3_client):
+    '''Maps every key under `site_prefix` to its (md5, last modified) pair'''
+    paginator = s3_client.get_paginator('list_objects_v2')
+    prefix = site_prefix if site_prefix.endswith('/') else site_prefix + '/'
+
+    state = {}
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            state[obj['Key']] = (obj['ETag'].replace('"', ''), obj['LastModified'])
+
+    return state
+
+
+def deletable_keys(manifest, remote_state):
+    '''
+    Returns the manifest keys that are still safe to delete: the remote object
+    must be unchanged since it was recorded as stale.
+    '''
+    keys = []
+    for s3_key, entry in manifest['objects'].items():
+        remote = remote_state.get(s3_key)
+        if not remote:
+            continue
+
+        md5, last_modified = remote
+        recorded_at = datetime.fromisoformat(entry['recorded_at'])
+        if md5 == entry['md5'] and last_modified <= recorded_at:
+            keys.append(s3_key)
+
+    return keys
+
+
+def delete_keys(bucket, keys, s3_client):
+    '''Deletes `keys` in bulk, returns the number of keys deleted'''
+    deleted = 0
+    for idx in range(0, len(keys), MAX_S3_KEYS_PER_DELETE):
+        batch = keys[idx:idx + MAX_S3_KEYS_PER_DELETE]
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                'Objects': [{'Key': key} for key in batch],
+                'Quiet': True,
+            }
+        )
+        deleted += len(batch) - len(response.get('Errors', []))
+
+    return deleted
+
+
+def collect_garbage(bucket, s3_client, site_prefix=None, dry_run=False):
+    '''
+    Drains the stale object manifests in `bucket`, or only the one for
+    `site_prefix`.
+
+    A manifest that is rewritten by a publish while it is being drained is
+    left alone and will be picked up again by the next collection. Its ETag
+    is checked again before each batch of deletes, but a publish can still
+    land between that check and the batch, in which case objects it
+    published again can be deleted. Collect while sites are not being
+    published to rule that out.
+
+    Returns a dict with the number of `deleted` and `skipped` keys.
+    '''
+    logger = get_logger('gc')
+
+    stats = {'deleted': 0, 'skipped': 0}
+
+    for key in list_manifest_keys(bucket, s3_client, site_prefix):
+        manifest, etag = load_manifest(bucket, key, s3_client)
+        if not manifest:
+            continue
+
+        prefix = manifest['site_prefix']
+        remote_state = list_remote_state(bucket, prefix, s3_client)
+        keys = deletable_keys(manifest, remote_state)
+        stats['skipped'] += len(manifest['objects']) - len(keys)
+
+        if dry_run:
+            logger.info(f'Dry-run deleting {len(keys)} stale objects for {prefix}')
+            continue
+
+        logger.info(f'Deleting {len(keys)} stale objects for {prefix}')
+
+        changed = False
+        for idx in range(0, len(keys), MAX_S3_KEYS_PER_DELETE):
+            if manifest_etag(bucket, key, s3_client) != etag:
+                changed = True
+                break
+            stats['deleted'] += delete_keys(
+                bucket, keys[idx:idx + MAX_S3_KEYS_PER_DELETE], s3_client
+            )
+
+        if changed or manifest_etag(bucket, key, s3_client) != etag:
+            logger.info(f'Manifest for {prefix} changed, leaving it for the next collection')
+            continue
+
+        s3_client.delete_object(Bucket=bucket, Key=key)
+
+    return stats
@@ -0,0 +1,133 @@
+'''
+Metrics collected while publishing a site
+'''
+
+import json
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+# Upper bounds, in seconds, of the S3 request latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')]
+
+PHASES = ['walk', 'compress', 'hash', 'list', 'upload', 'delete']
+
+
+class PublishMetrics():
+    '''
+    Collects per-phase timings, byte counts, and S3 request counts and
+    latencies for a publish.
+
+    S3 requests are counted by registering on the botocore events of the
+    client, so requests made by `upload_file` are included as well. A call
+    which gets a response counts as one request, timed across its retries,
+    and every attempt which fails without a response, ie on a connection
+    error, counts as a failed request.
+    '''
+
+    def __init__(self):
+        self.phases = dict((phase, 0.0) for phase in PHASES)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.bytes_uploaded = 0
+        self.requests = defaultdict(int)
+        self.failed_requests = defaultdict(int)
+        self.latencies = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        '''Adds the time spent in the block to the phase `name`'''
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + perf_counter() - start
+
+    def record_request(self, operation, seconds, failed=False):
+        '''Records an S3 request and its latency'''
+        bucket = next(idx for idx, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)
+        # uploads can make concurrent requests from s3transfer threads
+        with self._lock:
+            self.requests[operation] += 1
+            self.latencies[operation][bucket] += 1
+            if failed:
+                self.failed_requests[operation] += 1
+
+    @contextmanager
+    def instrument(self, s3_client):
+        '''Records every request made with `s3_client` within the block'''
+        events = s3_client.meta.events
+        unique_id = f'publish-metrics-{id(self)}'
+
+        def before_call(model, context, **kwargs):
+            context['publish_metrics_start'] = perf_counter()
+
+        def after_call(model, context, **kwargs):
+            start = context.pop('publish_metrics_start', None)
+            if start is not None:
+                self.record_request(model.name, perf_counter() - start)
+
+        # `after-call-error` is not emitted by older versions of botocore,
+        # while `needs-retry` follows every attempt, including the last
+        def needs_retry(operation, request_dict, caught_exception=None, **kwargs):
+            context = request_dict.get('context', {})
+            start = context.get('publish_metrics_start')
+            if caught_exception is None or start is None:
+                return
+
+            now = perf_counter()
+            self.record_request(operation.name, now - start, failed=True)
+            # the next attempt, if any, is timed on its own
+            context['publish_metrics_start'] = now
+
+        # unique ids are shared by all the events of the client
+        handlers = [
+            ('before-call.s3', before_call),
+            ('after-call.s3', after_call),
+            ('needs-retry.s3', needs_retry),
+        ]
+        for event_name, handler in handlers:
+            events.register(event_name, handler, unique_id=f'{unique_id}-{event_name}')
+        try:
+            yield
+        finally:
+            for event_name, _ in handlers:
+                events.unregister(event_name, unique_id=f'{unique_id}-{event_name}')
+
+    def to_dict(self):
+        '''The metrics as a dict which can be serialized to JSON'''
+        return {
+            'phases': dict(self.phases),
+            'bytes': {
+                'read': self.bytes_read,
+                'written': self.bytes_written,
+                'uploaded': self.bytes_uploaded,
+            },
+            'requests': dict(self.requests),
+            'failed_requests': dict(self.failed_requests),
+            'latency_buckets': [str(bound) for bound in LATENCY_BUCKETS],
+            'latencies': dict(self.latencies),
+        }
+
+    def write_json(self, filename):
+        '''Writes the metrics to `filename` as JSON'''
+        with open(filename, 'w') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+
+    def summary(self):
+        '''
+        A one line summary of the metrics
+
+        >>> metrics = PublishMetrics()
+        >>> metrics.bytes_uploaded = 2048
+        >>> metrics.record_request('PutObject', 0.2)
+        >>> metrics.summary()
+        'walk: 0.0s, compress: 0.0s, hash: 0.0s, list: 0.0s, upload: 0.0s, delete: 0.0s, read: 0 B, written: 0 B, uploaded: 2048 B, requests: PutObject=1'
+        '''  # noqa: E501
+        phases = ', '.join(f'{name}: {seconds:.1f}s' for name, seconds in self.phases.items())
+        requests = ' '.join(f'{op}={count}' for op, count in sorted(self.requests.items()))
+        return (f'{phases}, read: {self.bytes_read} B, written: {self.bytes_written} B, '
+                f'uploaded: {self.bytes_uploaded} B, requests: {requests or "none"}')
@@ -3,11 +3,14 @@
 import binascii
 import gzip
 import hashlib
+import json
 import mimetypes
 
 from datetime import datetime
 from os import path
 
+from .metrics import PublishMetrics
+
 mimetypes.init()  # must initialize mimetypes
 
 
@@ -63,15 +66,21 @@ class SiteFile(SiteObject):
 
     GZIP_EXTENSIONS = ['html', 'css', 'js', 'json', 'svg']
 
-    def __init__(self, filename, dir_prefix, site_prefix, cache_control):
+    def __init__(self, filename, dir_prefix, site_prefix, cache_control, metrics=None):
         super().__init__(filename=filename,
                          md5=None,
                          dir_prefix=dir_prefix,
                          site_prefix=site_prefix)
+        self.metrics = metrics or PublishMetrics()
         self._compress()
         self.md5 = self.generate_md5()
         self.cache_control = cache_control
 
+    @property
+    def size(self):
+        '''The size in bytes of the object that will be uploaded'''
+        return path.getsize(self.filename)
+
     @property
     def is_compressible(self):
         '''Whether the file should be compressed'''
@@ -103,9 +112,10 @@ class SiteFile(SiteObject):
         '''Generates an md5 hash of the file contents'''
         hash_md5 = hashlib.md5()  # nosec
 
-        with open(self.filename, 'rb') as file:
+        with self.metrics.phase('hash'), open(self.filename, 'rb') as file:
             for chunk in iter(lambda: file.read(4096), b""):
                 hash_md5.update(chunk)
+                self.metrics.bytes_read += len(chunk)
         return hash_md5.hexdigest()
 
     def _compress(self):
@@ -120,7 +130,7 @@ class SiteFile(SiteObject):
             return
 
         # otherwise, gzip the file in place
-        with open(self.filename, 'rb') as f_in:
+        with self.metrics.phase('compress'), open(self.filename, 'rb') as f_in:
             contents = f_in.read()
             # Spoof the modification time so that MD5 hashes match next time
             spoofed_mtime = datetime(2014, 3, 19).timestamp()  # March 19, 2014
@@ -129,6 +139,9 @@ class SiteFile(SiteObject):
                                mtime=spoofed_mtime) as gz_file:
                 gz_file.write(contents)
 
+        self.metrics.bytes_read += len(contents)
+        self.metrics.bytes_written += self.size
+
     def upload_to_s3(self, bucket, s3_client):
         extra_args = {
             "CacheControl": self.cache_control,
@@ -168,6 +181,11 @@ class SiteRedirect(SiteObject):
         # of the file contents, for our redirect objects
         self.md5 = hashlib.md5(self.destination.encode()).hexdigest()  # nosec
 
+    @property
+    def size(self):
+        '''The size in bytes of the object that will be uploaded'''
+        return len(self.destination.encode())
+
     @property
     def destination(self):
         '''The destination of the redirect object'''
@@ -207,3 +225,50 @@ class SiteRedirect(SiteObject):
             WebsiteRedirectLocation=self.destination,
             CacheControl=self.cache_control
         )
+
+
+class SiteRedirectMap(SiteObject):
+    '''
+    A single object mapping the directory redirects of a site to their
+    destinations, published instead of one `SiteRedirect` object per directory
+    '''
+
+    FILENAME = '.redirect-map.json'
+
+    def __init__(self, dir_prefix, site_prefix, redirects, cache_control):
+        super().__init__(filename=path.join(dir_prefix, self.FILENAME),
+                         dir_prefix=dir_prefix,
+                         md5=None,  # update after super().__init()__
+                         site_prefix=site_prefix)
+
+        self.cache_control = cache_control
+
+        # Map the redirect keys relative to the site prefix so that the
+        # map is independent of where the site is published
+        self.redirects = {
+            remove_prefix(remove_prefix(redirect.s3_key, site_prefix), '/'): redirect.destination
+            for redirect in redirects
+        }
+
+        self.md5 = hashlib.md5(self.body.encode()).hexdigest()  # nosec
+
+    @property
+    def size(self):
+        '''The size in bytes of the object that will be uploaded'''
+        return len(self.body.encode())
+
+    @property
+    def body(self):
+        '''The compact JSON encoding of the redirects, sorted by key'''
+        return json.dumps(self.redirects, sort_keys=True, separators=(',', ':'))
+
+    def upload_to_s3(self, bucket, s3_client):
+        '''Uploads the redirect map to S3'''
+        s3_client.put_object(
+            Body=self.body,
+            Bucket=bucket,
+            Key=self.s3_key,
+            ServerSideEncryption='AES256',
+            ContentType='application/json',
+            CacheControl=self.cache_control
+        )
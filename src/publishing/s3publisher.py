@@ -2,16 +2,39 @@
 Classes and methods for publishing a directory to S3
 '''
 
-import requests
+import re
 
 from os import path, makedirs, walk, getenv
+from time import perf_counter
 
 from log_utils import get_logger
-from .models import (remove_prefix, SiteObject, SiteFile, SiteRedirect)
+from .asset_cache import AssetCache
+from .garbage import record_stale_objects
+from .metrics import PublishMetrics
+from .models import (remove_prefix, SiteObject, SiteFile, SiteRedirect, SiteRedirectMap)
 
 MAX_S3_KEYS_PER_REQUEST = 1000
 FEDERALIST_JSON = 'federalist.json'
 
+DEFAULT_404_URL = ('https://raw.githubusercontent.com'
+                   '/cloud-gov/pages-404-page/main/'
+                   '404-pages-client.html')
+ASSET_CACHE_DIR = getenv('ASSET_CACHE_DIR', '/var/cache/pages-build')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# A content hash segment of a filename, ie `3f9a2c1b` in `main.3f9a2c1b.js`:
+# at least 8 hex characters with at least one digit and one letter, or at
+# least 16 base32 characters with at least 3 digits, so that words, dates,
+# version numbers, and long names with a number are not mistaken for one
+FINGERPRINT_SEGMENT = re.compile(
+    r'(?=.*[0-9])(?=.*[a-z])[0-9a-f]{8,64}'
+    r'|(?=(?:[a-z]*[2-7]){3})(?=.*[a-z])[a-z2-7]{16,64}',
+    re.IGNORECASE
+)
+FINGERPRINT_SEPARATORS = re.compile(r'[.\-_~]')
+FINGERPRINT_EXCLUDED_EXTENSIONS = ['.html', '.htm']
+
 
 def list_remote_objects(bucket, site_prefix, s3_client):
     '''
@@ -69,8 +92,63 @@ def list_remote_objects(bucket, site_prefix, s3_client):
     return remote_objects
 
 
-def get_cache_control(federalist_config, filename):
-    return federalist_config.get_headers_for_path(filename).get('cache-control')
+def is_fingerprinted(filename):
+    '''
+    Whether the filename contains a content hash, so its contents never
+    change under the same name.
+
+    >>> is_fingerprinted('/static/main.3f9a2c1b.js')
+    True
+
+    >>> is_fingerprinted('/static/main.3f9a2c1b.js.map')
+    True
+
+    >>> is_fingerprinted('/chunk-5f2d8a3c9e0b1a7d4c6e.css')
+    True
+
+    >>> is_fingerprinted('/assets/logo.mzxw6ytboi3tmn7q.svg')
+    True
+
+    >>> is_fingerprinted('/js/responsivenavigation3.js')
+    False
+
+    >>> is_fingerprinted('/js/sidebarnavigation2menu3.js')
+    False
+
+    >>> is_fingerprinted('/static/main.js')
+    False
+
+    >>> is_fingerprinted('/reports/2023-01-01.20230101.pdf')
+    False
+
+    >>> is_fingerprinted('/3f9a2c1b/index.html')
+    False
+
+    >>> is_fingerprinted('/about.3f9a2c1b.html')
+    False
+    '''
+    name, extension = path.splitext(path.basename(filename))
+    if not extension or extension.lower() in FINGERPRINT_EXCLUDED_EXTENSIONS:
+        return False
+
+    return any(
+        FINGERPRINT_SEGMENT.fullmatch(segment)
+        for segment in FINGERPRINT_SEPARATORS.split(name)
+    )
+
+
+def resolve_cache_control(rule_headers, headers, filename):
+    '''
+    The cache control of a file given the headers of its matching rule and
+    its headers including the defaults, see `RepoConfig.classify_paths`.
+
+    Headers configured for the path take precedence, fingerprinted files are
+    otherwise cached indefinitely.
+    '''
+    if 'cache-control' not in rule_headers and is_fingerprinted(filename):
+        return IMMUTABLE_CACHE_CONTROL
+
+    return headers.get('cache-control')
 
 
 def strip_dirname(filepath, dirname):
@@ -80,55 +158,119 @@ def strip_dirname(filepath, dirname):
 
 
 def publish_to_s3(directory, base_url, site_prefix, bucket, federalist_config,
-                  s3_client, dry_run=False):
-    '''Publishes the given directory to S3'''
+                  s3_client, dry_run=False, defer_deletes=False, redirect_map=False,
+                  metrics=None, progress=None):
+    '''
+    Publishes the given directory to S3
+
+    When `defer_deletes` is set, stale objects are recorded in the site's
+    stale object manifest instead of being deleted, see `garbage.py`.
+
+    When `redirect_map` is set, the directory redirects are published as a
+    single `SiteRedirectMap` object instead of one object per directory.
+
+    Returns the `PublishMetrics` of the publish, collected into `metrics` if
+    it is provided.
+
+    `progress` is called with the keyword arguments `files_done`,
+    `files_total`, `bytes_done`, and `bytes_total` as files are uploaded.
+    '''
+    metrics = metrics or PublishMetrics()
+
+    with metrics.instrument(s3_client):
+        _publish_to_s3(directory, base_url, site_prefix, bucket, federalist_config,
+                       s3_client, dry_run, defer_deletes, redirect_map, metrics, progress)
+
+    return metrics
+
+
+def _publish_to_s3(directory, base_url, site_prefix, bucket, federalist_config,
+                   s3_client, dry_run, defer_deletes, redirect_map, metrics, progress):
     logger = get_logger('publish')
 
     # Add local 404 if does not already exist
     filename_404 = directory + '/404.html'
     if not path.isfile(filename_404):
-        default_404_url = ('https://raw.githubusercontent.com'
-                           '/cloud-gov/pages-404-page/main/'
-                           '404-pages-client.html')
-        default_404 = requests.get(default_404_url)
+        default_404 = AssetCache(ASSET_CACHE_DIR).get(DEFAULT_404_URL)
         makedirs(path.dirname(filename_404), exist_ok=True)
-        with open(filename_404, "w+") as f:
-            f.write(default_404.text)
+        with open(filename_404, "wb") as f:
+            f.write(default_404)
 
     # Collect a list of all files in `directory``
     local_objects_by_filename = {}
+    site_redirects = []
+    walked_files = []
+
+    # compressing and hashing happen during the walk but are timed separately
+    walk_start = perf_counter()
+    walk_excluded = metrics.phases['compress'] + metrics.phases['hash']
+
+    for root, dirs, filenames in walk(directory):
+        # Don't descend into directories where nothing can be included
+        dirs[:] = [
+            dir for dir in dirs
+            if not federalist_config.is_subtree_excluded(
+                strip_dirname(path.join(root, dir), directory))
+        ]
 
-    for root, _dirs, filenames in walk(directory):
         for filename in filenames:
-            full_path = path.join(root, filename)
-            relative_path = strip_dirname(full_path, directory)
+            walked_files.append((root, filename))
 
-            if federalist_config.is_path_included(relative_path):
-                cache_control = get_cache_control(federalist_config, relative_path)
+    relative_paths = [
+        strip_dirname(path.join(root, filename), directory) for root, filename in walked_files
+    ]
+    classification = federalist_config.classify_paths(relative_paths)
 
-                site_file = SiteFile(filename=full_path,
-                                     dir_prefix=directory,
-                                     site_prefix=site_prefix,
-                                     cache_control=cache_control)
+    for idx, (root, filename) in enumerate(walked_files):
+        if not classification.included[idx]:
+            continue
 
-                local_objects_by_filename[site_file.filename] = site_file
+        cache_control = resolve_cache_control(classification.rule_headers(idx),
+                                              classification.headers(idx),
+                                              relative_paths[idx])
 
-                if filename == 'index.html':
-                    site_redirect = SiteRedirect(filename=root,
-                                                 dir_prefix=directory,
-                                                 site_prefix=site_prefix,
-                                                 base_url=base_url,
-                                                 cache_control=cache_control)
+        site_file = SiteFile(filename=path.join(root, filename),
+                             dir_prefix=directory,
+                             site_prefix=site_prefix,
+                             cache_control=cache_control,
+                             metrics=metrics)
 
-                    local_objects_by_filename[site_redirect.filename] = site_redirect
+        local_objects_by_filename[site_file.filename] = site_file
+
+        if filename == 'index.html':
+            site_redirect = SiteRedirect(filename=root,
+                                         dir_prefix=directory,
+                                         site_prefix=site_prefix,
+                                         base_url=base_url,
+                                         cache_control=cache_control)
+
+            if redirect_map:
+                site_redirects.append(site_redirect)
+            else:
+                local_objects_by_filename[site_redirect.filename] = site_redirect
+
+    walk_excluded = metrics.phases['compress'] + metrics.phases['hash'] - walk_excluded
+    metrics.phases['walk'] += perf_counter() - walk_start - walk_excluded
+
+    # track whether we can do diffing because of cache control
+    default_cache_control = getenv('CACHE_CONTROL', 'max-age=60')
+
+    if site_redirects:
+        site_redirect_map = SiteRedirectMap(dir_prefix=directory,
+                                            site_prefix=site_prefix,
+                                            redirects=site_redirects,
+                                            cache_control=default_cache_control)
+
+        local_objects_by_filename[site_redirect_map.filename] = site_redirect_map
 
     if len(local_objects_by_filename) == 0:
         raise RuntimeError('Local build files not found')
 
     # Get list of remote files
-    remote_objects = list_remote_objects(bucket=bucket,
-                                         site_prefix=site_prefix,
-                                         s3_client=s3_client)
+    with metrics.phase('list'):
+        remote_objects = list_remote_objects(bucket=bucket,
+                                             site_prefix=site_prefix,
+                                             s3_client=s3_client)
 
     # Make dicts by filename of local and remote objects for easier searching
     remote_objects_by_filename = {}
@@ -141,14 +283,17 @@ def publish_to_s3(directory, base_url, site_prefix, bucket, federalist_config,
     # Create lists of all the new and modified objects
     new_objects = []
     replacement_objects = []
-    # track whether we can do diffing because of cache control
-    default_cache_control = getenv('CACHE_CONTROL', 'max-age=60')
     for local_filename, local_obj in local_objects_by_filename.items():
         matching_remote_obj = remote_objects_by_filename.get(local_filename)
         if not matching_remote_obj:
             new_objects.append(local_obj)
+        # Fingerprinted files never change under the same name, so they
+        # never need to be uploaded again to refresh their headers. The
+        # listing has no headers, so fingerprinted files published with
+        # another cache control keep it until their contents change.
         elif (matching_remote_obj.md5 != local_obj.md5 or
-              local_obj.cache_control != default_cache_control):
+              local_obj.cache_control not in (default_cache_control,
+                                              IMMUTABLE_CACHE_CONTROL)):
             replacement_objects.append(local_obj)
 
     # Create a list of the remote objects that should be deleted
@@ -168,28 +313,53 @@ def publish_to_s3(directory, base_url, site_prefix, bucket, federalist_config,
 
     # Upload new and replacement files
     upload_objects = new_objects + replacement_objects
-    for file in upload_objects:
-        if dry_run:  # pragma: no cover
-            logger.info(f'Dry-run uploading {file.s3_key}')
-        else:
-            logger.info(f'Uploading {file.s3_key}')
-
-            try:
-                file.upload_to_s3(bucket, s3_client)
-            except UnicodeEncodeError as err:
-                if err.reason == 'surrogates not allowed':
-                    logger.warning(
-                        f'... unable to upload {file.filename} due '
-                        f'to invalid characters in file name.'
-                    )
-                else:
-                    raise
-
-    # Delete files not needed any more
-    for file in deletion_objects:
-        if dry_run:  # pragma: no cover
-            logger.info(f'Dry run deleting {file.s3_key}')
-        else:
-            logger.info(f'Deleting {file.s3_key}')
-
-            file.delete_from_s3(bucket, s3_client)
+    with metrics.phase('upload'):
+        if progress:
+            sizes = [file.size for file in upload_objects]
+            bytes_total = sum(sizes)
+            bytes_done = 0
+            progress(files_done=0, files_total=len(upload_objects),
+                     bytes_done=0, bytes_total=bytes_total)
+
+        for idx, file in enumerate(upload_objects):
+            if dry_run:  # pragma: no cover
+                logger.info(f'Dry-run uploading {file.s3_key}')
+            else:
+                logger.info(f'Uploading {file.s3_key}')
+
+                try:
+                    file.upload_to_s3(bucket, s3_client)
+                    metrics.bytes_uploaded += file.size
+                except UnicodeEncodeError as err:
+                    if err.reason == 'surrogates not allowed':
+                        logger.warning(
+                            f'... unable to upload {file.filename} due '
+                            f'to invalid characters in file name.'
+                        )
+                    else:
+                        raise
+
+            if progress:
+                bytes_done += sizes[idx]
+                progress(files_done=idx + 1, files_total=len(upload_objects),
+                         bytes_done=bytes_done, bytes_total=bytes_total)
+
+    with metrics.phase('delete'):
+        if defer_deletes:
+            if dry_run:  # pragma: no cover
+                logger.info(f'Dry run deferring deletion of {len(deletion_objects)} objects')
+            else:
+                live_keys = set(obj.s3_key for obj in local_objects_by_filename.values())
+                pending = record_stale_objects(bucket, site_prefix, deletion_objects,
+                                               live_keys, s3_client)
+                logger.info(f'Deferred deletion, {pending} objects pending deletion')
+            return
+
+        # Delete files not needed any more
+        for file in deletion_objects:
+            if dry_run:  # pragma: no cover
+                logger.info(f'Dry run deleting {file.s3_key}')
+            else:
+                logger.info(f'Deleting {file.s3_key}')
+
+                file.delete_from_s3(bucket, s3_client)
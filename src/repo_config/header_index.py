@@ -0,0 +1,193 @@
+'''
+Header rules compiled into a segment trie
+'''
+
+from types import MappingProxyType
+
+
+def min_rule(a, b):
+    '''
+    The lowest of two rule indexes, either of which may be None
+
+    >>> min_rule(None, 2)
+    2
+
+    >>> min_rule(3, 1)
+    1
+    '''
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+class Node():
+    '''A node of the trie, one per pattern segment'''
+
+    __slots__ = ['literals', 'param', 'star', 'extensions', 'end', 'lowest']
+
+    def __init__(self):
+        self.literals = {}     # child nodes by literal segment
+        self.param = None      # child node for a ':param' segment
+        self.star = None       # rule ending in '*' at this node
+        self.extensions = {}   # rules ending in '*.ext' at this node, by ext
+        self.end = None        # rule ending exactly at this node
+        self.lowest = None     # lowest rule anywhere in this subtree
+
+
+class HeaderRuleIndex():
+    '''
+    Compiles the `headers` rules of a configuration once so that the first
+    matching rule for a path is found in O(path depth), following the same
+    semantics as `repo_config.match_path`.
+
+    Each pattern is inserted into a trie of its segments. Literal segments
+    and ':param' segments are edges, while '*', '*.ext', and the end of the
+    pattern are terminal and record the index of the rule. A lookup walks
+    the trie along the path and keeps the lowest matching rule index, which
+    preserves first-match order.
+
+    The resolved headers are immutable and interned, so rules with the same
+    headers share a single mapping.
+    '''
+
+    def __init__(self, rules, default_headers):
+        self.root = Node()
+        self.literal_segments = set()
+        self.rule_headers = []
+        self.headers = []
+
+        interned = {}
+
+        def intern(headers):
+            key = tuple(sorted(headers.items()))
+            if key not in interned:
+                interned[key] = MappingProxyType(headers)
+            return interned[key]
+
+        self.default_headers = intern(dict(default_headers))
+        self.empty_headers = intern({})
+
+        for rule in rules:
+            if not rule:
+                continue
+
+            pattern, headers = next(iter(rule.items()))
+
+            rule_headers = {
+                key.strip().lower(): value.strip()
+                for key, value in headers.items()
+            }
+
+            self.rule_headers.append(intern(rule_headers))
+            self.headers.append(intern({**default_headers, **rule_headers}))
+            self.insert(pattern, len(self.headers) - 1)
+
+    def insert(self, pattern, rule):
+        pattern = pattern[1:] if pattern.startswith('/') else pattern
+
+        node = self.root
+        node.lowest = min_rule(node.lowest, rule)
+
+        for part in pattern.split('/'):
+            if part == '*':
+                node.star = min_rule(node.star, rule)
+                return
+
+            if part.startswith(':'):
+                if node.param is None:
+                    node.param = Node()
+                node = node.param
+
+            elif part.startswith('*.'):
+                ext = part.split('.')[-1]
+                node.extensions[ext] = min_rule(node.extensions.get(ext), rule)
+                return
+
+            else:
+                node = node.literals.setdefault(part, Node())
+                self.literal_segments.add(part)
+
+            node.lowest = min_rule(node.lowest, rule)
+
+        node.end = min_rule(node.end, rule)
+
+    def find(self, path_to_match):
+        '''
+        Returns the index of the first rule matching `path_to_match` or None
+        '''
+        path_to_match = path_to_match[1:] if path_to_match.startswith('/') else path_to_match
+        parts = path_to_match.split('/')
+        last_ext = parts[-1].split('.')[-1]
+
+        return self._find(self.root, parts, 0, last_ext, None)
+
+    def find_many(self, paths):
+        '''
+        Returns the index of the first rule matching each of `paths`, or None
+
+        Unless the last segment of a path is a literal segment of a rule, the
+        match only depends on its directory and extension, so paths are
+        grouped by those and each group is matched once.
+        '''
+        find = self.find
+        literal_segments = self.literal_segments
+
+        found_by_dir = {}
+        results = []
+
+        for path_to_match in paths:
+            dirname, _, basename = path_to_match.rpartition('/')
+
+            found = found_by_dir.get(dirname)
+            if found is None:
+                found = found_by_dir[dirname] = {}
+
+            # a literal name and an extension can be the same string, ie
+            # `README` and `foo.README`, but do not match the same rules
+            if basename in literal_segments:
+                key = ('literal', basename)
+            else:
+                key = ('ext', basename.rpartition('.')[2])
+
+            rule = found.get(key, found)
+            if rule is found:
+                rule = found[key] = find(path_to_match)
+            results.append(rule)
+
+        return results
+
+    def _find(self, node, parts, idx, last_ext, best):
+        # nothing in this subtree can improve on the best match so far
+        if node.lowest is None or (best is not None and node.lowest >= best):
+            return best
+
+        best = min_rule(best, node.star)
+
+        if idx < len(parts):
+            if node.extensions:
+                best = min_rule(best, node.extensions.get(last_ext))
+
+            child = node.literals.get(parts[idx])
+            if child is not None:
+                best = self._find(child, parts, idx + 1, last_ext, best)
+
+        else:
+            best = min_rule(best, node.end)
+
+        # ':param' segments also match segments past the end of the path
+        if node.param is not None:
+            best = self._find(node.param, parts, idx + 1, last_ext, best)
+
+        return best
+
+    def get_headers(self, path_to_match):
+        '''The default headers merged with the headers of the first matching rule'''
+        rule = self.find(path_to_match)
+        return self.default_headers if rule is None else self.headers[rule]
+
+    def get_rule_headers(self, path_to_match):
+        '''The headers of the first matching rule'''
+        rule = self.find(path_to_match)
+        return self.empty_headers if rule is None else self.rule_headers[rule]
@@ -1,4 +1,16 @@
 import fnmatch
+import re
+
+from .header_index import HeaderRuleIndex
+
+PATH_INCLUDED = 'included'
+PATH_EXCLUDED = 'excluded'
+
+# Matches a path with a segment starting with '.' once a slash is prepended
+DOTPATH_REGEX = r'(?s:.*?/\.)'
+
+# Never matches anything
+EMPTY_REGEX = r'(?!)'
 
 
 class RepoConfig:
@@ -34,38 +46,126 @@ class RepoConfig:
         self.config = config
         self.defaults = defaults
 
+        # The header rules are matched for every published file, so they are
+        # compiled once
+        self.header_index = HeaderRuleIndex(
+            self.config.get('headers', []),
+            self.defaults.get('headers', {}))
+
+        # As are the include and exclude paths, which are combined into a
+        # single regex so that a path is classified with one match
+        exclude_regex = patterns_regex(self.exclude_paths())
+        include_regex = patterns_regex(self.include_paths())
+
+        self.exclude_matcher = re.compile(exclude_regex)
+        self.include_matcher = re.compile(include_regex)
+        self.classifier = re.compile(
+            f'(?P<{PATH_INCLUDED}>{include_regex})|'
+            f'(?P<{PATH_EXCLUDED}>{DOTPATH_REGEX}|{exclude_regex})'
+        )
+
+        # A directory is excluded as a whole when it is a dotpath or matches
+        # an exclude path ending in '*', since that '*' matches anything
+        # under the directory
+        self.subtree_exclude_matcher = re.compile(
+            f'{DOTPATH_REGEX}|' +
+            patterns_regex([p for p in self.exclude_paths() if p.endswith('*')])
+        )
+        self.include_prefixes = [literal_prefix(p) for p in self.include_paths()]
+
     def get_headers_for_path(self, path_to_match):
         '''
         Determine the headers that apply to particular filepath
+
+        The returned mapping is shared and immutable.
         '''
+        return self.header_index.get_headers(path_to_match)
 
-        # A shallow copy should be sufficient
-        resolved_headers = self.defaults.get('headers', {}).copy()
+    def get_rule_headers_for_path(self, path_to_match):
+        '''
+        Determine the headers configured for a particular filepath, without
+        the defaults
 
-        first_matching_cfg = find_first_matching_cfg(
-            self.config.get('headers', []),
-            path_to_match)
+        The returned mapping is shared and immutable.
+        '''
+        return self.header_index.get_rule_headers(path_to_match)
+
+    def classify(self, path_to_match):
+        '''
+        Returns PATH_EXCLUDED if the path is a dotpath or matches an exclude
+        path and does not match an include path, otherwise PATH_INCLUDED
+        '''
+        match = self.classifier.match(prepend_slash(path_to_match))
+        if match is None:
+            return PATH_INCLUDED
+        return match.lastgroup
 
-        if first_matching_cfg:
-            headers = first_value(first_matching_cfg)
+    def classify_paths(self, paths):
+        '''
+        Classifies many paths at once, see `PathClassification`
 
-            for key, value in headers.items():
-                resolved_headers[key.strip().lower()] = value.strip()
+        Paths in the same directory share the pruning check of the directory
+        and paths in the same directory with the same extension usually share
+        their header rule, so each is only computed once per batch.
+        '''
+        match = self.classifier.match
+        excluded_dirs = {}
+        included = []
+
+        for path_to_match in paths:
+            dirname = path_to_match.rpartition('/')[0]
+            excluded = excluded_dirs.get(dirname)
+            if excluded is None:
+                excluded = excluded_dirs[dirname] = (
+                    dirname.strip('/') != '' and self.is_subtree_excluded(dirname)
+                )
+
+            if excluded:
+                included.append(False)
+                continue
+
+            result = match(path_to_match if path_to_match.startswith('/') else '/' + path_to_match)
+            included.append(result is None or result.lastgroup == PATH_INCLUDED)
+
+        rules = self.header_index.find_many(paths)
+        header_ids = [0 if rule is None else rule + 1 for rule in rules]
+
+        return PathClassification(
+            included=included,
+            header_ids=header_ids,
+            header_sets=[self.header_index.default_headers] + self.header_index.headers,
+            rule_header_sets=[self.header_index.empty_headers] + self.header_index.rule_headers,
+        )
+
+    def is_subtree_excluded(self, dir_path):
+        '''
+        Whether every path under the directory is excluded, so that it does
+        not need to be traversed at all.
 
-        return resolved_headers
+        This is conservative: an include path that might match something
+        under the directory keeps the directory from being excluded.
+        '''
+        dir_path = prepend_slash(dir_path).rstrip('/') + '/'
+
+        if not self.subtree_exclude_matcher.match(dir_path):
+            return False
+
+        return not any(
+            prefix.startswith(dir_path) or (is_glob and dir_path.startswith(prefix))
+            for prefix, is_glob in self.include_prefixes
+        )
 
     def is_path_excluded(self, path_to_match):
-        return ((contains_dotpath(path_to_match) or self.is_exclude_path_match(path_to_match))
-                and not self.is_include_path_match(path_to_match))
+        return self.classify(path_to_match) == PATH_EXCLUDED
 
     def is_path_included(self, path_to_match):
-        return not self.is_path_excluded(path_to_match)
+        return self.classify(path_to_match) == PATH_INCLUDED
 
     def is_exclude_path_match(self, path_to_match):
-        return is_path_match(self.exclude_paths(), path_to_match)
+        return self.exclude_matcher.match(prepend_slash(path_to_match)) is not None
 
     def is_include_path_match(self, path_to_match):
-        return is_path_match(self.include_paths(), path_to_match)
+        return self.include_matcher.match(prepend_slash(path_to_match)) is not None
 
     def full_clone(self):
         return self.config.get('fullClone', False) is True
@@ -77,10 +177,75 @@ class RepoConfig:
         return self.config.get('includePaths', []) + self.defaults.get('includePaths', [])
 
 
+class PathClassification:
+    '''
+    The result of `RepoConfig.classify_paths`, by position in the paths:
+        - included: whether each path is published
+        - header_ids: the id of the header set of each path
+
+    The header sets are indexed by id, `header_sets` holds the headers of a
+    path and `rule_header_sets` holds only the headers of its matching rule.
+    The ids are the same for every batch classified with the same config,
+    so results can be combined or reused.
+    '''
+
+    def __init__(self, included, header_ids, header_sets, rule_header_sets):
+        self.included = included
+        self.header_ids = header_ids
+        self.header_sets = header_sets
+        self.rule_header_sets = rule_header_sets
+
+    def __len__(self):
+        return len(self.included)
+
+    def headers(self, idx):
+        return self.header_sets[self.header_ids[idx]]
+
+    def rule_headers(self, idx):
+        return self.rule_header_sets[self.header_ids[idx]]
+
+
 def contains_dotpath(filename):
     return any(segment for segment in filename.split('/') if segment.startswith('.'))
 
 
+def patterns_regex(patterns):
+    '''
+    Combines glob patterns into one regex matching the same paths as
+    `is_path_match`
+
+    >>> bool(re.match(patterns_regex(['*/Dockerfile', '/foo']), '/bar/Dockerfile'))
+    True
+
+    >>> bool(re.match(patterns_regex([]), '/bar/Dockerfile'))
+    False
+    '''
+    if not patterns:
+        return EMPTY_REGEX
+
+    return '|'.join(f'(?:{fnmatch.translate(pattern)})' for pattern in patterns)
+
+
+def literal_prefix(pattern):
+    '''
+    Returns the part of a glob pattern before its first wildcard and whether
+    the pattern has a wildcard at all
+
+    >>> literal_prefix('/.well-known/security.txt')
+    ('/.well-known/security.txt', False)
+
+    >>> literal_prefix('/foo/*/bar')
+    ('/foo/', True)
+
+    >>> literal_prefix('*/.foo')
+    ('', True)
+    '''
+    match = re.search(r'[*?[]', pattern)
+    if match is None:
+        return pattern, False
+    return pattern[:match.start()], True
+
+
 def is_path_match(patterns, path_to_match):
     for pattern in patterns:
         if fnmatch.fnmatch(prepend_slash(path_to_match), pattern):
@@ -1,40 +1,321 @@
 import grp
+import json
 import os
 import pwd
+import queue
 import shlex
+import signal
 import subprocess  # nosec
+import threading
+
+from functools import lru_cache
+from time import perf_counter
+
+from .output_filter import OutputFilter, DEFAULT_MAX_LINES
 
 NVM_PATH = '~/.nvm/nvm.sh'
 RVM_PATH = '/usr/local/rvm/scripts/rvm'
 
+# The most bytes read from the output of a command at once
+CHUNK_SIZE = 64 * 1024
+
+# Variables set by bash itself, or by the build, rather than by the toolchains
+SHELL_VARS = ['PWD', 'OLDPWD', 'SHLVL', '_', 'HOME']
+
+# Toolchain environments by (node, ruby, cwd), see `toolchain_env`
+TOOLCHAIN_ENVS = {}
+TOOLCHAIN_ENVS_LOCK = threading.Lock()
+
+# The resource usage of every command run during the build, see `usage_record`
+USAGE_RECORDS = []
+USAGE_RECORDS_LOCK = threading.Lock()
+
+# The commands being run, and whether they were stopped, see `stop_commands`
+RUNNING_PROCESSES = set()
+RUNNING_PROCESSES_LOCK = threading.Lock()
+STOPPED = threading.Event()
+
+
+@lru_cache(maxsize=None)
+def customer_ids():
+    '''The group and user ids commands are run with'''
+    return grp.getgrnam('rvm').gr_gid, pwd.getpwnam('customer').pw_uid
+
 
 def setuser():
-    os.setgid(grp.getgrnam('rvm').gr_gid)
-    os.setuid(pwd.getpwnam('customer').pw_uid)
+    # This runs in the child process between fork and exec, where looking up
+    # the ids is not safe while other threads of the build are running, so
+    # they are looked up beforehand
+    gid, uid = customer_ids()
+    os.setgid(gid)
+    os.setuid(uid)
+
+    # the command and its child processes can then be stopped together, see
+    # `stop_commands`
+    os.setpgid(0, 0)
 
 
-def run(logger, command, cwd=None, env=None, shell=False, check=False, node=False, ruby=False):
+def decode_line(line):
     '''
-    Run an OS command with provided cwd or env, stream logs to logger, and return the exit code.
+    Decodes a line of command output, replacing invalid bytes
 
-    Errors that occur BEFORE the command is actually executed are caught and handled here.
+    >>> decode_line(b'  caf\\xc3\\xa9\\r')
+    'café'
 
-    Errors encountered by the executed command are NOT caught. Instead a non-zero exit code
-    will be returned to be handled by the caller.
+    >>> decode_line(b'bad \\xff byte') == 'bad \\N{REPLACEMENT CHARACTER} byte'
+    True
+    '''
+    return line.decode('utf-8', errors='replace').strip()
 
-    See https://docs.python.org/3/library/subprocess.html#popen-constructor for details.
+
+def read_lines(stream, lines, chunk_size=CHUNK_SIZE):
     '''
+    Reads `stream` in chunks until EOF and puts the complete lines of each
+    chunk on the `lines` queue as a list, followed by None once the stream is
+    exhausted.
+
+    This keeps the pipe of a command drained regardless of how long it takes
+    to log its output, so the command never blocks on a full pipe.
+    '''
+    pending = b''
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+
+            *complete, pending = (pending + chunk).split(b'\n')
+            if complete:
+                lines.put([decode_line(line) for line in complete])
+
+        if pending:
+            lines.put([decode_line(pending)])
+    finally:
+        lines.put(None)
+
+
+def exit_code(status):
+    '''
+    Converts a wait status to an exit code the same way as `Popen.returncode`
+
+    >>> exit_code(0)
+    0
 
+    >>> exit_code(2 << 8)
+    2
+
+    >>> exit_code(9)
+    -9
+    '''
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait(process):
+    '''
+    Waits for the process to exit, sets its return code, and returns its
+    resource usage, or None if the process was already waited for
+    '''
+    if process.returncode is not None:
+        return None
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = exit_code(status)
+    return rusage
+
+
+def program_name(command):
+    '''
+    The program run by a command, which is recorded instead of the command
+    itself since commands may contain credentials
+
+    >>> program_name('git clone https://token@github.com/owner/repo')
+    'git'
+
+    >>> program_name(['/tmp/work/hugo', '--source', '.'])
+    'hugo'
+    '''
+    args = command.split() if isinstance(command, str) else command
+    return os.path.basename(args[0]) if args else ''
+
+
+def usage_record(step, program, returncode, wall_seconds, rusage):
+    return {
+        'step': step,
+        'program': program,
+        'returncode': returncode,
+        'wall_seconds': round(wall_seconds, 3),
+        'user_seconds': round(rusage.ru_utime, 3),
+        'system_seconds': round(rusage.ru_stime, 3),
+        'max_rss_kb': rusage.ru_maxrss,
+        'block_input': rusage.ru_inblock,
+        'block_output': rusage.ru_oublock,
+        'voluntary_switches': rusage.ru_nvcsw,
+        'involuntary_switches': rusage.ru_nivcsw,
+    }
+
+
+def format_usage(record):
+    '''
+    >>> format_usage({
+    ...     'program': 'npm', 'wall_seconds': 12.34, 'user_seconds': 9.5,
+    ...     'system_seconds': 1.25, 'max_rss_kb': 524288, 'block_input': 0,
+    ...     'block_output': 2048, 'voluntary_switches': 100, 'involuntary_switches': 20
+    ... })
+    'npm used 12.3s wall, 9.5s user, 1.2s sys, 512.0 MiB max RSS, 0/2048 blocks in/out, 100/20 voluntary/involuntary context switches'
+    '''  # noqa: E501
+    return (
+        f'{record["program"]} used {record["wall_seconds"]:.1f}s wall, '
+        f'{record["user_seconds"]:.1f}s user, {record["system_seconds"]:.1f}s sys, '
+        f'{record["max_rss_kb"] / 1024:.1f} MiB max RSS, '
+        f'{record["block_input"]}/{record["block_output"]} blocks in/out, '
+        f'{record["voluntary_switches"]}/{record["involuntary_switches"]} '
+        'voluntary/involuntary context switches'
+    )
+
+
+def usage_records():
+    '''The resource usage records of the commands run so far'''
+    with USAGE_RECORDS_LOCK:
+        return list(USAGE_RECORDS)
+
+
+def write_usage_records(filename):
+    with open(filename, 'w') as usage_file:
+        json.dump(usage_records(), usage_file, indent=2, default=str)
+
+
+def source_toolchains(command, node=False, ruby=False):
+    '''
+    Prefixes a bash command with the commands that load the toolchains
+
+    >>> source_toolchains('bundle install', ruby=True)
+    'source /usr/local/rvm/scripts/rvm && bundle install'
+
+    >>> source_toolchains('npm ci', node=True)
+    'source ~/.nvm/nvm.sh && nvm use default && npm ci'
+    '''
     # TODO - refactor to put the appropriate bundler binaries in PATH so this isn't necessary
     if ruby:
         command = f'source {RVM_PATH} && {command}'
-        shell = True
 
     # TODO - refactor to put the appropriate node/npm binaries in PATH so this isn't necessary
     if node:
         command = f'source {NVM_PATH} && nvm use default && {command}'
+
+    return command
+
+
+def toolchain_env(cwd=None, node=False, ruby=False):
+    '''
+    Returns the environment variables set by loading the toolchains, ie
+    `PATH`, `NVM_BIN`, or `GEM_HOME`.
+
+    Loading nvm and rvm takes seconds, so the environment is captured once
+    and reused for every command run with the same toolchains and cwd until
+    `clear_toolchain_envs` is called.
+    '''
+    key = (node, ruby, str(cwd) if cwd else None)
+
+    with TOOLCHAIN_ENVS_LOCK:
+        if key not in TOOLCHAIN_ENVS:
+            customer_ids()
+
+            command = '{ ' + source_toolchains('true', node, ruby) + '; } > /dev/null && env -0'
+
+            output = subprocess.run(  # nosec
+                command,
+                cwd=cwd,
+                env={},
+                shell=True,
+                executable='/bin/bash',
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+                preexec_fn=setuser
+            ).stdout
+
+            env = dict(
+                entry.split('=', 1)
+                for entry in output.decode('utf-8', errors='replace').split('\0')
+                if '=' in entry
+            )
+            for name in SHELL_VARS:
+                env.pop(name, None)
+
+            TOOLCHAIN_ENVS[key] = env
+
+        return TOOLCHAIN_ENVS[key]
+
+
+def clear_toolchain_envs():
+    with TOOLCHAIN_ENVS_LOCK:
+        TOOLCHAIN_ENVS.clear()
+
+
+def stop_commands():
+    '''
+    Kills the commands being run, along with their child processes, and
+    keeps any more commands from being run since the build is ending
+    '''
+    with RUNNING_PROCESSES_LOCK:
+        STOPPED.set()
+        for process in RUNNING_PROCESSES:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def run(logger, command, cwd=None, env=None, shell=False, check=False, node=False, ruby=False,
+        max_lines=DEFAULT_MAX_LINES):
+    '''
+    Run an OS command with provided cwd or env, stream logs to logger, and return the exit code.
+
+    Errors that occur BEFORE the command is actually executed are caught and handled here.
+
+    Errors encountered by the executed command are NOT caught. Instead a non-zero exit code
+    will be returned to be handled by the caller.
+
+    See https://docs.python.org/3/library/subprocess.html#popen-constructor for details.
+
+    The output is filtered before it is logged, see `OutputFilter`, so at most
+    `max_lines` lines are logged for the command. Its resource usage is logged
+    once it exits and recorded, see `usage_records`. Once `stop_commands` is
+    called, the command is not run and 1 is returned.
+
+    With `node` or `ruby`, the command is run with the environment of those
+    toolchains. Unless `shell` is set, it is executed directly with the
+    captured environment of the toolchains, see `toolchain_env`. Shell
+    commands are run after loading the toolchains instead, since they may use
+    the `nvm` and `rvm` shell functions, and may change the toolchains so the
+    captured environments are cleared afterwards.
+    '''
+    program = program_name(command)
+    sources_toolchains = False
+
+    if (node or ruby) and not shell:
+        try:
+            env = {**(os.environ if env is None else env), **toolchain_env(cwd, node, ruby)}
+        except (subprocess.CalledProcessError, OSError) as err:
+            logger.warning(f'Unable to capture the toolchain environment: {err}')
+            sources_toolchains = True
+    elif node or ruby:
+        sources_toolchains = True
+
+    if sources_toolchains:
+        command = source_toolchains(command, node, ruby)
         shell = True
 
+    try:
+        return _run(logger, command, cwd, env, shell, check, max_lines, program)
+    finally:
+        if sources_toolchains:
+            clear_toolchain_envs()
+
+
+def _run(logger, command, cwd, env, shell, check, max_lines, program):
     if isinstance(command, str) and not shell:
         command = shlex.split(command)
 
@@ -42,23 +323,55 @@ def run(logger, command, cwd=None, env=None, shell=False, check=False, node=Fals
     executable = '/bin/bash' if shell else None
 
     try:
-        p = subprocess.Popen(  # nosec
-            command,
-            cwd=cwd,
-            env=env,
-            shell=shell,
-            executable=executable,
-            stderr=subprocess.STDOUT,
-            stdout=subprocess.PIPE,
-            bufsize=1,
-            encoding='utf-8',
-            text=True,
-            preexec_fn=setuser
-        )
-        while p.poll() is None:
-            logger.info(p.stdout.readline().strip())
-
-        logger.info(p.stdout.readline().strip())
+        customer_ids()
+
+        with RUNNING_PROCESSES_LOCK:
+            if STOPPED.is_set():
+                logger.error(f'The build is stopping, `{program}` was not run.')
+                if check:
+                    raise subprocess.CalledProcessError(1, command)
+                return 1
+
+            start = perf_counter()
+
+            p = subprocess.Popen(  # nosec
+                command,
+                cwd=cwd,
+                env=env,
+                shell=shell,
+                executable=executable,
+                stderr=subprocess.STDOUT,
+                stdout=subprocess.PIPE,
+                bufsize=0,
+                preexec_fn=setuser
+            )
+            RUNNING_PROCESSES.add(p)
+
+        lines = queue.Queue()
+        reader = threading.Thread(target=read_lines, args=(p.stdout, lines), daemon=True)
+        reader.start()
+
+        output_filter = OutputFilter(max_lines)
+        for batch in iter(lines.get, None):
+            for line in output_filter.filter(batch):
+                logger.info(line)
+
+        for line in output_filter.close():
+            logger.info(line)
+
+        try:
+            rusage = wait(p)
+        finally:
+            with RUNNING_PROCESSES_LOCK:
+                RUNNING_PROCESSES.discard(p)
+
+        if rusage is not None:
+            record = usage_record(getattr(logger, 'name', None), program,
+                                  p.returncode, perf_counter() - start, rusage)
+            logger.info(format_usage(record))
+
+            with USAGE_RECORDS_LOCK:
+                USAGE_RECORDS.append(record)
 
         if check and p.returncode:
             raise subprocess.CalledProcessError(p.returncode, command)
@@ -0,0 +1,120 @@
+'''
+Reduces the output of commands to what is worth logging
+'''
+
+import re
+
+from collections import deque
+
+# The most lines logged for a single command, half of them from its start and
+# half from its end
+DEFAULT_MAX_LINES = 10000
+
+# CSI sequences (colors, cursor movement, erasing), OSC sequences (titles,
+# links), and the remaining two character escapes
+ANSI_ESCAPES = re.compile(
+    r'\x1b\[[0-?]*[ -/]*[@-~]'
+    r'|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)'
+    r'|\x1b[@-Z\\-_]'
+)
+
+
+def clean_line(line):
+    '''
+    Strips ANSI escapes and collapses carriage return overwrites, ie from
+    progress bars, to the text that would remain on the terminal
+
+    >>> clean_line('\\x1b[32m✔\\x1b[0m done')
+    '✔ done'
+
+    >>> clean_line('[=   ] 10%\\r[==  ] 50%\\r[====] 100%\\r')
+    '[====] 100%'
+
+    >>> clean_line('\\x1b[2K\\r\\x1b[1G')
+    ''
+    '''
+    line = ANSI_ESCAPES.sub('', line)
+
+    if '\r' in line:
+        overwrites = [part for part in line.split('\r') if part.strip()]
+        line = overwrites[-1] if overwrites else ''
+
+    return line.strip()
+
+
+class OutputFilter():
+    '''
+    Filters the lines of output of a command:
+        - ANSI escapes and carriage return overwrites are cleaned up
+        - empty lines are dropped
+        - consecutive identical lines are logged once, followed by how many
+          times they were repeated
+        - at most `max_lines` lines are logged, the first half as they are
+          received and the last half once the command is done, with a note of
+          how many lines were omitted in between
+
+    >>> output_filter = OutputFilter(max_lines=4)
+    >>> output_filter.filter(['one', 'two', 'two', 'two', 'three', 'four', 'five', 'six'])
+    ['one', 'two']
+    >>> output_filter.close()
+    ['... 3 lines omitted ...', 'five', 'six']
+    '''
+
+    def __init__(self, max_lines=DEFAULT_MAX_LINES):
+        self.head_lines = max_lines - max_lines // 2
+        self.tail = deque(maxlen=max_lines // 2)
+        self.logged = 0
+        self.omitted = 0
+
+        self.previous = None
+        self.repeated = 0
+
+    def filter(self, lines):
+        '''Returns the lines to log now out of `lines`'''
+        output = []
+
+        for line in lines:
+            line = clean_line(line)
+            if not line:
+                continue
+
+            if line == self.previous:
+                self.repeated += 1
+                continue
+
+            self._flush_repeated(output)
+            self.previous = line
+            self._add(line, output)
+
+        return output
+
+    def close(self):
+        '''Returns the remaining lines to log once the command is done'''
+        output = []
+        self._flush_repeated(output)
+
+        if self.omitted:
+            output.append(f'... {self.omitted} lines omitted ...')
+
+        output.extend(self.tail)
+        self.tail.clear()
+        return output
+
+    def _flush_repeated(self, output):
+        if self.repeated:
+            self._add(f'(repeated {self.repeated} times)', output)
+            self.repeated = 0
+
+    def _add(self, line, output):
+        if self.logged < self.head_lines:
+            self.logged += 1
+            output.append(line)
+            return
+
+        if self.tail.maxlen == 0:
+            self.omitted += 1
+            return
+
+        if len(self.tail) == self.tail.maxlen:
+            self.omitted += 1
+        self.tail.append(line)
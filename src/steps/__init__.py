@@ -6,6 +6,8 @@ from .build import (
 from .exceptions import StepException
 from .fetch import fetch_repo, update_repo, fetch_commit_sha
 from .publish import publish
+from .repo_cache import RepoCache
+from .scheduler import Step, run_steps
 
 __all__ = [
     'build_hugo',
@@ -14,10 +16,13 @@ __all__ = [
     'download_hugo',
     'fetch_repo',
     'publish',
+    'RepoCache',
     'run_build_script',
+    'run_steps',
     'setup_bundler',
     'setup_node',
     'setup_ruby',
+    'Step',
     'StepException',
     'update_repo',
     'fetch_commit_sha',
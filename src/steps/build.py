@@ -1,12 +1,14 @@
 import json
 import os
 import shutil
+from itertools import zip_longest
 from os import path
 from pathlib import Path
 import re
 import requests
 import shlex
 from subprocess import CalledProcessError  # nosec
+import tarfile
 import time
 import yaml
 
@@ -20,6 +22,7 @@ NVMRC = '.nvmrc'
 PACKAGE_JSON = 'package.json'
 RUBY_VERSION = '.ruby-version'
 GEMFILE = 'Gemfile'
+GEMFILE_LOCK = 'Gemfile.lock'
 JEKYLL_CONFIG_YML = '_config.yml'
 BUNDLER_VERSION = '.bundler-version'
 
@@ -94,23 +97,70 @@ def has_build_script(script_name):
     return False
 
 
+# A version string accepted by `Gem::Version`
+GEM_VERSION_REGEX = r'^\s*[0-9]+(\.[0-9a-zA-Z]+)*(-[0-9A-Za-z-]+(\.[0-9A-Za-z-]+)*)?\s*$'
+
+
+def gem_version_segments(version):
+    '''
+    Splits a version into the segments `Gem::Version` compares, a prerelease
+    like '-rc1' is equivalent to '.pre.rc1'
+
+    >>> gem_version_segments('2.7.0.preview1')
+    [2, 7, 0, 'preview', 1]
+
+    >>> gem_version_segments('3.1.0-rc1')
+    [3, 1, 0, 'pre', 'rc', 1]
+    '''
+    version = version.strip().replace('-', '.pre.')
+    return [
+        int(segment) if segment.isdigit() else segment
+        for segment in re.findall(r'[0-9]+|[a-zA-Z]+', version)
+    ]
+
+
+def compare_gem_versions(a, b):
+    '''
+    Compares versions like `Gem::Version#<=>`, returning -1, 0, or 1.
+    Missing segments count as 0 and prerelease segments sort first.
+
+    >>> compare_gem_versions('2.7', '2.7.0')
+    0
+
+    >>> compare_gem_versions('2.10.1', '2.9')
+    1
+
+    >>> compare_gem_versions('3.0.0.preview1', '3.0.0')
+    -1
+    '''
+    for x, y in zip_longest(gem_version_segments(a), gem_version_segments(b), fillvalue=0):
+        if x == y:
+            continue
+        if isinstance(x, str) != isinstance(y, str):
+            return -1 if isinstance(x, str) else 1
+        return -1 if x < y else 1
+    return 0
+
+
 def is_supported_ruby_version(version):
     '''
     Checks if the version defined in .ruby-version is supported
+
+    Versions that cannot be compared are left to rvm to install.
     '''
     is_supported = 0
 
     if version:
         logger = get_logger('setup-ruby')
 
-        RUBY_VERSION_MIN = os.getenv('RUBY_VERSION_MIN')
+        RUBY_VERSION_MIN = os.getenv('RUBY_VERSION_MIN') or '0'
 
-        is_supported = run(
-            logger,
-            f'ruby -e "exit Gem::Version.new(\'{shlex.split(version)[0]}\') >= Gem::Version.new(\'{RUBY_VERSION_MIN}\') ? 1 : 0"',  # noqa: E501
-            cwd=CLONE_DIR_PATH,
-            env={},
-            ruby=True
+        version_to_check = shlex.split(version)[0]
+
+        is_supported = int(
+            not re.match(GEM_VERSION_REGEX, version_to_check) or
+            not re.match(GEM_VERSION_REGEX, RUBY_VERSION_MIN) or
+            compare_gem_versions(version_to_check, RUBY_VERSION_MIN) >= 0
         )
 
         upgrade_msg = 'Please upgrade to an actively supported version, see https://www.ruby-lang.org/en/downloads/branches/ for details.'  # noqa: E501
@@ -137,8 +187,8 @@ def setup_node():
     '''
     logger = get_logger('setup-node')
 
-    def runp(cmd):
-        return run(logger, cmd, cwd=CLONE_DIR_PATH, env={}, check=True, node=True)
+    def runp(cmd, shell=False):
+        return run(logger, cmd, cwd=CLONE_DIR_PATH, env={}, shell=shell, check=True, node=True)
 
     try:
         NVMRC_PATH = CLONE_DIR_PATH / NVMRC
@@ -163,17 +213,18 @@ def setup_node():
                     echo "Please upgrade to LTS major version 16 or 18, see https://nodejs.org/en/about/releases/ for details."
                     exit 1
                 fi
-            """)  # noqa: E501
+            """, shell=True)  # noqa: E501
         else:
             # output node and npm versions if the defaults are used
             logger.info('Using default node version')
-            runp('nvm alias default $(nvm version)')
-            runp('echo Node version: $(node --version)')
-            runp('echo NPM version: $(npm --version)')
+            runp('nvm alias default $(nvm version)'
+                 ' && echo Node version: $(node --version)'
+                 ' && echo NPM version: $(npm --version)', shell=True)
 
         PACKAGE_JSON_PATH = CLONE_DIR_PATH / PACKAGE_JSON
         if PACKAGE_JSON_PATH.is_file():
             logger.info('Installing dependencies in package.json')
+            # also keeps audits off for the npm commands of the build script
             runp('npm set audit false')
             runp('npm ci')
 
@@ -238,8 +289,7 @@ def download_hugo():
                     hugo_tar.write(chunk)
 
             HUGO_BIN_PATH = WORKING_DIR_PATH / HUGO_BIN
-            run(logger, f'tar -xzf {hugo_tar_path} -C {WORKING_DIR_PATH}', env={}, check=True)
-            run(logger, f'chmod +x {HUGO_BIN_PATH}', env={}, check=True)
+            extract_hugo(hugo_tar_path, HUGO_BIN_PATH)
             return 0
         except Exception:
             failed_attempts += 1
@@ -251,6 +301,20 @@ def download_hugo():
             time.sleep(2)  # try again in 2 seconds
 
 
+def extract_hugo(hugo_tar_path, hugo_bin_path):
+    '''
+    Extracts the hugo binary from the release archive and makes it executable
+    '''
+    with tarfile.open(hugo_tar_path, 'r:gz') as hugo_tar:
+        # only the binary is needed, which also avoids writing any other
+        # member of the archive outside of the working directory
+        member = hugo_tar.getmember(HUGO_BIN)
+        with hugo_tar.extractfile(member) as src, open(hugo_bin_path, 'wb') as dest:
+            shutil.copyfileobj(src, dest)
+
+    os.chmod(hugo_bin_path, 0o755)  # nosec
+
+
 def build_hugo(branch, owner, repository, site_prefix,
                base_url='', user_env_vars=[]):
     '''
@@ -260,7 +324,8 @@ def build_hugo(branch, owner, repository, site_prefix,
 
     HUGO_BIN_PATH = WORKING_DIR_PATH / HUGO_BIN
 
-    run(logger, f'echo hugo version: $({HUGO_BIN_PATH} version)', env={}, check=True)
+    # hugo outputs its own version
+    run(logger, f'{HUGO_BIN_PATH} version', env={}, check=True)
 
     logger.info('Building site with hugo')
 
@@ -280,8 +345,8 @@ def setup_ruby():
 
     logger = get_logger('setup-ruby')
 
-    def runp(cmd):
-        return run(logger, cmd, cwd=CLONE_DIR_PATH, env={}, ruby=True)
+    def runp(cmd, shell=False):
+        return run(logger, cmd, cwd=CLONE_DIR_PATH, env={}, shell=shell, ruby=True)
 
     returncode = 0
 
@@ -294,14 +359,15 @@ def setup_ruby():
             # in the .ruby-version file
             ruby_version = shlex.quote(ruby_version)
         if is_supported_ruby_version(ruby_version):
-            returncode = runp(f'rvm install {ruby_version}')
+            returncode = runp(f'rvm install {ruby_version}', shell=True)
         else:
             returncode = 1
 
     if returncode:
         return returncode
 
-    return runp('echo Ruby version: $(ruby -v)')
+    # ruby outputs its own version
+    return runp('ruby -v')
 
 
 def setup_bundler():
@@ -371,6 +437,23 @@ def update_jekyll_config(federalist_config={}, custom_config_path=''):
     return 0
 
 
+def locked_gem_version(gemfile_lock_path, gem):
+    '''
+    Returns the version of `gem` in the Gemfile.lock, or None
+    '''
+    if not gemfile_lock_path.is_file():
+        return None
+
+    with gemfile_lock_path.open() as gemfile_lock:
+        for line in gemfile_lock:
+            # top level specs are indented by 4 spaces, their dependencies by 6
+            match = re.match(rf'^    {re.escape(gem)} \(([^)]+)\)$', line.rstrip())
+            if match:
+                return match.group(1)
+
+    return None
+
+
 def build_jekyll(branch, owner, repository, site_prefix,
                  base_url='', config='', user_env_vars=[]):
     '''
@@ -392,14 +475,12 @@ def build_jekyll(branch, owner, repository, site_prefix,
     if GEMFILE_PATH.is_file():
         jekyll_cmd = f'bundle exec {jekyll_cmd}'
 
-    run(
-        logger,
-        f'echo Building using Jekyll version: $({jekyll_cmd} -v)',
-        cwd=CLONE_DIR_PATH,
-        env={},
-        check=True,
-        ruby=True
-    )
+    jekyll_version = locked_gem_version(CLONE_DIR_PATH / GEMFILE_LOCK, 'jekyll')
+    if jekyll_version:
+        logger.info(f'Building using Jekyll version: {jekyll_version}')
+    else:
+        # jekyll outputs its own version
+        run(logger, f'{jekyll_cmd} -v', cwd=CLONE_DIR_PATH, env={}, check=True, ruby=True)
 
     env = build_env(branch, owner, repository, site_prefix, base_url, user_env_vars)
     env['JEKYLL_ENV'] = 'production'
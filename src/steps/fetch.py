@@ -1,8 +1,9 @@
 '''
 Fetch tasks and helpers
 '''
+import os
 import shlex
-import subprocess  # nosec
+import shutil
 
 from log_utils import get_logger
 from runner import run
@@ -29,21 +30,40 @@ def fetch_url(owner, repository, access_token=''):  # nosec
     return f'https://{repo_url}'
 
 
-def fetch_repo(owner, repository, branch, github_token=''):  # nosec
+def fetch_repo(owner, repository, branch, github_token='', repo_cache=None):  # nosec
     '''
     Clones the GitHub repository specified by owner and repository
     into CLONE_DIR_PATH.
+
+    With a `repo_cache`, the repository is cloned from its cached mirror,
+    see `RepoCache`, and from GitHub if that fails.
     '''
     logger = get_logger('clone')
 
-    owner = shlex.quote(owner)
-    repository = shlex.quote(repository)
-    branch = shlex.quote(branch)
-
     clone_env = {
         'HOME': '/home'
     }
 
+    if repo_cache is not None:
+        try:
+            returncode = repo_cache.clone(
+                logger, branch, fetch_url(owner, repository, github_token), CLONE_DIR_PATH,
+                env=clone_env
+            )
+        except OSError as err:
+            logger.warning(f'Unable to use the repository cache: {err}')
+            returncode = None
+
+        if returncode == 0:
+            return returncode
+
+        logger.warning('Unable to clone from the repository cache, cloning from GitHub')
+        shutil.rmtree(CLONE_DIR_PATH, ignore_errors=True)
+
+    owner = shlex.quote(owner)
+    repository = shlex.quote(repository)
+    branch = shlex.quote(branch)
+
     command = (
         f'git clone -b {branch} --single-branch --depth 1 '
         f'{fetch_url(owner, repository, github_token)} '
@@ -53,14 +73,30 @@ def fetch_repo(owner, repository, branch, github_token=''):  # nosec
     return run(logger, command, env=clone_env)
 
 
-def update_repo(clone_dir):
+def update_repo(clone_dir, repo_cache=None):
     '''
     Updates the repo with the full git history
+
+    With a `repo_cache`, the history is fetched from the cached mirror of
+    the repository, and from GitHub if that fails.
     '''
     logger = get_logger('update')
 
     logger.info('Fetching full git history')
 
+    if repo_cache is not None:
+        try:
+            returncode = repo_cache.unshallow(logger, clone_dir)
+        except OSError as err:
+            logger.warning(f'Unable to use the repository cache: {err}')
+            returncode = None
+
+        if returncode == 0:
+            return returncode
+
+        logger.warning('Unable to fetch the history from the repository cache, '
+                       'fetching it from GitHub')
+
     command = 'git pull --unshallow'
 
     return run(logger, command, cwd=clone_dir)
@@ -73,18 +109,48 @@ def fetch_commit_sha(clone_dir):
     try:
         logger = get_logger('clone')
         logger.info('Fetching commit details ...')
-        command = shlex.split('git log -1')  # get last commit only
-        process = subprocess.run(  # nosec
-            command,
-            shell=False,
-            check=True,
-            stdout=subprocess.PIPE,
-            universal_newlines=True,
-            cwd=clone_dir
-        )
-        commit_log = process.stdout
-        commit_sha = commit_log.split()[1]
+        commit_sha = read_head_sha(git_dir(clone_dir))
         logger.info(f'commit {commit_sha}')
         return commit_sha
     except Exception:
         raise StepException('There was a problem fetching the commit hash for this build')
+
+
+def git_dir(clone_dir):
+    '''
+    The git directory of the clone, `.git` may also be a file pointing to it
+    '''
+    dot_git = os.path.join(clone_dir, '.git')
+    if os.path.isfile(dot_git):
+        with open(dot_git) as dot_git_file:
+            gitdir = dot_git_file.read().strip()
+        return os.path.join(clone_dir, gitdir[len('gitdir:'):].strip())
+    return dot_git
+
+
+def read_head_sha(git_dir):
+    '''
+    Resolves HEAD by reading the git directory instead of running `git`
+    '''
+    with open(os.path.join(git_dir, 'HEAD')) as head_file:
+        head = head_file.read().strip()
+
+    if not head.startswith('ref:'):
+        # a detached HEAD is the commit itself
+        return head
+
+    ref = head[len('ref:'):].strip()
+
+    ref_path = os.path.join(git_dir, ref)
+    if os.path.isfile(ref_path):
+        with open(ref_path) as ref_file:
+            return ref_file.read().strip()
+
+    # refs are packed once the repository is gc'ed, as `<sha> <ref>` lines
+    with open(os.path.join(git_dir, 'packed-refs')) as packed_refs:
+        for line in packed_refs:
+            parts = line.split()
+            if len(parts) == 2 and parts[1] == ref:
+                return parts[0]
+
+    raise ValueError(f'Unable to resolve {ref}')
@@ -12,9 +12,14 @@ from common import SITE_BUILD_DIR_PATH
 
 def publish(base_url, site_prefix, bucket, federalist_config,
             aws_region, aws_access_key_id, aws_secret_access_key,
-            dry_run=False):
+            dry_run=False, defer_deletes=False, redirect_map=False,
+            metrics_file=None, progress=None):
     '''
     Publish the built site to S3.
+
+    Returns the `PublishMetrics` of the publish, which are also written as
+    JSON to `metrics_file` if it is provided. `progress` is called as files
+    are uploaded, see `publish_to_s3`.
     '''
     logger = get_logger('publish')
 
@@ -29,15 +34,24 @@ def publish(base_url, site_prefix, bucket, federalist_config,
         region_name=aws_region
     )
 
-    s3publisher.publish_to_s3(
+    metrics = s3publisher.publish_to_s3(
         directory=str(SITE_BUILD_DIR_PATH),
         base_url=base_url,
         site_prefix=site_prefix,
         bucket=bucket,
         federalist_config=federalist_config,
         s3_client=s3_client,
-        dry_run=dry_run
+        dry_run=dry_run,
+        defer_deletes=defer_deletes,
+        redirect_map=redirect_map,
+        progress=progress
     )
 
     delta_string = delta_to_mins_secs(datetime.now() - start_time)
     logger.info(f'Total time to publish: {delta_string}')
+    logger.info(f'Publish metrics: {metrics.summary()}')
+
+    if metrics_file:
+        metrics.write_json(metrics_file)
+
+    return metrics
@@ -0,0 +1,212 @@
+'''
+A cache of bare mirrors of the site repositories, kept across builds
+'''
+
+import fcntl
+import os
+import shutil
+import subprocess  # nosec
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from runner import customer_ids, run
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3  # 10 GiB
+
+
+@contextmanager
+def locked(lock_path, shared=False, blocking=True):
+    '''
+    Holds an exclusive, or `shared`, lock of `lock_path`, raises
+    `BlockingIOError` if it is held by another process and not `blocking`
+    '''
+    with open(lock_path, 'a') as lock_file:
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        fcntl.flock(lock_file, flags)
+        yield lock_file
+
+
+def dir_size(path):
+    '''The total size of the files in `path`, in bytes'''
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def chown_tree(path, uid, gid):
+    '''Changes the owner of `path` and everything in it'''
+    os.chown(path, uid, gid, follow_symlinks=False)
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            os.chown(os.path.join(dirpath, name), uid, gid, follow_symlinks=False)
+
+
+def git(logger, args, cwd=None):
+    '''
+    Runs `git` with `args` as the user running the build, unlike `run`, and
+    logs its output
+    '''
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    result = subprocess.run(  # nosec
+        ['git'] + args, cwd=cwd, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
+    )
+    for line in result.stdout.splitlines():
+        logger.info(line)
+    return result.returncode
+
+
+class RepoCache():
+    '''
+    Keeps a bare mirror of the `owner/repository` GitHub repository in
+    `cache_dir`, usually on a persistent volume, to clone from.
+
+    Only the built branches, and the tags, are mirrored, and the mirror is
+    updated with an incremental fetch before each clone. Builds hold an
+    exclusive lock of the mirror while updating it, and a shared one while
+    cloning from it, so concurrent builds of a repository update it in turn.
+    Once the cache holds more than `max_bytes`, the least recently used
+    mirrors which are not in use are removed.
+
+    The mirrors are only accessible to the user running the build, since
+    the build commands of one site must not read or change the repository
+    of another. Clones are handed over to the customer user before checking
+    out any file.
+    '''
+
+    def __init__(self, cache_dir, owner, repository, max_bytes=DEFAULT_MAX_BYTES):
+        for name in [owner, repository]:
+            if not name or name in ['.', '..'] or '/' in name:
+                raise ValueError(f'Invalid repository name: {owner}/{repository}')
+
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+        # GitHub names are case insensitive
+        self.mirror_path = self.cache_dir / owner.lower() / f'{repository.lower()}.git'
+        self.lock_path = self.mirror_path.with_name(self.mirror_path.name + '.lock')
+
+    def clone(self, logger, branch, url, clone_dir, env=None):
+        '''
+        Updates the mirror from `url`, then makes a shallow clone of `branch`
+        into `clone_dir`, with `url` as its origin. Returns the exit code of
+        the first git command to fail, or 0.
+        '''
+        self.cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.mirror_path.parent.mkdir(exist_ok=True)
+
+        with locked(self.lock_path) as lock_file:
+            logger.info('Updating the cached mirror of the repository')
+
+            if not (self.mirror_path / 'HEAD').is_file():
+                returncode = git(logger, ['init', '--bare', '-q', str(self.mirror_path)])
+                if returncode != 0:
+                    return returncode
+
+            returncode = git(logger, [
+                'fetch', '--force', '--prune', url,
+                f'+refs/heads/{branch}:refs/heads/{branch}', '+refs/tags/*:refs/tags/*'
+            ], cwd=self.mirror_path)
+            if returncode != 0:
+                return returncode
+
+            # other builds of the repository can clone, but not update it,
+            # while this one does
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            os.utime(self.lock_path)
+
+            returncode = git(logger, [
+                'clone', '-q', '--no-checkout', '--depth', '1', '--single-branch',
+                '-b', branch, self.mirror_url(), str(clone_dir)
+            ])
+            if returncode != 0:
+                return returncode
+
+        returncode = git(logger, ['remote', 'set-url', 'origin', url], cwd=clone_dir)
+        if returncode != 0:
+            return returncode
+
+        gid, uid = customer_ids()
+        chown_tree(clone_dir, uid, gid)
+
+        # the files are checked out by the customer user, as when cloning
+        # from GitHub
+        returncode = run(logger, 'git reset -q --hard', cwd=clone_dir, env=env)
+
+        self.evict(logger)
+
+        return returncode
+
+    def unshallow(self, logger, clone_dir):
+        '''
+        Fetches the full history of the branch checked out in `clone_dir`
+        from the mirror. Returns the exit code of git, or 1 if there is no
+        mirror to fetch from.
+        '''
+        with open(Path(clone_dir) / '.git' / 'HEAD') as head_file:
+            head = head_file.read().strip()
+
+        if not head.startswith('ref:') or not (self.mirror_path / 'HEAD').is_file():
+            return 1
+        ref = head[len('ref:'):].strip()
+
+        with locked(self.lock_path, shared=True):
+            os.utime(self.lock_path)
+            returncode = git(logger, [
+                # the clone belongs to the customer user
+                '-c', 'safe.directory=*',
+                'fetch', '-q', '--unshallow', '--tags', self.mirror_url(), ref
+            ], cwd=clone_dir)
+
+        gid, uid = customer_ids()
+        chown_tree(Path(clone_dir) / '.git', uid, gid)
+
+        return returncode
+
+    def evict(self, logger):
+        '''
+        Removes the least recently used mirrors, other than this one, until
+        the cache holds at most `max_bytes`. Mirrors in use are skipped.
+        Returns the paths of the removed mirrors.
+        '''
+        mirrors = []
+        for lock_path in self.cache_dir.glob('*/*.git.lock'):
+            mirror_path = lock_path.with_suffix('')
+            if mirror_path.is_dir():
+                mirrors.append(
+                    (lock_path.stat().st_mtime, mirror_path, lock_path, dir_size(mirror_path))
+                )
+
+        total = sum(size for _, _, _, size in mirrors)
+
+        evicted = []
+        for _, mirror_path, lock_path, size in sorted(mirrors):
+            if total <= self.max_bytes:
+                break
+
+            if mirror_path == self.mirror_path:
+                continue
+
+            try:
+                # the lock file is kept, a build may be waiting for it
+                with locked(lock_path, blocking=False):
+                    shutil.rmtree(mirror_path)
+            except BlockingIOError:
+                continue
+
+            logger.info(f'Removed the cached mirror {mirror_path} ({size} bytes)')
+            evicted.append(mirror_path)
+            total -= size
+
+        return evicted
+
+    def mirror_url(self):
+        return f'file://{self.mirror_path}'
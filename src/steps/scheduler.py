@@ -0,0 +1,106 @@
+'''
+Runs build steps concurrently, following their dependencies
+'''
+
+import queue
+import threading
+
+from runner import stop_commands
+
+from .exceptions import StepException
+
+# How often the main thread wakes up while waiting for steps, so that signals,
+# ie the build timeout, are handled promptly
+POLL_SECONDS = 1
+
+
+class Step():
+    '''
+    A build step, `func` returns a return code and a non-zero return code
+    fails the build with `error_message`.
+
+    The step only starts once the steps named in `requires` have succeeded.
+    '''
+
+    def __init__(self, name, func, error_message, requires=[]):
+        self.name = name
+        self.func = func
+        self.error_message = error_message
+        self.requires = list(requires)
+
+
+def run_steps(steps, on_running=None):
+    '''
+    Runs every step once the steps it requires have succeeded, running the
+    steps that do not depend on each other concurrently on daemon threads.
+    Each step logs with its own logger, so its output remains attributed to
+    it.
+
+    `on_running` is called with the sorted names of the running steps
+    whenever they change.
+
+    As soon as a step fails, no more steps are started and a StepException
+    is raised with its error message, like for a step run on its own. An
+    exception raised by a step is raised again here. The commands of the
+    steps still running are then stopped, see `stop_commands`, as they are
+    when the build times out while waiting for the steps.
+    '''
+    names = set(step.name for step in steps)
+    for step in steps:
+        unknown = [name for name in step.requires if name not in names]
+        if unknown:
+            raise ValueError(f'Step {step.name} requires unknown steps: {", ".join(unknown)}')
+
+    results = queue.Queue()
+    pending = list(steps)
+    succeeded = set()
+    running = set()
+
+    def target(step):
+        try:
+            results.put((step, step.func(), None))
+        except BaseException as err:  # pylint: disable=W0703
+            results.put((step, None, err))
+
+    try:
+        while pending or running:
+            ready = [step for step in pending if all(name in succeeded for name in step.requires)]
+
+            for step in ready:
+                pending.remove(step)
+                threading.Thread(
+                    target=target, args=(step,), name=f'step-{step.name}', daemon=True
+                ).start()
+                running.add(step.name)
+
+            if not running:
+                raise ValueError(
+                    f'Steps have circular requirements: {", ".join(s.name for s in pending)}'
+                )
+
+            if ready and on_running:
+                on_running(sorted(running))
+
+            step, returncode, err = _next_result(results)
+            running.remove(step.name)
+
+            if err is not None:
+                raise err
+
+            if returncode != 0:
+                raise StepException(step.error_message)
+
+            succeeded.add(step.name)
+    except BaseException:
+        # the other steps would keep changing the clone while the build ends
+        if running:
+            stop_commands()
+        raise
+
+
+def _next_result(results):
+    while True:
+        try:
+            return results.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            pass
@@ -0,0 +1,31 @@
+'''
+Prints the log of a build as it is written, for builds run with
+`DB_LOG_NOTIFY=true`
+
+The database URL is read from the `DATABASE_URL` environment variable.
+'''
+
+import argparse
+import os
+
+import psycopg2
+
+from log_utils.tail import tail_build_log
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Follow the log of a build')
+    parser.add_argument('build_id', type=int,
+                        help='The id of the build')
+    parser.add_argument('--idle-timeout', dest='idle_timeout', type=float,
+                        help='Stop once no lines were written for this many seconds')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        for line in tail_build_log(conn, args.build_id, args.idle_timeout):
+            print(line, flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from publishing.asset_cache import AssetCache
+
+ETAG = '"abc123"'
+BODY = b'<html>not found</html>'
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(self.server.status)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = HTTPServer(('127.0.0.1', 0), RequestHandler)
+    server.requests = []
+    server.status = 200
+    server.delay = 0
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def _url(server):
+    return f'http://127.0.0.1:{server.server_port}/assets/404.html'
+
+
+def test_it_caches_the_asset(tmpdir, server):
+    cache = AssetCache(tmpdir)
+
+    assert cache.get(_url(server)) == BODY
+    assert cache.get(_url(server)) == BODY
+
+    # the second request is served from the cache
+    assert len(server.requests) == 1
+    assert os.path.isfile(tmpdir.join('404.html'))
+
+
+def test_it_revalidates_after_the_ttl(tmpdir, server):
+    cache = AssetCache(tmpdir, ttl=0)
+
+    assert cache.get(_url(server)) == BODY
+    assert cache.get(_url(server)) == BODY
+
+    assert len(server.requests) == 2
+    assert server.requests[1]['If-None-Match'] == ETAG
+
+
+def test_it_revalidates_a_seeded_copy_by_mtime(tmpdir, server):
+    tmpdir.join('404.html').write_binary(BODY)
+    os.utime(tmpdir.join('404.html'), (0, 0))
+
+    cache = AssetCache(tmpdir)
+
+    assert cache.get(_url(server)) == BODY
+
+    assert server.requests[0]['If-Modified-Since'] == 'Thu, 01 Jan 1970 00:00:00 GMT'
+    assert 'If-None-Match' not in server.requests[0]
+
+
+def test_it_falls_back_to_the_cached_copy(tmpdir, server):
+    cache = AssetCache(tmpdir, ttl=0, timeout=0.2)
+
+    assert cache.get(_url(server)) == BODY
+
+    server.status = 500
+    tmpdir.join('404.html.json').remove()
+    assert cache.get(_url(server)) == BODY
+
+    server.delay = 1
+    assert cache.get(_url(server)) == BODY
+
+
+def test_it_raises_without_a_cached_copy(tmpdir, server):
+    cache = AssetCache(tmpdir)
+
+    server.status = 404
+
+    with pytest.raises(RuntimeError, match='Unable to fetch'):
+        cache.get(_url(server))
+
+    assert not os.path.isfile(tmpdir.join('404.html'))
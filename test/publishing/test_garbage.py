@@ -0,0 +1,152 @@
+import json
+from unittest.mock import patch
+
+import boto3
+import pytest
+
+from moto import mock_s3
+
+from publishing import garbage
+from publishing.garbage import (
+    collect_garbage, load_manifest, manifest_key, record_stale_objects)
+from publishing.models import SiteObject
+
+TEST_BUCKET = 'test-bucket'
+TEST_REGION = 'test-region'
+TEST_ACCESS_KEY = 'fake-access-key'
+TEST_SECRET_KEY = 'fake-secret-key'
+SITE_PREFIX = 'site/owner/repo'
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', TEST_ACCESS_KEY)
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', TEST_SECRET_KEY)
+
+    with mock_s3():
+        conn = boto3.resource('s3', region_name=TEST_REGION)
+
+        conn.create_bucket(
+            Bucket=TEST_BUCKET,
+            CreateBucketConfiguration={"LocationConstraint": "test-bucket"}
+        )
+
+        s3_client = boto3.client(
+            service_name='s3',
+            region_name=TEST_REGION,
+            aws_access_key_id=TEST_ACCESS_KEY,
+            aws_secret_access_key=TEST_SECRET_KEY,
+        )
+
+        yield s3_client
+
+
+def _put(s3_client, filename, body):
+    key = f'{SITE_PREFIX}/{filename}'
+    s3_client.put_object(Key=key, Body=body, Bucket=TEST_BUCKET)
+    etag = s3_client.head_object(Key=key, Bucket=TEST_BUCKET)['ETag'].replace('"', '')
+    return SiteObject(filename=filename, md5=etag, site_prefix=SITE_PREFIX)
+
+
+def _keys(s3_client):
+    results = s3_client.list_objects_v2(Bucket=TEST_BUCKET)
+    return [r['Key'] for r in results.get('Contents', [])]
+
+
+def test_record_stale_objects_merges_manifest(s3_client):
+    a = _put(s3_client, 'a.html', 'a')
+    b = _put(s3_client, 'b.html', 'b')
+
+    assert record_stale_objects(TEST_BUCKET, SITE_PREFIX, [a], set(), s3_client) == 1
+    assert record_stale_objects(TEST_BUCKET, SITE_PREFIX, [b], set(), s3_client) == 2
+
+    manifest, _ = load_manifest(TEST_BUCKET, manifest_key(SITE_PREFIX), s3_client)
+    assert manifest['site_prefix'] == SITE_PREFIX
+    assert sorted(manifest['objects']) == [a.s3_key, b.s3_key]
+
+    # `a` is published again, so it must no longer be pending
+    assert record_stale_objects(TEST_BUCKET, SITE_PREFIX, [], {a.s3_key}, s3_client) == 1
+
+    manifest, _ = load_manifest(TEST_BUCKET, manifest_key(SITE_PREFIX), s3_client)
+    assert list(manifest['objects']) == [b.s3_key]
+
+    # an empty manifest is removed
+    assert record_stale_objects(TEST_BUCKET, SITE_PREFIX, [], {b.s3_key}, s3_client) == 0
+    assert manifest_key(SITE_PREFIX) not in _keys(s3_client)
+
+
+def test_record_stale_objects_keeps_the_recorded_time(s3_client):
+    a = _put(s3_client, 'a.html', 'a')
+    b = _put(s3_client, 'b.html', 'b')
+
+    record_stale_objects(TEST_BUCKET, SITE_PREFIX, [a, b], set(), s3_client)
+    manifest, etag = load_manifest(TEST_BUCKET, manifest_key(SITE_PREFIX), s3_client)
+
+    # still stale, the manifest is not rewritten
+    record_stale_objects(TEST_BUCKET, SITE_PREFIX, [a, b], set(), s3_client)
+    assert load_manifest(TEST_BUCKET, manifest_key(SITE_PREFIX), s3_client) == (manifest, etag)
+
+    # stale again with other contents, it is recorded again
+    b_changed = _put(s3_client, 'b.html', 'changed')
+    record_stale_objects(TEST_BUCKET, SITE_PREFIX, [a, b_changed], set(), s3_client)
+
+    updated, _ = load_manifest(TEST_BUCKET, manifest_key(SITE_PREFIX), s3_client)
+    assert updated['objects'][a.s3_key] == manifest['objects'][a.s3_key]
+    assert updated['objects'][b.s3_key]['md5'] == b_changed.md5
+
+
+def test_collect_garbage(s3_client):
+    stale = [_put(s3_client, f'stale-{i}.html', f'{i}') for i in range(3)]
+    _put(s3_client, 'index.html', 'index')
+
+    record_stale_objects(TEST_BUCKET, SITE_PREFIX, stale, set(), s3_client)
+
+    stats = collect_garbage(TEST_BUCKET, s3_client, dry_run=True)
+    assert stats == {'deleted': 0, 'skipped': 0}
+    assert len(_keys(s3_client)) == 5
+
+    stats = collect_garbage(TEST_BUCKET, s3_client)
+    assert stats == {'deleted': 3, 'skipped': 0}
+    assert _keys(s3_client) == [f'{SITE_PREFIX}/index.html']
+
+
+def test_collect_garbage_skips_republished_keys(s3_client):
+    changed = _put(s3_client, 'changed.html', 'old content')
+    recorded_later = _put(s3_client, 'recorded-later.html', 'content')
+
+    record_stale_objects(TEST_BUCKET, SITE_PREFIX, [changed, recorded_later], set(), s3_client)
+
+    # republished with different content after it was recorded
+    _put(s3_client, 'changed.html', 'new content')
+
+    # republished after it was recorded, with the same content
+    key = manifest_key(SITE_PREFIX)
+    manifest, _ = load_manifest(TEST_BUCKET, key, s3_client)
+    manifest['objects'][recorded_later.s3_key]['recorded_at'] = '2000-01-01T00:00:00+00:00'
+    s3_client.put_object(Key=key, Body=json.dumps(manifest), Bucket=TEST_BUCKET)
+
+    stats = collect_garbage(TEST_BUCKET, s3_client, site_prefix=SITE_PREFIX)
+
+    assert stats == {'deleted': 0, 'skipped': 2}
+    assert sorted(_keys(s3_client)) == [changed.s3_key, recorded_later.s3_key]
+
+
+def test_collect_garbage_stops_when_the_manifest_changes(s3_client, monkeypatch):
+    stale = [_put(s3_client, f'stale-{i}.html', f'{i}') for i in range(3)]
+    record_stale_objects(TEST_BUCKET, SITE_PREFIX, stale, set(), s3_client)
+
+    monkeypatch.setattr(garbage, 'MAX_S3_KEYS_PER_DELETE', 1)
+    delete_objects = s3_client.delete_objects
+
+    def publish_during_deletes(**kwargs):
+        response = delete_objects(**kwargs)
+        # a publish records another stale object
+        other = _put(s3_client, 'other.html', 'other')
+        record_stale_objects(TEST_BUCKET, SITE_PREFIX, [other], set(), s3_client)
+        return response
+
+    with patch.object(s3_client, 'delete_objects', side_effect=publish_during_deletes):
+        stats = collect_garbage(TEST_BUCKET, s3_client, site_prefix=SITE_PREFIX)
+
+    assert stats['deleted'] == 1
+    assert manifest_key(SITE_PREFIX) in _keys(s3_client)
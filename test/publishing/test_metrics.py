@@ -0,0 +1,103 @@
+import json
+
+import boto3
+import pytest
+
+from botocore.config import Config
+from botocore.exceptions import EndpointConnectionError
+from moto import mock_s3
+
+from publishing.metrics import PublishMetrics, LATENCY_BUCKETS
+
+TEST_BUCKET = 'test-bucket'
+TEST_REGION = 'test-region'
+
+
+class TestPublishMetrics():
+    def test_phase(self):
+        metrics = PublishMetrics()
+
+        with metrics.phase('hash'):
+            pass
+        with metrics.phase('custom'):
+            pass
+
+        assert metrics.phases['hash'] > 0
+        assert metrics.phases['custom'] > 0
+        assert metrics.phases['upload'] == 0
+
+    def test_record_request(self):
+        metrics = PublishMetrics()
+
+        metrics.record_request('PutObject', 0.001)
+        metrics.record_request('PutObject', 0.3)
+        metrics.record_request('PutObject', 1000)
+
+        assert metrics.requests == {'PutObject': 3}
+
+        buckets = metrics.latencies['PutObject']
+        assert buckets[0] == 1
+        assert buckets[LATENCY_BUCKETS.index(0.5)] == 1
+        assert buckets[-1] == 1
+
+    def test_instrument(self, monkeypatch):
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'fake-access-key')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'fake-secret-key')
+
+        metrics = PublishMetrics()
+
+        with mock_s3():
+            s3_client = boto3.client(service_name='s3', region_name=TEST_REGION)
+            s3_client.create_bucket(
+                Bucket=TEST_BUCKET,
+                CreateBucketConfiguration={"LocationConstraint": TEST_REGION}
+            )
+
+            with metrics.instrument(s3_client):
+                s3_client.put_object(Key='a', Body='a', Bucket=TEST_BUCKET)
+                s3_client.put_object(Key='b', Body='b', Bucket=TEST_BUCKET)
+                s3_client.list_objects_v2(Bucket=TEST_BUCKET)
+
+            # requests after the block are not recorded
+            s3_client.list_objects_v2(Bucket=TEST_BUCKET)
+
+        assert metrics.requests == {'PutObject': 2, 'ListObjectsV2': 1}
+        assert sum(metrics.latencies['PutObject']) == 2
+        assert metrics.failed_requests == {}
+
+    def test_instrument_counts_failed_requests(self, monkeypatch):
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'fake-access-key')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'fake-secret-key')
+
+        metrics = PublishMetrics()
+
+        # nothing listens on port 9
+        s3_client = boto3.client(
+            service_name='s3', region_name=TEST_REGION, endpoint_url='http://127.0.0.1:9',
+            config=Config(retries={'max_attempts': 1, 'mode': 'standard'})
+        )
+
+        with metrics.instrument(s3_client):
+            with pytest.raises(EndpointConnectionError):
+                s3_client.put_object(Key='a', Body='a', Bucket=TEST_BUCKET)
+
+        # every attempt failed, the number of attempts depends on botocore
+        assert metrics.failed_requests['PutObject'] >= 1
+        assert metrics.requests == metrics.failed_requests
+        assert sum(metrics.latencies['PutObject']) == metrics.requests['PutObject']
+
+    def test_write_json(self, tmpdir):
+        metrics = PublishMetrics()
+        metrics.bytes_uploaded = 10
+        metrics.record_request('DeleteObject', 0.02)
+
+        filename = str(tmpdir.join('metrics.json'))
+        metrics.write_json(filename)
+
+        with open(filename) as metrics_file:
+            result = json.load(metrics_file)
+
+        assert result['bytes'] == {'read': 0, 'written': 0, 'uploaded': 10}
+        assert result['requests'] == {'DeleteObject': 1}
+        assert result['failed_requests'] == {}
+        assert set(result['phases']) == {'walk', 'compress', 'hash', 'list', 'upload', 'delete'}
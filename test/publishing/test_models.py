@@ -4,7 +4,7 @@ from unittest.mock import Mock
 
 import pytest
 
-from publishing.models import SiteObject, SiteFile, SiteRedirect
+from publishing.models import SiteObject, SiteFile, SiteRedirect, SiteRedirectMap
 
 
 class TestSiteObject():
@@ -203,3 +203,55 @@ class TestSiteRedirect():
             WebsiteRedirectLocation=expected_dest,
             CacheControl="max-age=60",
         )
+
+
+class TestSiteRedirectMap():
+    def _redirects(self, base_test_dir):
+        return [
+            SiteRedirect(
+                filename=str(dir),
+                dir_prefix=str(base_test_dir),
+                site_prefix='site-prefix',
+                base_url='/site/test',
+                cache_control='max-age=60'
+            )
+            for dir in [base_test_dir.mkdir('b'), base_test_dir, base_test_dir.mkdir('a')]
+        ]
+
+    def test_constructor_and_props(self, tmpdir):
+        base_test_dir = tmpdir.mkdir('boop')
+
+        model = SiteRedirectMap(
+            dir_prefix=str(base_test_dir),
+            site_prefix='site-prefix',
+            redirects=self._redirects(base_test_dir),
+            cache_control='max-age=60'
+        )
+
+        expected_body = '{"":"/site/test/","a":"/site/test/a/","b":"/site/test/b/"}'
+        assert model.body == expected_body
+        assert model.md5 == hashlib.md5(expected_body.encode()).hexdigest()
+        assert model.filename == f'{base_test_dir}/{SiteRedirectMap.FILENAME}'
+        assert model.s3_key == f'site-prefix/{SiteRedirectMap.FILENAME}'
+
+    def test_upload_to_s3(self, tmpdir):
+        base_test_dir = tmpdir.mkdir('boop')
+
+        model = SiteRedirectMap(
+            dir_prefix=str(base_test_dir),
+            site_prefix='site-prefix',
+            redirects=self._redirects(base_test_dir),
+            cache_control='max-age=60'
+        )
+
+        s3_client = Mock()
+        model.upload_to_s3('test-bucket', s3_client)
+
+        s3_client.put_object.assert_called_once_with(
+            Body=model.body,
+            Bucket='test-bucket',
+            Key=f'site-prefix/{SiteRedirectMap.FILENAME}',
+            ServerSideEncryption='AES256',
+            ContentType='application/json',
+            CacheControl='max-age=60',
+        )
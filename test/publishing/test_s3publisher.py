@@ -1,11 +1,17 @@
+import os
+
 import boto3
 import pytest
 import requests_mock
 
+from unittest.mock import patch
+
 from moto import mock_s3
 
-from publishing.s3publisher import list_remote_objects, publish_to_s3
-from publishing.models import SiteObject
+from publishing.garbage import load_manifest, manifest_key
+from publishing.s3publisher import (
+    list_remote_objects, publish_to_s3, resolve_cache_control, IMMUTABLE_CACHE_CONTROL)
+from publishing.models import SiteObject, SiteRedirectMap
 
 import repo_config
 
@@ -15,6 +21,11 @@ TEST_ACCESS_KEY = 'fake-access-key'
 TEST_SECRET_KEY = 'fake-secret-key'
 
 
+@pytest.fixture(autouse=True)
+def asset_cache_dir(monkeypatch, tmpdir):
+    monkeypatch.setattr('publishing.s3publisher.ASSET_CACHE_DIR', str(tmpdir.mkdir('cache')))
+
+
 @pytest.fixture
 def s3_client(monkeypatch):
     monkeypatch.setenv('AWS_ACCESS_KEY_ID', TEST_ACCESS_KEY)
@@ -66,6 +77,37 @@ def test_list_remote_objects(monkeypatch, s3_client):
     assert len(results) == 11  # 10 keys from the loop, 1 from previous put
 
 
+def test_resolve_cache_control():
+    federalist_config = repo_config.from_object(
+        {
+            'headers': [
+                {'/configured/*': {'cache-control': 'no-cache'}},
+                {'/*.css': {'x-frame-options': 'DENY'}}
+            ]
+        },
+        {
+            'headers': {
+                'cache-control': 'max-age=60'
+            }
+        }
+    )
+
+    cache_control_checks = [
+        ('/main.js',                     'max-age=60'),
+        ('/main.3f9a2c1b.js',            IMMUTABLE_CACHE_CONTROL),
+        ('/main.3f9a2c1b.css',           IMMUTABLE_CACHE_CONTROL),
+        ('/index.3f9a2c1b.html',         'max-age=60'),
+        ('/configured/main.3f9a2c1b.js', 'no-cache'),
+    ]
+    classification = federalist_config.classify_paths(
+        [filename for filename, _ in cache_control_checks]
+    )
+    for idx, (filename, expected) in enumerate(cache_control_checks):
+        assert resolve_cache_control(
+            classification.rule_headers(idx), classification.headers(idx), filename
+        ) == expected
+
+
 def _make_fake_files(dir, filenames):
     for f_name in filenames:
         file = dir.join(f_name)
@@ -128,7 +170,13 @@ def test_publish_to_s3(tmpdir, s3_client):
                '404-pages-client.html'),
               text='default 404 page')
 
-        publish_to_s3(**publish_kwargs)
+        metrics = publish_to_s3(**publish_kwargs)
+
+        assert metrics.requests['ListObjectsV2'] == 1
+        assert metrics.requests['PutObject'] == 6
+        assert metrics.bytes_uploaded > 0
+        assert metrics.bytes_written > 0
+        assert metrics.phases['compress'] > 0
 
         results = s3_client.list_objects_v2(Bucket=TEST_BUCKET)
 
@@ -217,3 +265,150 @@ def test_publish_to_s3(tmpdir, s3_client):
         publish_to_s3(**publish_kwargs)
         results = s3_client.list_objects_v2(Bucket=TEST_BUCKET)
         assert results['KeyCount'] == 6
+
+
+def test_publish_to_s3_prunes_excluded_directories(tmpdir, s3_client):
+    test_dir = tmpdir.mkdir('test_dir')
+    test_dir.mkdir('.git')
+    test_dir.mkdir('node_modules')
+    _make_fake_files(test_dir, ['index.html', '.git/HEAD', 'node_modules/index.js'])
+
+    federalist_config = repo_config.from_object(
+        {'excludePaths': ['/node_modules/*']},
+        {'headers': {'cache-control': 'max-age=60'}}
+    )
+
+    walked = []
+
+    def walk(directory):
+        for root, dirs, filenames in os.walk(directory):
+            walked.append(os.path.relpath(root, str(test_dir)))
+            yield root, dirs, filenames
+
+    with requests_mock.mock() as m, patch('publishing.s3publisher.walk', side_effect=walk):
+        m.get(requests_mock.ANY, text='default 404 page')
+
+        publish_to_s3(str(test_dir), '/base_url', 'test_dir', TEST_BUCKET,
+                      federalist_config, s3_client)
+
+    assert walked == ['.']
+
+    results = s3_client.list_objects_v2(Bucket=TEST_BUCKET)
+    keys = [r['Key'] for r in results['Contents']]
+    assert sorted(keys) == ['test_dir', 'test_dir/404.html', 'test_dir/index.html']
+
+
+def test_publish_to_s3_reports_progress(tmpdir, s3_client):
+    test_dir = tmpdir.mkdir('test_dir')
+    _make_fake_files(test_dir, ['index.html', 'boop.txt', '404.html'])
+
+    federalist_config = repo_config.from_object({}, {'headers': {'cache-control': 'max-age=60'}})
+
+    progress = []
+    publish_to_s3(str(test_dir), '/base_url', 'test_dir', TEST_BUCKET,
+                  federalist_config, s3_client, progress=lambda **counts: progress.append(counts))
+
+    # 3 files and the redirect object
+    assert [counts['files_done'] for counts in progress] == [0, 1, 2, 3, 4]
+    assert all(counts['files_total'] == 4 for counts in progress)
+
+    bytes_total = progress[0]['bytes_total']
+    assert bytes_total > 0
+    assert progress[0]['bytes_done'] == 0
+    assert progress[-1]['bytes_done'] == bytes_total
+
+
+def test_publish_to_s3_defer_deletes(tmpdir, s3_client):
+    test_dir = tmpdir.mkdir('test_dir')
+    site_prefix = 'test_dir'
+
+    _make_fake_files(test_dir, ['index.html', 'boop.txt', '404.html'])
+
+    publish_kwargs = {
+        'directory': str(test_dir),
+        'base_url': '/base_url',
+        'site_prefix': site_prefix,
+        'bucket': TEST_BUCKET,
+        'federalist_config': repo_config.from_object(
+            {}, {'headers': {'cache-control': 'max-age=60'}}
+        ),
+        's3_client': s3_client,
+        'defer_deletes': True,
+    }
+
+    publish_to_s3(**publish_kwargs)
+
+    test_dir.join('boop.txt').remove()
+    metrics = publish_to_s3(**publish_kwargs)
+
+    # the deletion is recorded in the manifest, not made
+    assert 'DeleteObject' not in metrics.requests
+    # the root redirect object and the manifest
+    assert metrics.requests['PutObject'] == 2
+
+    results = s3_client.list_objects_v2(Bucket=TEST_BUCKET)
+    keys = [r['Key'] for r in results['Contents']]
+
+    # the stale file is still there, but recorded for deletion
+    assert f'{site_prefix}/boop.txt' in keys
+    assert manifest_key(site_prefix) in keys
+
+    manifest, _ = load_manifest(TEST_BUCKET, manifest_key(site_prefix), s3_client)
+    assert list(manifest['objects']) == [f'{site_prefix}/boop.txt']
+
+    # publishing the file again removes it from the manifest
+    _make_fake_files(test_dir, ['boop.txt'])
+    publish_to_s3(**publish_kwargs)
+
+    results = s3_client.list_objects_v2(Bucket=TEST_BUCKET)
+    keys = [r['Key'] for r in results['Contents']]
+    assert manifest_key(site_prefix) not in keys
+
+
+def test_publish_to_s3_redirect_map(tmpdir, s3_client):
+    test_dir = tmpdir.mkdir('test_dir')
+    test_dir.mkdir('sub_dir')
+    site_prefix = 'test_dir'
+
+    _make_fake_files(test_dir, ['index.html', 'sub_dir/index.html', '404.html'])
+
+    publish_kwargs = {
+        'directory': str(test_dir),
+        'base_url': '/base_url',
+        'site_prefix': site_prefix,
+        'bucket': TEST_BUCKET,
+        'federalist_config': repo_config.from_object(
+            {}, {'headers': {'cache-control': 'max-age=60'}}
+        ),
+        's3_client': s3_client,
+        'redirect_map': True,
+    }
+
+    publish_to_s3(**publish_kwargs)
+
+    results = s3_client.list_objects_v2(Bucket=TEST_BUCKET)
+    keys = sorted(r['Key'] for r in results['Contents'])
+
+    # no redirect objects, just the map
+    assert keys == [
+        f'{site_prefix}/.redirect-map.json',
+        f'{site_prefix}/404.html',
+        f'{site_prefix}/index.html',
+        f'{site_prefix}/sub_dir/index.html',
+    ]
+
+    redirect_map = s3_client.get_object(
+        Bucket=TEST_BUCKET, Key=f'{site_prefix}/.redirect-map.json')
+    assert redirect_map['Body'].read() == (
+        b'{"":"/base_url/","sub_dir":"/base_url/sub_dir/"}'
+    )
+
+    # the unchanged map is not uploaded again
+    with patch.object(SiteRedirectMap, 'upload_to_s3') as mock_upload:
+        publish_to_s3(**publish_kwargs)
+        mock_upload.assert_not_called()
+
+        test_dir.mkdir('new_dir')
+        _make_fake_files(test_dir, ['new_dir/index.html'])
+        publish_to_s3(**publish_kwargs)
+        mock_upload.assert_called_once()
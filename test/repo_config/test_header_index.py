@@ -0,0 +1,78 @@
+import pytest
+
+from repo_config.header_index import HeaderRuleIndex
+from repo_config.repo_config import match_path
+
+PATTERNS = [
+    '/', '/hello', '/hello/world', '/*', '/hello/*', '/*.html', '/bar/*.html',
+    '/bar/*.map', '/:hello', '/:hello/world', '/hello/*/foo', '/:hello/world/*',
+    '/hi/:hello/world/*', ':hello/world/*',
+]
+
+PATHS = [
+    '/', '/hello', '/hello/world', '/world', '/hello.js', '/foo.html',
+    '/bar/foo.html', '/bar/baz/foo.js', '/bar/foo.js.map', '/booyah/world',
+    '/booyah/world/foo', '/hi/booyah/world/crazy', '/hi/booyah/nope',
+    'booyah/world', '/hello/',
+]
+
+
+@pytest.mark.parametrize('pattern', PATTERNS)
+def test_it_matches_like_match_path(pattern):
+    index = HeaderRuleIndex([{pattern: {'x-rule': pattern}}], {})
+
+    for path_to_match in PATHS:
+        expected = 0 if match_path(pattern, path_to_match) else None
+        assert index.find(path_to_match) == expected, path_to_match
+
+
+def test_it_preserves_first_match_order():
+    rules = [
+        {'/index.html':  {'cache-control': 'no-cache'}},
+        {'/:foo/*.html': {'cache-control': 'max-age=2000'}},
+        {'/*.html':      {'cache-control': 'max-age=4000'}},
+        {'/*':           {'cache-control': 'max-age=6000'}},
+        {'/foo/bar.html': {'cache-control': 'unreachable'}},
+    ]
+
+    index = HeaderRuleIndex(rules, {'cache-control': 'max-age=60'})
+
+    assert index.find('/index.html') == 0
+    assert index.find('/foo/bar.html') == 1
+    assert index.find('/foo.html') == 2
+    assert index.find('/bar.js') == 3
+
+    assert HeaderRuleIndex([], {}).find('/bar.js') is None
+
+
+def test_it_interns_immutable_headers():
+    rules = [
+        {'/a': {' Cache-Control ': ' no-cache '}},
+        {'/b': {'cache-control': 'no-cache'}},
+        {'/c': {'x-frame-options': 'DENY'}},
+    ]
+
+    index = HeaderRuleIndex(rules, {'cache-control': 'max-age=60'})
+
+    assert index.get_headers('/a') == {'cache-control': 'no-cache'}
+    assert index.get_headers('/a') is index.get_headers('/b')
+    assert index.get_headers('/c') == {'cache-control': 'max-age=60', 'x-frame-options': 'DENY'}
+    assert index.get_headers('/d') == {'cache-control': 'max-age=60'}
+
+    assert index.get_rule_headers('/c') == {'x-frame-options': 'DENY'}
+    assert index.get_rule_headers('/d') == {}
+
+    with pytest.raises(TypeError):
+        index.get_headers('/a')['cache-control'] = 'max-age=0'
+
+
+def test_find_many():
+    rules = [
+        {'/hello/world': {'x-rule': 'literal'}},
+        {'/:hello/world/*': {'x-rule': 'param'}},
+        {'/*.html': {'x-rule': 'html'}},
+    ]
+
+    index = HeaderRuleIndex(rules, {})
+
+    assert index.find_many(PATHS) == [index.find(path_to_match) for path_to_match in PATHS]
@@ -1,5 +1,7 @@
+import pytest
+
 from repo_config.repo_config import (RepoConfig, contains_dotpath, match_path,
-                                     find_first_matching_cfg)
+                                     find_first_matching_cfg, PATH_EXCLUDED, PATH_INCLUDED)
 
 
 def test_match_path():
@@ -145,6 +147,27 @@ def test_get_headers_for_path():
     assert value == defaults['headers']
 
 
+def test_get_rule_headers_for_path():
+    config = {
+        'headers': [
+            {'/index.html': {' Cache-Control ': ' no-cache '}},
+            {'/*.js':       {'x-frame-options': 'DENY'}}
+        ]
+    }
+
+    defaults = {
+        'headers': {
+            'cache-control': 'max-age=60'
+        }
+    }
+
+    repo_config = RepoConfig(config=config, defaults=defaults)
+
+    assert repo_config.get_rule_headers_for_path('/index.html') == {'cache-control': 'no-cache'}
+    assert repo_config.get_rule_headers_for_path('/foo.js') == {'x-frame-options': 'DENY'}
+    assert repo_config.get_rule_headers_for_path('/foo.css') == {}
+
+
 def test_exclude_paths_always_returns_a_list():
     repo_config = RepoConfig(config={}, defaults={})
     value = repo_config.exclude_paths()
@@ -294,6 +317,114 @@ def test_is_path_included_is_not_is_path_excluded():
     assert included_value is not excluded_value
 
 
+def test_classify():
+    repo_config = RepoConfig(config=test_config(), defaults=test_defaults())
+
+    checks = [
+        ('/index.html',                PATH_INCLUDED),
+        ('/.bar',                      PATH_EXCLUDED),
+        ('/foo/.bar/baz',              PATH_EXCLUDED),
+        ('/.well-known/security.txt',  PATH_INCLUDED),
+        ('/bar/.foo',                  PATH_INCLUDED),
+        ('/bar/Dockerfile',            PATH_EXCLUDED),
+        ('/foo/Dockerfile',            PATH_INCLUDED),
+        ('/excluded-folder/foo.txt',   PATH_EXCLUDED),
+        ('excluded-file',              PATH_EXCLUDED),
+    ]
+
+    for path, expected in checks:
+        assert repo_config.classify(path) == expected, path
+
+    repo_config = RepoConfig(config={}, defaults={})
+    assert repo_config.classify('/index.html') == PATH_INCLUDED
+    assert repo_config.classify('/.index.html') == PATH_EXCLUDED
+
+
+def test_classify_paths():
+    config = {
+        **test_config(),
+        'headers': [
+            {'/index.html': {'cache-control': 'no-cache'}},
+            {'/foo/*.html': {'cache-control': 'max-age=1000'}},
+        ]
+    }
+    defaults = {**test_defaults(), 'headers': {'cache-control': 'max-age=60'}}
+
+    repo_config = RepoConfig(config=config, defaults=defaults)
+
+    paths = [
+        '/index.html',
+        '/foo/index.html',
+        '/.bar',
+        '/.well-known/security.txt',
+        '/bar/Dockerfile',
+        '/excluded-folder/foo.txt',
+        '/foo/bar.html',
+        '/foo/baz.html',
+    ]
+
+    result = repo_config.classify_paths(paths)
+
+    assert len(result) == len(paths)
+
+    for idx, path in enumerate(paths):
+        assert result.included[idx] == repo_config.is_path_included(path), path
+        assert result.headers(idx) == repo_config.get_headers_for_path(path), path
+        assert result.rule_headers(idx) == repo_config.get_rule_headers_for_path(path), path
+
+    # paths with the same rule share a header set
+    assert result.header_ids[6] == result.header_ids[7]
+
+    assert RepoConfig().classify_paths([]).included == []
+
+
+@pytest.mark.parametrize('paths', [
+    ['/a/foo.README', '/a/README'],
+    ['/a/README', '/a/foo.README'],
+])
+def test_classify_paths_separates_literal_names_from_extensions(paths):
+    config = {
+        'headers': [
+            {'/a/README': {'cache-control': 'no-cache'}},
+            {'/a/*.README': {'cache-control': 'max-age=1000'}},
+        ]
+    }
+    repo_config = RepoConfig(config=config, defaults={'headers': {}})
+
+    result = repo_config.classify_paths(paths)
+
+    for idx, path in enumerate(paths):
+        assert result.headers(idx) == repo_config.get_headers_for_path(path), path
+
+
+def test_is_subtree_excluded():
+    repo_config = RepoConfig(
+        config={
+            'excludePaths': ['/node_modules/*', '/vendor/*'],
+            'includePaths': ['/.well-known/security.txt', '/vendor/*/LICENSE'],
+        },
+        defaults={}
+    )
+
+    checks = [
+        ('/node_modules',          True),
+        ('node_modules/foo',       True),
+        ('/.git',                  True),
+        ('/foo/.cache',            True),
+        ('/.well-known',           False),
+        ('/vendor',                False),
+        ('/node_modules_backup',   False),
+        ('/foo',                   False),
+    ]
+
+    for dir_path, expected in checks:
+        assert repo_config.is_subtree_excluded(dir_path) == expected, dir_path
+
+    # included files under a pruned directory are never skipped
+    repo_config = RepoConfig(config={'includePaths': ['*/.foo']}, defaults={})
+    assert repo_config.is_subtree_excluded('/.git') is False
+
+
 def test_contains_dotpath():
     value = contains_dotpath('/.foo')
     assert value is True
@@ -1,6 +1,7 @@
 import json
 import os
-from io import StringIO
+from io import BytesIO, StringIO
+import tarfile
 from unittest.mock import call, patch
 from subprocess import CalledProcessError  # nosec
 
@@ -15,7 +16,7 @@ from steps import (
     run_build_script, setup_bundler, setup_node, setup_ruby
 )
 from steps.build import (
-    build_env, is_supported_ruby_version, BUNDLER_VERSION, GEMFILE,
+    build_env, is_supported_ruby_version, BUNDLER_VERSION, GEMFILE, GEMFILE_LOCK,
     HUGO_BIN, HUGO_VERSION, JEKYLL_CONFIG_YML,
     NVMRC, PACKAGE_JSON, RUBY_VERSION
 )
@@ -77,12 +78,14 @@ class TestSetupNode():
             call('Installing dependencies in package.json')
         ])
 
-        def callp(cmd):
-            return call(mock_logger, cmd, cwd=patch_clone_dir, env={}, check=True, node=True)
+        def callp(cmd, shell=False):
+            return call(mock_logger, cmd, cwd=patch_clone_dir, env={}, shell=shell, check=True,
+                        node=True)
 
         mock_run.assert_has_calls([
-            callp('echo Node version: $(node --version)'),
-            callp('echo NPM version: $(npm --version)'),
+            callp('nvm alias default $(nvm version)'
+                  ' && echo Node version: $(node --version)'
+                  ' && echo NPM version: $(npm --version)', shell=True),
             callp('npm set audit false'),
             callp('npm ci'),
         ])
@@ -238,9 +241,10 @@ class TestSetupRuby():
 
         mock_run.assert_called_once_with(
             mock_logger,
-            'echo Ruby version: $(ruby -v)',
+            'ruby -v',
             cwd=patch_clone_dir,
             env={},
+            shell=False,
             ruby=True
         )
 
@@ -265,12 +269,12 @@ class TestSetupRuby():
 
         mock_logger = mock_get_logger.return_value
 
-        def callp(cmd):
-            return call(mock_logger, cmd, cwd=patch_clone_dir, env={}, ruby=True)
+        def callp(cmd, shell=False):
+            return call(mock_logger, cmd, cwd=patch_clone_dir, env={}, shell=shell, ruby=True)
 
         mock_run.assert_has_calls([
-            callp(f'rvm install {version}'),
-            callp('echo Ruby version: $(ruby -v)')
+            callp(f'rvm install {version}', shell=True),
+            callp('ruby -v')
         ])
 
     def test_it_strips_and_quotes_ruby_version(self,
@@ -294,16 +298,16 @@ class TestSetupRuby():
 
         mock_logger = mock_get_logger.return_value
 
-        def callp(cmd):
-            return call(mock_logger, cmd, cwd=patch_clone_dir, env={}, ruby=True)
+        def callp(cmd, shell=False):
+            return call(mock_logger, cmd, cwd=patch_clone_dir, env={}, shell=shell, ruby=True)
 
         mock_logger.info.assert_has_calls([
             call('Using ruby version in .ruby-version'),
         ])
 
         mock_run.assert_has_calls([
-            callp("rvm install '$2.3'"),
-            callp('echo Ruby version: $(ruby -v)'),
+            callp("rvm install '$2.3'", shell=True),
+            callp('ruby -v'),
         ])
 
     def test_it_returns_error_code_when_rvm_install_fails(self,
@@ -332,7 +336,7 @@ class TestSetupRuby():
         ])
 
         mock_run.assert_called_once_with(
-            mock_logger, 'rvm install 2.3', cwd=patch_clone_dir, env={}, ruby=True
+            mock_logger, 'rvm install 2.3', cwd=patch_clone_dir, env={}, shell=True, ruby=True
         )
 
     def test_it_outputs_warning_if_eol_approaching(self,
@@ -342,8 +346,6 @@ class TestSetupRuby():
 
         min_ruby_version = os.getenv('RUBY_VERSION_MIN')
 
-        mock_run.return_value = 1
-
         result = is_supported_ruby_version(min_ruby_version)
 
         assert result == 1
@@ -358,11 +360,10 @@ class TestSetupRuby():
 
     def test_it_outputs_warning_if_not_supported(self,
                                                  mock_is_supported_ruby_version,
-                                                 mock_get_logger, mock_run):
+                                                 mock_get_logger, mock_run,
+                                                 patch_ruby_min_version):
         version = '2.3'
 
-        mock_run.return_value = 0
-
         result = is_supported_ruby_version(version)
 
         assert result == 0
@@ -375,6 +376,21 @@ class TestSetupRuby():
         ])
 
 
+@pytest.mark.parametrize('version, expected', [
+    ('2.6.6', 1),
+    ('2.7', 1),
+    ('3.0.0.preview1', 1),
+    ('2.6.5', 0),
+    ('2.6.6.rc1', 0),
+    ('1.9', 0),
+    # left to rvm
+    ('ruby-2.3', 1),
+    ("'$2.3'", 1),
+])
+def test_is_supported_ruby_version(version, expected, patch_ruby_min_version):
+    assert is_supported_ruby_version(version) == expected
+
+
 @patch('steps.build.run')
 @patch('steps.build.get_logger')
 class TestSetupBundler():
@@ -487,7 +503,7 @@ class TestBuildJekyll():
         mock_run.assert_has_calls([
             call(
                 mock_logger,
-                f'echo Building using Jekyll version: $({command} -v)',
+                f'{command} -v',
                 cwd=patch_clone_dir,
                 env={},
                 check=True,
@@ -532,7 +548,7 @@ class TestBuildJekyll():
         mock_run.assert_has_calls([
             call(
                 mock_logger,
-                f'echo Building using Jekyll version: $({command} -v)',
+                f'{command} -v',
                 cwd=patch_clone_dir,
                 env={},
                 check=True,
@@ -548,6 +564,27 @@ class TestBuildJekyll():
             )
         ])
 
+    def test_with_gemfile_lock(self, mock_get_logger, mock_run, patch_clone_dir,
+                               patch_site_build_dir):
+        create_file(patch_clone_dir / GEMFILE, 'foo')
+        create_file(patch_clone_dir / GEMFILE_LOCK, '\n'.join([
+            'GEM',
+            '  remote: https://rubygems.org/',
+            '  specs:',
+            '    jekyll (4.3.2)',
+            '      jekyll-sass-converter (>= 2.0, < 4.0)',
+            '    jekyll-sass-converter (3.0.0)',
+        ]))
+        create_file(patch_clone_dir / JEKYLL_CONFIG_YML, 'hi: test')
+
+        build_jekyll('branch', 'owner', 'repo', 'site/prefix', '/site/prefix')
+
+        mock_logger = mock_get_logger.return_value
+        mock_logger.info.assert_any_call('Building using Jekyll version: 4.3.2')
+
+        # only the build itself is run
+        assert mock_run.call_count == 1
+
     def test_config_file_is_updated(self, mock_get_logger, mock_run, patch_clone_dir,
                                     patch_site_build_dir):
         conf_path = patch_clone_dir / JEKYLL_CONFIG_YML
@@ -568,13 +605,22 @@ class TestBuildJekyll():
             assert config['branch'] == kwargs['branch']
 
 
+def hugo_tar():
+    '''A release archive of a fake hugo binary'''
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, data in [('LICENSE', b'license'), (HUGO_BIN, b'fake-hugo')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, BytesIO(data))
+    return buffer.getvalue()
+
+
 @patch('steps.build.run')
 @patch('steps.build.get_logger')
 class TestDownloadHugo():
     def test_it_is_callable(self, mock_get_logger, mock_run, patch_working_dir, patch_clone_dir):
         version = '0.44'
-        tar_cmd = f'tar -xzf {patch_working_dir}/hugo.tar.gz -C {patch_working_dir}'
-        chmod_cmd = f'chmod +x {patch_working_dir}/hugo'
         dl_url = (
             'https://github.com/gohugoio/hugo/releases/download/v'
             f'{version}/hugo_{version}_Linux-64bit.tar.gz'
@@ -583,7 +629,7 @@ class TestDownloadHugo():
         create_file(patch_clone_dir / HUGO_VERSION, version)
 
         with requests_mock.Mocker() as m:
-            m.get(dl_url, text='fake-data')
+            m.get(dl_url, content=hugo_tar())
             result = download_hugo()
 
         assert result == 0
@@ -598,16 +644,15 @@ class TestDownloadHugo():
             call(f'Downloading hugo version {version}')
         ])
 
-        mock_run.assert_has_calls([
-            call(mock_logger, tar_cmd, env={}, check=True),
-            call(mock_logger, chmod_cmd, env={}, check=True)
-        ])
+        hugo_bin = patch_working_dir / HUGO_BIN
+        assert hugo_bin.read_bytes() == b'fake-hugo'
+        assert os.access(hugo_bin, os.X_OK)
+        assert not (patch_working_dir / 'LICENSE').exists()
+        mock_run.assert_not_called()
 
     def test_it_is_callable_retry(self, mock_get_logger, mock_run, patch_working_dir,
                                   patch_clone_dir):
         version = '0.44'
-        tar_cmd = f'tar -xzf {patch_working_dir}/hugo.tar.gz -C {patch_working_dir}'
-        chmod_cmd = f'chmod +x {patch_working_dir}/hugo'
         dl_url = (
             'https://github.com/gohugoio/hugo/releases/download/v'
             f'{version}/hugo_{version}_Linux-64bit.tar.gz'
@@ -621,7 +666,7 @@ class TestDownloadHugo():
                 dict(exc=requests.exceptions.ConnectTimeout),
                 dict(exc=requests.exceptions.ConnectTimeout),
                 dict(exc=requests.exceptions.ConnectTimeout),
-                dict(text='fake-data')
+                dict(content=hugo_tar())
             ])
 
             result = download_hugo()
@@ -642,10 +687,11 @@ class TestDownloadHugo():
             call(f'Failed attempt #4 to download hugo version: {version}'),
         ])
 
-        mock_run.assert_has_calls([
-            call(mock_logger, tar_cmd, env={}, check=True),
-            call(mock_logger, chmod_cmd, env={}, check=True)
-        ])
+        hugo_bin = patch_working_dir / HUGO_BIN
+        assert hugo_bin.read_bytes() == b'fake-hugo'
+        assert os.access(hugo_bin, os.X_OK)
+        assert not (patch_working_dir / 'LICENSE').exists()
+        mock_run.assert_not_called()
 
     def test_it_is_exception(self, mock_get_logger, mock_run, patch_working_dir, patch_clone_dir):
         version = '0.44'
@@ -723,7 +769,7 @@ class TestBuildHugo():
         mock_run.assert_has_calls([
             call(
                 mock_logger,
-                f'echo hugo version: $({hugo_path} version)',
+                f'{hugo_path} version',
                 env={},
                 check=True
             ),
@@ -1,10 +1,12 @@
 import logging
+import os
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, call, patch
 import subprocess  # nosec
 import pytest
 
-from steps import fetch_repo, update_repo, fetch_commit_sha
+from steps import fetch_repo, update_repo, fetch_commit_sha, RepoCache, StepException
+from steps.repo_cache import locked
 from common import CLONE_DIR_PATH
 
 clone_env = {
@@ -46,6 +48,46 @@ class TestCloneRepo():
 
         mock_run.assert_called_once_with(mock_get_logger.return_value, command, env=clone_env)
 
+    def test_it_clones_from_the_repo_cache(self, mock_get_logger, mock_run):
+        repo_cache = Mock()
+        repo_cache.clone.return_value = 0
+
+        assert fetch_repo('owner-3', 'repo-3', 'main', 'ABC123', repo_cache) == 0
+
+        repo_cache.clone.assert_called_once_with(
+            mock_get_logger.return_value, 'main', 'https://ABC123@github.com/owner-3/repo-3.git',
+            CLONE_DIR_PATH, env=clone_env
+        )
+        mock_run.assert_not_called()
+
+    def test_it_falls_back_to_github(self, mock_get_logger, mock_run):
+        repo_cache = Mock()
+        repo_cache.clone.return_value = 128
+
+        fetch_repo('owner-3', 'repo-3', 'main', repo_cache=repo_cache)
+
+        mock_get_logger.return_value.warning.assert_called_once_with(
+            'Unable to clone from the repository cache, cloning from GitHub'
+        )
+        mock_run.assert_called_once()
+
+    def test_it_falls_back_to_github_when_the_cache_is_not_writable(
+            self, mock_get_logger, mock_run, tmp_path):
+        repo_cache = RepoCache(tmp_path / 'cache', 'owner-3', 'repo-3')
+
+        # the tests may run as root, which can write to any directory, so
+        # opening the lock file is made to fail instead
+        error = PermissionError(13, 'Permission denied')
+        with patch('steps.repo_cache.locked', side_effect=error) as mock_locked:
+            fetch_repo('owner-3', 'repo-3', 'main', repo_cache=repo_cache)
+
+        mock_get_logger.return_value.warning.assert_has_calls([
+            call("Unable to use the repository cache: [Errno 13] Permission denied"),
+            call('Unable to clone from the repository cache, cloning from GitHub'),
+        ])
+        mock_locked.assert_called_once_with(repo_cache.lock_path)
+        mock_run.assert_called_once()
+
 
 class TestCloneRepoNoMock(unittest.TestCase):
     @pytest.fixture(autouse=True)
@@ -78,24 +120,220 @@ class TestUpdateRepo():
 
         mock_run.assert_called_once_with(mock_get_logger.return_value, command, cwd=clone_dir)
 
+    def test_it_fetches_the_history_from_the_repo_cache(self, mock_get_logger, mock_run):
+        repo_cache = Mock()
+        repo_cache.unshallow.return_value = 0
+
+        assert update_repo('clone_dir', repo_cache) == 0
+
+        repo_cache.unshallow.assert_called_once_with(mock_get_logger.return_value, 'clone_dir')
+        mock_run.assert_not_called()
+
+    def test_it_falls_back_to_github(self, mock_get_logger, mock_run):
+        repo_cache = Mock()
+        repo_cache.unshallow.return_value = 1
+
+        update_repo('clone_dir', repo_cache)
+
+        mock_run.assert_called_once_with(
+            mock_get_logger.return_value, 'git pull --unshallow', cwd='clone_dir'
+        )
+
+    def test_it_falls_back_to_github_when_the_cache_fails(self, mock_get_logger, mock_run):
+        repo_cache = Mock()
+        repo_cache.unshallow.side_effect = PermissionError(13, 'Permission denied')
+
+        update_repo('clone_dir', repo_cache)
+
+        mock_run.assert_called_once_with(
+            mock_get_logger.return_value, 'git pull --unshallow', cwd='clone_dir'
+        )
+
+
+def git(*args, cwd=None):
+    return subprocess.run(  # nosec
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+        cwd=str(cwd) if cwd else None, check=True, stdout=subprocess.PIPE,
+        universal_newlines=True
+    ).stdout.strip()
+
+
+def commit(work_dir, name):
+    (work_dir / name).write_text(name)
+    git('add', name, cwd=work_dir)
+    git('commit', '-q', '-m', name, cwd=work_dir)
+    git('push', '-q', '--tags', 'origin', 'main', cwd=work_dir)
+    return git('rev-parse', 'HEAD', cwd=work_dir)
+
+
+@pytest.fixture
+def origin(tmp_path):
+    '''A local bare repository with 3 commits and a tag on `main`, and a clone to push from'''
+    url = str(tmp_path / 'origin.git')
+    work_dir = tmp_path / 'work'
+
+    git('init', '-q', '--bare', url)
+    git('init', '-q', '-b', 'main', str(work_dir))
+    git('remote', 'add', 'origin', url, cwd=work_dir)
+    for name in ['one', 'two']:
+        commit(work_dir, name)
+    git('tag', 'v1', cwd=work_dir)
+    commit(work_dir, 'three')
+
+    return url, work_dir
+
+
+@pytest.fixture
+def as_build_user():
+    # run the commands of the customer user, and hand the clone over to
+    # them, as the user running the tests
+    with patch('runner.setuser', lambda: None), patch(
+        'steps.repo_cache.customer_ids', return_value=(os.getgid(), os.getuid())
+    ):
+        yield
+
+
+@pytest.mark.usefixtures('as_build_user')
+class TestRepoCache():
+    def test_it_clones_from_the_mirror(self, origin, tmp_path):
+        url, work_dir = origin
+        repo_cache = RepoCache(tmp_path / 'cache', 'Owner', 'Repo')
+        clone_dir = tmp_path / 'clone'
+
+        assert repo_cache.clone(Mock(), 'main', url, clone_dir) == 0
+
+        assert repo_cache.mirror_path == tmp_path / 'cache' / 'owner' / 'repo.git'
+        assert git('rev-parse', 'main', cwd=repo_cache.mirror_path) == (
+            git('rev-parse', 'HEAD', cwd=work_dir)
+        )
+        assert git('rev-parse', 'HEAD', cwd=clone_dir) == git('rev-parse', 'HEAD', cwd=work_dir)
+        assert git('remote', 'get-url', 'origin', cwd=clone_dir) == url
+        assert git('status', '--porcelain', cwd=clone_dir) == ''
+        assert (clone_dir / 'three').read_text() == 'three'
+        assert (clone_dir / '.git' / 'shallow').is_file()
+
+    def test_it_fetches_new_commits(self, origin, tmp_path):
+        url, work_dir = origin
+        repo_cache = RepoCache(tmp_path / 'cache', 'owner', 'repo')
+
+        repo_cache.clone(Mock(), 'main', url, tmp_path / 'clone-1')
+        sha = commit(work_dir, 'four')
+        assert repo_cache.clone(Mock(), 'main', url, tmp_path / 'clone-2') == 0
+
+        assert git('rev-parse', 'HEAD', cwd=tmp_path / 'clone-2') == sha
+
+    def test_it_fails_without_the_branch(self, origin, tmp_path):
+        url, _ = origin
+        repo_cache = RepoCache(tmp_path / 'cache', 'owner', 'repo')
+
+        assert repo_cache.clone(Mock(), 'other', url, tmp_path / 'clone') != 0
+        assert not (tmp_path / 'clone').exists()
+
+    def test_it_unshallows_from_the_mirror(self, origin, tmp_path):
+        url, _ = origin
+        repo_cache = RepoCache(tmp_path / 'cache', 'owner', 'repo')
+        clone_dir = tmp_path / 'clone'
+        repo_cache.clone(Mock(), 'main', url, clone_dir)
+
+        assert repo_cache.unshallow(Mock(), clone_dir) == 0
+
+        assert git('rev-list', '--count', 'HEAD', cwd=clone_dir) == '3'
+        assert git('tag', cwd=clone_dir) == 'v1'
+        assert not (clone_dir / '.git' / 'shallow').exists()
+
+    def test_it_cannot_unshallow_without_a_mirror(self, tmp_path):
+        git('init', '-q', '-b', 'main', str(tmp_path / 'clone'))
+        repo_cache = RepoCache(tmp_path / 'cache', 'owner', 'repo')
+
+        assert repo_cache.unshallow(Mock(), tmp_path / 'clone') == 1
+
+    def test_it_evicts_the_least_recently_used_mirrors(self, origin, tmp_path):
+        url, _ = origin
+        cache_dir = tmp_path / 'cache'
+        repo_caches = [RepoCache(cache_dir, 'owner', f'repo-{idx}') for idx in range(4)]
+
+        for idx, repo_cache in enumerate(repo_caches):
+            repo_cache.clone(Mock(), 'main', url, tmp_path / f'clone-{idx}')
+            os.utime(repo_cache.lock_path, (idx, idx))
+
+        oldest, in_use, newer, current = repo_caches
+        current.max_bytes = 1
+
+        with locked(in_use.lock_path, shared=True):
+            evicted = current.evict(Mock())
+
+        assert evicted == [oldest.mirror_path, newer.mirror_path]
+        assert [repo_cache.mirror_path.exists() for repo_cache in repo_caches] == [
+            False, True, False, True
+        ]
+        # a build waiting for the lock finds no mirror and fetches it again
+        assert oldest.lock_path.exists()
+        assert oldest.clone(Mock(), 'main', url, tmp_path / 'clone-again') == 0
+
+    def test_it_keeps_mirrors_within_the_limit(self, origin, tmp_path):
+        url, _ = origin
+        repo_caches = [RepoCache(tmp_path / 'cache', 'owner', f'repo-{idx}') for idx in range(2)]
+        for idx, repo_cache in enumerate(repo_caches):
+            repo_cache.clone(Mock(), 'main', url, tmp_path / f'clone-{idx}')
+
+        assert repo_caches[1].evict(Mock()) == []
+
+    @pytest.mark.parametrize('owner, repository', [('..', 'repo'), ('owner', 'a/b'), ('', 'r')])
+    def test_it_rejects_invalid_names(self, owner, repository, tmp_path):
+        with pytest.raises(ValueError):
+            RepoCache(tmp_path, owner, repository)
+
 
-@patch('steps.fetch.subprocess.run')
 @patch('steps.fetch.get_logger')
 class TestFetchCommitSHA():
-    def test_runs_expected_cmds(self, mock_get_logger, mock_run):
-        mock_run.return_value = subprocess.CompletedProcess([], 0, 'commit testSha blah blah blah')
-        clone_dir = 'clone_dir'
+    SHA = '5b0fc4f1c3a1d2e3f4a5b6c7d8e9f0a1b2c3d4e5'
+
+    def test_it_reads_the_branch_ref(self, mock_get_logger, tmpdir):
+        git_dir = tmpdir.mkdir('.git')
+        git_dir.join('HEAD').write('ref: refs/heads/main\n')
+        git_dir.mkdir('refs').mkdir('heads').join('main').write(f'{self.SHA}\n')
 
-        command = ['git', 'log', '-1']
-        commit_sha = fetch_commit_sha(clone_dir)
+        commit_sha = fetch_commit_sha(str(tmpdir))
 
         mock_get_logger.assert_called_once_with('clone')
-        mock_run.assert_called_once_with(
-            command,
-            shell=False,  # nosec
-            check=True,
-            stdout=subprocess.PIPE,
-            universal_newlines=True,
-            cwd=clone_dir
+        mock_get_logger.return_value.info.assert_has_calls([
+            call('Fetching commit details ...'),
+            call(f'commit {self.SHA}'),
+        ])
+        assert commit_sha == self.SHA
+
+    def test_it_reads_packed_refs(self, mock_get_logger, tmpdir):
+        git_dir = tmpdir.mkdir('.git')
+        git_dir.join('HEAD').write('ref: refs/heads/main\n')
+        git_dir.join('packed-refs').write(
+            '# pack-refs with: peeled fully-peeled sorted\n'
+            f'{"0" * 40} refs/heads/other\n'
+            f'{self.SHA} refs/heads/main\n'
         )
-        assert commit_sha == 'testSha'
+
+        assert fetch_commit_sha(str(tmpdir)) == self.SHA
+
+    def test_it_reads_a_detached_head(self, mock_get_logger, tmpdir):
+        tmpdir.mkdir('.git').join('HEAD').write(f'{self.SHA}\n')
+
+        assert fetch_commit_sha(str(tmpdir)) == self.SHA
+
+    def test_it_matches_git(self, mock_get_logger, tmpdir):
+        subprocess.run(['git', 'init', '-q', str(tmpdir)], check=True)  # nosec
+        subprocess.run(  # nosec
+            ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com',
+             'commit', '-q', '--allow-empty', '-m', 'test'],
+            cwd=str(tmpdir), check=True
+        )
+        subprocess.run(['git', 'pack-refs', '--all'], cwd=str(tmpdir), check=True)  # nosec
+
+        expected = subprocess.run(  # nosec
+            ['git', 'rev-parse', 'HEAD'], cwd=str(tmpdir), check=True,
+            stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout.strip()
+
+        assert fetch_commit_sha(str(tmpdir)) == expected
+
+    def test_it_raises_a_step_exception(self, mock_get_logger, tmpdir):
+        with pytest.raises(StepException):
+            fetch_commit_sha(str(tmpdir))
@@ -1,10 +1,30 @@
+import csv
+import gzip
+import importlib
+import json
 import logging
-from unittest.mock import patch
+import sys
+import threading
+import time
+from io import StringIO
+from unittest.mock import MagicMock, Mock, patch
+
+import boto3
+import psycopg2
+import pytest
+from moto import mock_s3
 
 from log_utils.get_logger import (
     LogFilter, Formatter, get_logger, init_logging,
-    set_log_attrs, DEFAULT_LOG_LEVEL)
-from log_utils.db_handler import DBHandler
+    set_log_attrs, upload_log_archive, DEFAULT_LOG_LEVEL)
+from log_utils.archive_handler import ArchiveHandler
+from log_utils.chunks import decode_chunk, encode_chunk, read_build_log
+from log_utils.db_handler import (
+    CHUNK_COPY_STMT, COPY_STMT, LAST_ID_STMT, NOTIFY_STMT, DBHandler)
+from log_utils.tail import NEW_ROWS_QUERIES, read_new_lines, tail_build_log
+
+# `log_utils.get_logger` is also the name of a function of the package
+get_logger_module = importlib.import_module('log_utils.get_logger')
 
 
 class TestLogFilter():
@@ -58,6 +78,41 @@ class TestLogFilter():
             'Sorry for the inconvenience!'
         ))
 
+    def test_it_masks_arguments(self):
+        filter = LogFilter(['foobar'])
+        record = logging.makeLogRecord({'msg': 'hello %s', 'args': ('foobar',)})
+        result = filter.filter(record)
+
+        assert(result is True)
+        assert(record.getMessage() == f'hello {LogFilter.DEFAULT_MASK}')
+
+    def test_it_masks_the_longest_value_first(self):
+        filter = LogFilter(['foo', '', 'foo.bar*', 'bar'], mask='*')
+        record = logging.makeLogRecord({'msg': 'foo.bar* foo.bar bar \\1'})
+        filter.filter(record)
+
+        assert(record.getMessage() == '* *.* * \\1')
+
+    def test_it_masks_exceptions(self):
+        filter = LogFilter(['foobar'])
+        try:
+            raise ValueError('bad value foobar')
+        except ValueError:
+            record = logging.makeLogRecord({'msg': 'oops', 'exc_info': sys.exc_info()})
+
+        filter.filter(record)
+
+        assert('bad value foobar' not in logging.Formatter().format(record))
+        assert(f'bad value {LogFilter.DEFAULT_MASK}' in logging.Formatter().format(record))
+
+    def test_it_masks_a_record_once(self):
+        filter = LogFilter(['foobar'], mask='foobar-hidden')
+        record = logging.makeLogRecord({'msg': 'hello foobar'})
+
+        assert(filter.filter(record) is True)
+        assert(filter.filter(record) is True)
+        assert(record.getMessage() == 'hello foobar-hidden')
+
 
 class TestFormatter():
     @patch('logging.Formatter.format')
@@ -98,10 +153,27 @@ class TestGetLogger():
         assert(adapter.extra == attrs)
 
 
+@pytest.fixture
+def mock_basic_config(monkeypatch):
+    '''Keeps the handlers of `init_logging` off the root logger, and closes them'''
+    monkeypatch.setattr(get_logger_module, 'LOG_ARCHIVE', None)
+
+    with patch('logging.basicConfig') as mock_basic_config:
+        yield mock_basic_config
+
+    handlers = []
+    for _, kwargs in mock_basic_config.call_args_list:
+        handlers.extend(kwargs['handlers'])
+    if get_logger_module.LOG_ARCHIVE is not None:
+        handlers.extend(get_logger_module.LOG_ARCHIVE)
+
+    for handler in handlers:
+        handler.close()
+
+
 @patch('psycopg2.connect')
-@patch('logging.basicConfig')
 class TestInitLogging():
-    def test_it_adds_a_stream_and_db_handlers(self, mock_basic_config, _):
+    def test_it_adds_a_stream_and_db_handlers(self, _, mock_basic_config):
         init_logging([], {'buildid': 1234}, 'foo')
 
         _, kwargs = mock_basic_config.call_args
@@ -110,3 +182,400 @@ class TestInitLogging():
         assert(len(kwargs['handlers']) == 2)
         assert(type(kwargs['handlers'][0]) == logging.StreamHandler)
         assert(type(kwargs['handlers'][1]) == DBHandler)
+        assert(kwargs['handlers'][1].chunks is False)
+
+    def test_it_can_log_to_an_archive(self, _, mock_basic_config, tmp_path):
+        init_logging([], {'buildid': 1234}, 'foo', archive_path=tmp_path / 'build.log.gz')
+
+        _, kwargs = mock_basic_config.call_args
+        archive_handler = kwargs['handlers'][1]
+
+        assert(len(kwargs['handlers']) == 2)
+        assert(type(archive_handler) == ArchiveHandler)
+
+    def test_it_can_log_to_the_db_in_chunks(self, _, mock_basic_config):
+        init_logging([], {'buildid': 1234}, 'foo', db_chunk_lines=1000, db_compress=True)
+
+        _, kwargs = mock_basic_config.call_args
+        db_handler = kwargs['handlers'][1]
+
+        assert(db_handler.chunks is True)
+        assert(db_handler.compress is True)
+        assert(db_handler.batch_size == 1000)
+
+    def test_it_can_notify_listeners(self, _, mock_basic_config):
+        init_logging([], {'buildid': 1234}, 'foo', db_notify=True)
+
+        _, kwargs = mock_basic_config.call_args
+
+        assert(kwargs['handlers'][1].notify is True)
+
+
+def copied_rows(mock_connect):
+    '''The log lines written by each COPY of a DBHandler'''
+    cursor = mock_connect.return_value.cursor.return_value
+    return [
+        [row[2] for row in csv.reader(StringIO(args[1].getvalue()))]
+        for args, _ in cursor.copy_expert.call_args_list
+    ]
+
+
+def log_record(msg):
+    return logging.makeLogRecord({'msg': msg})
+
+
+@patch('psycopg2.connect')
+class TestDBHandler():
+    def test_it_writes_records_in_batches(self, mock_connect):
+        handler = DBHandler('foo', 1234, batch_size=2)
+
+        for msg in ['one', 'two', 'three']:
+            handler.emit(log_record(msg))
+        handler.close()
+
+        assert(copied_rows(mock_connect) == [['one', 'two'], ['three']])
+
+        cursor = mock_connect.return_value.cursor.return_value
+        args, _ = cursor.copy_expert.call_args
+        assert(args[0] == COPY_STMT)
+        row = next(csv.reader(StringIO(args[1].getvalue())))
+        assert(row[:2] == ['1234', 'ALL'])
+        assert(mock_connect.return_value.commit.call_count == 2)
+        mock_connect.return_value.close.assert_called_once()
+
+    def test_it_writes_records_after_the_flush_interval(self, mock_connect):
+        handler = DBHandler('foo', 1234, flush_interval=0.01)
+
+        handler.emit(log_record('one'))
+
+        cursor = mock_connect.return_value.cursor.return_value
+        for _ in range(100):
+            if cursor.copy_expert.called:
+                break
+            time.sleep(0.05)
+
+        assert(copied_rows(mock_connect) == [['one']])
+        handler.close()
+
+    def test_flush_waits_for_queued_records(self, mock_connect):
+        handler = DBHandler('foo', 1234, flush_interval=60)
+
+        handler.emit(log_record('one'))
+        handler.emit(log_record('two'))
+        handler.flush()
+
+        assert(copied_rows(mock_connect) == [['one', 'two']])
+        handler.close()
+
+    def test_it_drops_records_when_the_queue_is_full(self, mock_connect):
+        writing = threading.Event()
+        release = threading.Event()
+
+        def slow_copy(*args):
+            writing.set()
+            release.wait(5)
+
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = slow_copy
+
+        handler = DBHandler('foo', 1234, batch_size=1, max_queue=1, put_timeout=0.01)
+
+        handler.emit(log_record('one'))
+        writing.wait(5)
+        handler.emit(log_record('two'))
+        handler.emit(log_record('three'))
+        handler.emit(log_record('four'))
+
+        release.set()
+        handler.close()
+
+        assert(copied_rows(mock_connect) == [
+            ['one'], ['two'], ['... 2 log lines dropped, the database was too slow ...']
+        ])
+
+    def test_it_keeps_writing_after_a_failed_write(self, mock_connect, capsys):
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = [Exception('connection lost'), None]
+
+        handler = DBHandler('foo', 1234, batch_size=1)
+        handler.emit(log_record('one'))
+        handler.emit(log_record('two'))
+        handler.close()
+
+        assert(copied_rows(mock_connect) == [['one'], ['two']])
+        mock_connect.return_value.rollback.assert_called_once()
+        assert('Failed to write 1 log lines to the database' in capsys.readouterr().err)
+
+    def test_it_removes_nul_characters(self, mock_connect):
+        handler = DBHandler('foo', 1234)
+        handler.emit(log_record('one\x00two'))
+        handler.close()
+
+        assert(copied_rows(mock_connect) == [['onetwo']])
+
+    def test_it_replays_spilled_records_after_reconnecting(self, mock_connect, tmp_path):
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = [
+            None, psycopg2.OperationalError('server closed the connection'), None
+        ]
+        spill_path = tmp_path / 'work' / 'buildlog.jsonl'
+
+        handler = DBHandler('foo', 1234, spill_path=spill_path)
+        handler.emit(log_record('one'))
+        handler.flush()
+        handler.emit(log_record('two'))
+        handler.flush()
+        handler.emit(log_record('three'))
+        handler.flush()
+
+        assert([json.loads(line)[2] for line in spill_path.read_text().splitlines()] == [
+            'two', 'three'
+        ])
+
+        handler.close()
+
+        # the failed write is retried on a new connection along with the next records
+        assert(copied_rows(mock_connect) == [['one'], ['two'], ['two', 'three']])
+        assert(mock_connect.call_count == 2)
+        assert(handler.delivery_stats() == dict(
+            written=1, replayed=2, spilled=2, dropped=0, failed=0, undelivered=0
+        ))
+        assert(not spill_path.exists())
+
+    @patch('log_utils.db_handler.REPLAY_TIMEOUT', 0.1)
+    @patch('log_utils.db_handler.RETRY_DELAY', 0.01)
+    def test_it_keeps_the_spill_file_if_the_db_stays_down(self, mock_connect, tmp_path,
+                                                          capsys):
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.copy_expert.side_effect = psycopg2.OperationalError('server closed the connection')
+        spill_path = tmp_path / 'buildlog.jsonl'
+
+        handler = DBHandler('foo', 1234, spill_path=spill_path)
+        mock_connect.side_effect = psycopg2.OperationalError('could not connect to server')
+
+        handler.emit(log_record('one'))
+        handler.emit(log_record('two'))
+        handler.close()
+
+        assert(mock_connect.call_count > 2)
+        assert(handler.delivery_stats()['undelivered'] == 2)
+        assert(len(spill_path.read_text().splitlines()) == 2)
+        assert(f'2 not written and kept in {spill_path}' in capsys.readouterr().err)
+
+    def test_it_writes_chunks(self, mock_connect):
+        handler = DBHandler('foo', 1234, chunks=True, compress=True)
+        for msg in ['one', 'two\nthree']:
+            handler.emit(log_record(msg))
+        handler.close()
+
+        cursor = mock_connect.return_value.cursor.return_value
+        args, _ = cursor.copy_expert.call_args
+        assert(args[0] == CHUNK_COPY_STMT)
+
+        rows = list(csv.reader(StringIO(args[1].getvalue())))
+        assert(len(rows) == 1)
+        build, source, line_count, encoding, output = rows[0][:5]
+        assert([build, source, line_count, encoding] == ['1234', 'ALL', '2', 'json+zlib'])
+        assert(decode_chunk(encoding, bytes.fromhex(output[2:])) == ['one', 'two\nthree'])
+
+    def test_it_notifies_the_new_ids(self, mock_connect):
+        cursor = mock_connect.return_value.cursor.return_value
+        # the last id before the first batch, then the last id of each batch
+        cursor.fetchone.side_effect = [(100,), (102,), (110,)]
+
+        handler = DBHandler('foo', 1234, batch_size=2, notify=True)
+        for msg in ['one', 'two', 'three']:
+            handler.emit(log_record(msg))
+        handler.close()
+
+        assert(cursor.execute.call_args_list == [
+            ((LAST_ID_STMT, ('buildlog',)),),
+            ((NOTIFY_STMT, dict(table='buildlog', channel='build_1234', after=100)),),
+            ((NOTIFY_STMT, dict(table='buildlog', channel='build_1234', after=102)),),
+        ])
+        assert(handler.last_id == 110)
+
+    def test_it_notifies_the_new_chunk_ids(self, mock_connect):
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.fetchone.side_effect = [(None,), (1,)]
+
+        handler = DBHandler('foo', 1234, chunks=True, notify=True)
+        handler.emit(log_record('one'))
+        handler.close()
+
+        assert(cursor.execute.call_args_list == [
+            ((LAST_ID_STMT, ('buildlog_chunk',)),),
+            ((NOTIFY_STMT, dict(table='buildlog_chunk', channel='build_1234', after=0)),),
+        ])
+
+    def test_it_does_not_notify_by_default(self, mock_connect):
+        handler = DBHandler('foo', 1234)
+        handler.emit(log_record('one'))
+        handler.close()
+
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.execute.assert_not_called()
+
+
+class TestReadBuildLog():
+    def test_it_expands_chunks(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [
+            encode_chunk(['one', 'two']),
+            encode_chunk(['three'], compress=True),
+        ]
+
+        assert(list(read_build_log(conn, 1234)) == ['one', 'two', 'three'])
+        cursor.execute.assert_called_once()
+
+    def test_it_reads_lines_without_chunks(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = []
+        cursor.__iter__.return_value = iter([('one',), ('two',)])
+
+        assert(list(read_build_log(conn, 1234)) == ['one', 'two'])
+        cursor.execute.assert_called_with(
+            'SELECT output FROM buildlog WHERE build = %s ORDER BY id', (1234,)
+        )
+
+
+def notification(payload):
+    return Mock(payload=json.dumps(payload))
+
+
+class TestTailBuildLog():
+    def test_it_reads_new_lines(self):
+        cursor = Mock()
+        cursor.fetchall.return_value = [(11, 'one'), (14, 'two')]
+
+        assert(read_new_lines(cursor, 1234, 'buildlog', 10, 20) == (['one', 'two'], 14))
+        cursor.execute.assert_called_once_with(NEW_ROWS_QUERIES['buildlog'], (1234, 10, 20))
+
+    def test_it_reads_new_chunks(self):
+        cursor = Mock()
+        cursor.fetchall.return_value = [(3,) + encode_chunk(['one', 'two'], compress=True)]
+
+        assert(read_new_lines(cursor, 1234, 'buildlog_chunk', 2, 3) == (['one', 'two'], 3))
+
+    def test_it_reads_nothing_new(self):
+        cursor = Mock()
+        cursor.fetchall.return_value = []
+
+        assert(read_new_lines(cursor, 1234, 'buildlog', 10, 20) == ([], 10))
+
+    @patch('select.select')
+    def test_it_follows_the_notifications(self, mock_select):
+        conn = MagicMock()
+        conn.notifies = []
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchall.side_effect = [
+            # the lines logged before listening
+            [(1, 'one')], [],
+            [(5, 'two'), (7, 'three')],
+        ]
+
+        def poll():
+            conn.notifies.append(notification({'table': 'buildlog', 'after': 1, 'last': 7}))
+            # already read
+            conn.notifies.append(notification({'table': 'buildlog', 'after': 1, 'last': 5}))
+
+        conn.poll.side_effect = poll
+        mock_select.side_effect = [([conn], [], []), ([], [], [])]
+
+        lines = list(tail_build_log(conn, 1234, idle_timeout=1))
+
+        assert(lines == ['one', 'two', 'three'])
+        assert(conn.autocommit is True)
+        assert(cursor.execute.call_args_list[-1] == (
+            (NEW_ROWS_QUERIES['buildlog'], (1234, 1, 7)),
+        ))
+        assert(cursor.execute.call_count == 4)
+        mock_select.assert_called_with([conn], [], [], 1)
+
+
+TEST_BUCKET = 'test-bucket'
+TEST_REGION = 'test-region'
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'fake-access-key')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'fake-secret-key')
+
+    with mock_s3():
+        s3_client = boto3.client('s3', region_name=TEST_REGION)
+        s3_client.create_bucket(
+            Bucket=TEST_BUCKET,
+            CreateBucketConfiguration={'LocationConstraint': TEST_REGION}
+        )
+        yield s3_client
+
+
+@pytest.fixture
+def log_archive(tmp_path, monkeypatch):
+    archive_handler = ArchiveHandler(tmp_path / 'build.log.gz', tail_lines=2)
+    archive_handler.setFormatter(logging.Formatter('> {message}', style='{'))
+    db_handler = Mock()
+    monkeypatch.setattr(get_logger_module, 'LOG_ARCHIVE', (archive_handler, db_handler))
+
+    yield archive_handler, db_handler
+
+    logging.getLogger().removeHandler(db_handler)
+
+
+class TestUploadLogArchive():
+    def test_it_uploads_the_archive_and_logs_the_tail_to_the_db(self, s3_client, log_archive):
+        archive_handler, db_handler = log_archive
+        for msg in ['one', 'two', 'three']:
+            archive_handler.handle(log_record(msg))
+
+        with patch.object(s3_client, 'upload_file', wraps=s3_client.upload_file) as spy:
+            upload_log_archive(s3_client, TEST_BUCKET, '_build-logs/site/prefix/1234.log.gz')
+
+        spy.assert_called_once_with(
+            str(archive_handler.path), TEST_BUCKET, '_build-logs/site/prefix/1234.log.gz',
+            ExtraArgs={
+                'ContentType': 'text/plain; charset=utf-8',
+                'ContentEncoding': 'gzip',
+                'ServerSideEncryption': 'AES256',
+            }
+        )
+
+        obj = s3_client.get_object(Bucket=TEST_BUCKET, Key='_build-logs/site/prefix/1234.log.gz')
+        # the stand-in appends the encoding of the upload itself
+        assert(obj['ContentEncoding'].startswith('gzip'))
+        assert(gzip.decompress(obj['Body'].read()).decode('utf-8') == (
+            '> one\n> two\n> three\n'
+        ))
+
+        messages = [args[0].getMessage() for args, _ in db_handler.handle.call_args_list]
+        assert(messages[1:] == ['two', 'three'])
+        assert(messages[0].startswith('The build log (3 lines, '))
+        assert(messages[0].endswith(
+            'was archived to s3://test-bucket/_build-logs/site/prefix/1234.log.gz, '
+            'the last 2 lines follow'
+        ))
+
+        # the db gets the records logged from then on
+        assert(db_handler in logging.getLogger().handlers)
+
+    def test_it_logs_the_tail_to_the_db_if_the_upload_fails(self, s3_client, log_archive):
+        archive_handler, db_handler = log_archive
+        archive_handler.handle(log_record('one'))
+
+        upload_log_archive(s3_client, 'missing-bucket', 'build.log.gz')
+
+        messages = [args[0].getMessage() for args, _ in db_handler.handle.call_args_list]
+        assert(messages[0].startswith(
+            'Failed to archive the build log to s3://missing-bucket/build.log.gz: '
+        ))
+        assert(messages[1:] == ['one'])
+
+    def test_it_does_nothing_without_an_archive(self, s3_client, monkeypatch):
+        monkeypatch.setattr(get_logger_module, 'LOG_ARCHIVE', None)
+
+        upload_log_archive(s3_client, TEST_BUCKET, 'build.log.gz')
+
+        assert('Contents' not in s3_client.list_objects_v2(Bucket=TEST_BUCKET))
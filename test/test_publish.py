@@ -1,5 +1,7 @@
+import json
 from unittest.mock import Mock
 
+from publishing.metrics import PublishMetrics
 from steps import publish
 from common import SITE_BUILD_DIR_PATH
 
@@ -34,3 +36,27 @@ class TestPublish():
         _, actual_kwargs = mock_publish_to_s3.call_args_list[0]
         assert type(actual_kwargs['directory']) == str
         assert actual_kwargs['directory'] == str(SITE_BUILD_DIR_PATH)
+
+    def test_it_writes_metrics_file(self, monkeypatch, tmpdir):
+        metrics = PublishMetrics()
+        metrics.bytes_uploaded = 42
+        monkeypatch.setattr('publishing.s3publisher.publish_to_s3',
+                            Mock(return_value=metrics))
+
+        metrics_file = str(tmpdir.join('metrics.json'))
+
+        result = publish(
+            base_url='/site/prefix',
+            site_prefix='site/prefix',
+            bucket=TEST_BUCKET,
+            federalist_config={},
+            aws_region=TEST_REGION,
+            aws_access_key_id=TEST_ACCESS_KEY,
+            aws_secret_access_key=TEST_SECRET_KEY,
+            metrics_file=metrics_file
+        )
+
+        assert result is metrics
+
+        with open(metrics_file) as f:
+            assert json.load(f)['bytes']['uploaded'] == 42
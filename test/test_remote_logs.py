@@ -1,64 +1,287 @@
+import importlib.util
+import json
+import threading
+import time
+from pathlib import Path
 from unittest.mock import patch
 
+import pytest
+import requests
+import requests_mock
+
+from log_utils import remote_logs
 from log_utils.remote_logs import (
-    b64string, post_build_complete,
+    b64string, init_status_client, post_build_complete,
     post_build_error, post_build_timeout,
-    post_build_processing)
+    post_build_processing, Heartbeat, StatusClient)
 
 from log_utils.common import (STATUS_COMPLETE, STATUS_ERROR, STATUS_PROCESSING)
 
 MOCK_STATUS_URL = 'https://status.example.com'
 
+ECHO_SERVER_PATH = Path(__file__).parent.parent / 'echo-server' / 'run.py'
+
+
+@pytest.fixture(autouse=True)
+def status_client(monkeypatch):
+    # no waiting between attempts
+    monkeypatch.setattr(remote_logs, 'RETRY_BACKOFF', 0)
+    monkeypatch.setattr(remote_logs, 'STATUS_CLIENT', StatusClient())
+
+
+@pytest.fixture
+def echo_server():
+    spec = importlib.util.spec_from_file_location('echo_server', ECHO_SERVER_PATH)
+    echo_server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(echo_server)
+
+    server = echo_server.StoppableHTTPServer(('127.0.0.1', 0), echo_server.RequestHandler)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    thread.join()
+
+
+def echo_url(server, path):
+    host, port = server.server_address
+    return f'http://{host}:{port}{path}'
+
 
 class TestPostBuildComplete():
-    @patch('requests.post')
-    @patch('requests.delete')
-    def test_it_works(self, mock_del, mock_post):
+    def test_it_works(self):
         commit_sha = 'testSha1'
-        post_build_complete(MOCK_STATUS_URL, commit_sha)
-        mock_post.assert_called_once_with(
-            MOCK_STATUS_URL,
-            json={'status': STATUS_COMPLETE, 'message': '', 'commit_sha': commit_sha}
-        )
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL)
+            post_build_complete(MOCK_STATUS_URL, commit_sha)
+
+        assert m.call_count == 1
+        assert m.last_request.json() == {
+            'status': STATUS_COMPLETE, 'message': '', 'commit_sha': commit_sha
+        }
 
 
 class TestPostBuildProcessing():
-    @patch('requests.post')
-    def test_it_works(self, mock_post):
-        post_build_processing(MOCK_STATUS_URL)
-        mock_post.assert_called_once_with(
-            MOCK_STATUS_URL, json={'status': STATUS_PROCESSING, 'message': '', 'commit_sha': None})
+    def test_it_works(self):
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL)
+            post_build_processing(MOCK_STATUS_URL)
+
+        assert m.call_count == 1
+        assert m.last_request.json() == {
+            'status': STATUS_PROCESSING, 'message': '', 'commit_sha': None
+        }
 
 
 class TestPostBuildError():
-    @patch('requests.post')
-    @patch('requests.delete')
-    def test_it_works(self, mock_del, mock_post):
+    def test_it_works(self):
         commit_sha = 'testSha2'
-        post_build_error(MOCK_STATUS_URL, 'error msg', commit_sha)
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL)
+            post_build_error(MOCK_STATUS_URL, 'error msg', commit_sha)
 
-        assert mock_post.call_count == 1
-
-        mock_post.assert_any_call(
-            MOCK_STATUS_URL,
-            json={
-                'status': STATUS_ERROR, 'message': b64string('error msg'), 'commit_sha': commit_sha
-            }
-        )
+        assert m.call_count == 1
+        assert m.last_request.json() == {
+            'status': STATUS_ERROR, 'message': b64string('error msg'), 'commit_sha': commit_sha
+        }
 
 
 class TestPostBuildTimeout():
-    @patch('requests.post')
-    @patch('requests.delete')
-    def test_it_works(self, mock_del, mock_post):
+    def test_it_works(self):
         commit_sha = 'testSha3'
-        post_build_timeout(MOCK_STATUS_URL, commit_sha)
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL)
+            post_build_timeout(MOCK_STATUS_URL, commit_sha)
 
         expected_output = b64string(
             'The build did not complete. It may have timed out.')
 
-        assert mock_post.call_count == 1
-        mock_post.assert_any_call(
+        assert m.call_count == 1
+        assert m.last_request.json() == {
+            'status': STATUS_ERROR, 'message': expected_output, 'commit_sha': commit_sha
+        }
+
+
+class TestStatusClient():
+    def test_it_times_out(self):
+        client = StatusClient()
+        with patch.object(client.session, 'post') as mock_post:
+            mock_post.return_value.status_code = 200
+            client.post(MOCK_STATUS_URL, {'status': STATUS_PROCESSING})
+
+        mock_post.assert_called_once_with(
             MOCK_STATUS_URL,
-            json={'status': STATUS_ERROR, 'message': expected_output, 'commit_sha': commit_sha}
+            json={'status': STATUS_PROCESSING},
+            timeout=(remote_logs.CONNECT_TIMEOUT, remote_logs.READ_TIMEOUT)
         )
+
+    def test_it_retries(self):
+        client = StatusClient()
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL, [
+                dict(exc=requests.exceptions.ConnectTimeout),
+                dict(status_code=503),
+                dict(status_code=200),
+            ])
+            client.post(MOCK_STATUS_URL, {'status': STATUS_PROCESSING})
+
+        assert m.call_count == 3
+
+    def test_it_does_not_retry_client_errors(self):
+        client = StatusClient()
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL, status_code=400)
+            client.post(MOCK_STATUS_URL, {'status': STATUS_PROCESSING})
+
+        assert m.call_count == 1
+
+    def test_it_gives_up(self, capsys):
+        client = StatusClient()
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL, exc=requests.exceptions.ConnectionError('refused'))
+            client.post(MOCK_STATUS_URL, {'status': STATUS_PROCESSING})
+
+        assert m.call_count == remote_logs.MAX_ATTEMPTS
+        assert 'Failed to post the build status after 4 attempts: refused' in (
+            capsys.readouterr().err
+        )
+
+    @patch('atexit.register')
+    def test_it_posts_in_the_background(self, mock_register, echo_server):
+        client = StatusClient(blocking=False)
+        url = echo_url(echo_server, '/status?delay=0.2')
+
+        start = time.monotonic()
+        client.post(url, {'status': STATUS_PROCESSING})
+        client.post(url, {'status': STATUS_COMPLETE})
+
+        # posting does not wait for the server
+        assert time.monotonic() - start < 0.2
+        mock_register.assert_called_once_with(client.flush)
+
+        assert client.flush() is True
+        assert [json.loads(payload)['status'] for _, _, payload in echo_server.requests] == [
+            STATUS_PROCESSING, STATUS_COMPLETE
+        ]
+
+    @patch('atexit.register')
+    def test_the_worker_survives_request_errors(self, mock_register, capsys):
+        client = StatusClient(blocking=False)
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL, [
+                dict(exc=requests.exceptions.ChunkedEncodingError('truncated')),
+                dict(status_code=200),
+            ])
+            client.post(MOCK_STATUS_URL, {'status': STATUS_PROCESSING})
+            client.post(MOCK_STATUS_URL, {'status': STATUS_COMPLETE})
+
+            assert client.flush(timeout=5) is True
+
+        assert client.worker.is_alive()
+        assert m.last_request.json() == {'status': STATUS_COMPLETE}
+
+    @patch('atexit.register')
+    def test_the_worker_survives_unexpected_errors(self, mock_register, capsys):
+        client = StatusClient(blocking=False)
+        with patch.object(client, '_post', side_effect=[ValueError('boom'), None]) as mock_post:
+            client.post(MOCK_STATUS_URL, {'status': STATUS_PROCESSING})
+            client.post(MOCK_STATUS_URL, {'status': STATUS_COMPLETE})
+
+            assert client.flush(timeout=5) is True
+
+        assert client.worker.is_alive()
+        assert mock_post.call_count == 2
+        assert 'Failed to post the build status: boom' in capsys.readouterr().err
+
+    @patch('atexit.register')
+    def test_flush_has_a_deadline(self, mock_register, echo_server, capsys):
+        client = StatusClient(blocking=False)
+
+        client.post(echo_url(echo_server, '/status?delay=1'), {'status': STATUS_PROCESSING})
+
+        assert client.flush(timeout=0.1) is False
+        assert 'Gave up waiting for 1 build statuses to be posted' in capsys.readouterr().err
+
+    def test_it_retries_against_the_echo_server(self, echo_server):
+        client = StatusClient()
+
+        client.post(echo_url(echo_server, '/status?fail=2'), {'status': STATUS_PROCESSING})
+
+        assert len(echo_server.requests) == 3
+
+    @patch('atexit.register')
+    def test_init_status_client(self, mock_register):
+        client = init_status_client(blocking=False)
+
+        assert remote_logs.STATUS_CLIENT is client
+        assert client.blocking is False
+
+
+class TestHeartbeat():
+    def test_it_posts_the_progress(self):
+        heartbeat = Heartbeat(MOCK_STATUS_URL)
+        heartbeat.update(step='publish', files_done=1, files_total=2)
+
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL)
+            heartbeat.beat()
+
+        assert m.last_request.json() == {
+            'status': STATUS_PROCESSING, 'message': '', 'commit_sha': None,
+            'progress': {
+                'step': 'publish', 'files_done': 1, 'files_total': 2, 'elapsed_seconds': 0
+            }
+        }
+
+    def test_it_coalesces_updates(self):
+        heartbeat = Heartbeat(MOCK_STATUS_URL, keepalive=60)
+
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL)
+
+            heartbeat.update(step='fetch')
+            heartbeat.update(step='publish', files_done=1)
+            heartbeat.update(files_done=2)
+            heartbeat.beat()
+            assert m.call_count == 1
+            assert m.last_request.json()['progress']['files_done'] == 2
+
+            # nothing changed
+            heartbeat.update(files_done=2)
+            heartbeat.beat()
+            assert m.call_count == 1
+
+            heartbeat.update(files_done=3)
+            heartbeat.beat()
+            assert m.call_count == 2
+
+    def test_it_keeps_posting_without_changes(self):
+        heartbeat = Heartbeat(MOCK_STATUS_URL, keepalive=0)
+
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL)
+            heartbeat.beat()
+            heartbeat.beat()
+
+        assert m.call_count == 2
+
+    def test_it_posts_periodically_until_stopped(self):
+        heartbeat = Heartbeat(MOCK_STATUS_URL, interval=0.01, keepalive=0)
+
+        with requests_mock.Mocker() as m:
+            m.post(MOCK_STATUS_URL)
+            heartbeat.start()
+            for _ in range(100):
+                if m.call_count >= 2:
+                    break
+                time.sleep(0.01)
+
+            heartbeat.stop()
+            count = m.call_count
+            heartbeat.beat()
+            heartbeat.thread.join(1)
+
+        assert count >= 2
+        assert m.call_count == count
@@ -1,9 +1,14 @@
 from pytest import raises
+import io
+import json
+import queue
 import shlex
 import subprocess  # nosec
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, call, patch
 
-from runner import run, setuser, NVM_PATH, RVM_PATH
+from runner import (clear_toolchain_envs, format_usage, read_lines, run, setuser,
+                    toolchain_env, usage_records, write_usage_records, NVM_PATH, RVM_PATH)
+from runner.output_filter import OutputFilter
 
 
 @patch('subprocess.Popen', autospec=True)
@@ -11,7 +16,9 @@ def test_run(mock_popen):
     mock_logger = Mock()
     command = 'foobar'
 
-    mock_popen.return_value = Mock(returncode=0, stdout=Mock(readline=Mock(return_value='foobar')))
+    mock_popen.return_value = Mock(
+        returncode=0, stdout=Mock(read=Mock(side_effect=[b'foobar', b'']))
+    )
 
     result = run(mock_logger, command)
 
@@ -23,9 +30,7 @@ def test_run(mock_popen):
         executable=None,
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
         preexec_fn=setuser,
     )
 
@@ -51,9 +56,7 @@ def test_run_popen_failure(mock_popen):
         executable=None,
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
         preexec_fn=setuser,
     )
 
@@ -81,9 +84,7 @@ def test_run_popen_failure_check_true(mock_popen):
         executable=None,
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
         preexec_fn=setuser,
     )
 
@@ -108,9 +109,7 @@ def test_run_os_failure(mock_popen):
         executable=None,
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
         preexec_fn=setuser
     )
 
@@ -140,9 +139,7 @@ def test_run_os_failure_check_true(mock_popen):
         executable=None,
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
         preexec_fn=setuser
     )
 
@@ -158,7 +155,7 @@ def test_run_command_failure(mock_popen):
     command = 'foobar'
     return_code = 2
 
-    mock_popen.return_value = Mock(returncode=return_code, stdout=Mock(readline=Mock()))
+    mock_popen.return_value = Mock(returncode=return_code, stdout=Mock(read=Mock(return_value=b'')))
 
     result = run(mock_logger, command)
 
@@ -170,9 +167,7 @@ def test_run_command_failure(mock_popen):
         executable=None,
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
         preexec_fn=setuser
     )
 
@@ -185,7 +180,7 @@ def test_run_command_failure_check_true(mock_popen):
     command = 'foobar'
     return_code = 2
 
-    mock_popen.return_value = Mock(returncode=return_code, stdout=Mock(readline=Mock()))
+    mock_popen.return_value = Mock(returncode=return_code, stdout=Mock(read=Mock(return_value=b'')))
 
     with raises(subprocess.CalledProcessError):
         run(mock_logger, command, check=True)
@@ -198,23 +193,23 @@ def test_run_command_failure_check_true(mock_popen):
         executable=None,
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
         preexec_fn=setuser
     )
 
 
 @patch('subprocess.Popen', autospec=True)
-def test_run_with_node(mock_popen):
+def test_run_shell_with_node(mock_popen):
     mock_logger = Mock()
     command = 'foobar'
     cwd = '/foo'
     env = {}
 
-    mock_popen.return_value = Mock(returncode=0, stdout=Mock(readline=Mock(return_value='foobar')))
+    mock_popen.return_value = Mock(
+        returncode=0, stdout=Mock(read=Mock(side_effect=[b'foobar', b'']))
+    )
 
-    run(mock_logger, command, cwd=cwd, env=env, node=True)
+    run(mock_logger, command, cwd=cwd, env=env, shell=True, node=True)
 
     mock_popen.assert_called_once_with(
         f'source {NVM_PATH} && nvm use default && {command}',
@@ -224,23 +219,23 @@ def test_run_with_node(mock_popen):
         executable='/bin/bash',
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
         preexec_fn=setuser
     )
 
 
 @patch('subprocess.Popen', autospec=True)
-def test_run_with_ruby(mock_popen):
+def test_run_shell_with_ruby(mock_popen):
     mock_logger = Mock()
     command = 'foobar'
     cwd = '/foo'
     env = {}
 
-    mock_popen.return_value = Mock(returncode=0, stdout=Mock(readline=Mock(return_value='foobar')))
+    mock_popen.return_value = Mock(
+        returncode=0, stdout=Mock(read=Mock(side_effect=[b'foobar', b'']))
+    )
 
-    run(mock_logger, command, cwd=cwd, env=env, ruby=True)
+    run(mock_logger, command, cwd=cwd, env=env, shell=True, ruby=True)
 
     mock_popen.assert_called_once_with(
         f'source {RVM_PATH} && {command}',
@@ -250,13 +245,78 @@ def test_run_with_ruby(mock_popen):
         executable='/bin/bash',
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
-        bufsize=1,
-        encoding='utf-8',
-        text=True,
+        bufsize=0,
+        preexec_fn=setuser
+    )
+
+
+@patch('runner.toolchain_env', autospec=True)
+@patch('subprocess.Popen', autospec=True)
+def test_run_with_node_and_ruby(mock_popen, mock_toolchain_env):
+    mock_logger = Mock()
+    command = 'foobar --baz'
+    cwd = '/foo'
+    env = {'HOME': '/home/customer', 'PATH': '/bin'}
+
+    mock_toolchain_env.return_value = {'PATH': '/nvm/bin:/rvm/bin', 'GEM_HOME': '/gems'}
+    mock_popen.return_value = Mock(returncode=0, stdout=Mock(read=Mock(return_value=b'')))
+
+    run(mock_logger, command, cwd=cwd, env=env, node=True, ruby=True)
+
+    mock_toolchain_env.assert_called_once_with(cwd, True, True)
+
+    mock_popen.assert_called_once_with(
+        ['foobar', '--baz'],
+        cwd=cwd,
+        env={'HOME': '/home/customer', 'PATH': '/nvm/bin:/rvm/bin', 'GEM_HOME': '/gems'},
+        shell=False,
+        executable=None,
+        stderr=subprocess.STDOUT,
+        stdout=subprocess.PIPE,
+        bufsize=0,
         preexec_fn=setuser
     )
 
 
+@patch('subprocess.run', autospec=True)
+def test_toolchain_env(mock_subprocess_run):
+    clear_toolchain_envs()
+
+    mock_subprocess_run.return_value = Mock(
+        stdout=b'PATH=/nvm/bin:/bin\0NVM_BIN=/nvm/bin\0PWD=/foo\0SHLVL=1\0MULTI=a\nb\0'
+    )
+
+    env = toolchain_env('/foo', node=True)
+
+    assert env == {'PATH': '/nvm/bin:/bin', 'NVM_BIN': '/nvm/bin', 'MULTI': 'a\nb'}
+
+    # the environment is captured once
+    assert toolchain_env('/foo', node=True) is env
+    mock_subprocess_run.assert_called_once()
+    assert mock_subprocess_run.call_args[0][0] == (
+        f'{{ source {NVM_PATH} && nvm use default && true; }} > /dev/null && env -0'
+    )
+
+    toolchain_env('/foo', ruby=True)
+    assert mock_subprocess_run.call_count == 2
+
+    clear_toolchain_envs()
+    toolchain_env('/foo', node=True)
+    assert mock_subprocess_run.call_count == 3
+
+    clear_toolchain_envs()
+
+
+@patch('runner.clear_toolchain_envs', autospec=True)
+@patch('subprocess.Popen', autospec=True)
+def test_run_shell_with_node_clears_toolchain_envs(mock_popen, mock_clear_toolchain_envs):
+    mock_popen.return_value = Mock(returncode=0, stdout=Mock(read=Mock(return_value=b'')))
+
+    run(Mock(), 'nvm install 18', env={}, shell=True, node=True)
+
+    mock_clear_toolchain_envs.assert_called_once_with()
+
+
 def test_access_environ():
     mock_logger = Mock()
     command = 'cat /proc/1/environ'
@@ -265,3 +325,91 @@ def test_access_environ():
     run(mock_logger, command, env=env)
 
     mock_logger.info.assert_any_call('cat: /proc/1/environ: Permission denied')
+
+
+def test_read_lines():
+    lines = queue.Queue()
+    stream = io.BytesIO(b'first\nsecond line\r\n\xe2\x9c\x93 third\nlast')
+
+    read_lines(stream, lines, chunk_size=4)
+
+    output = [line for batch in iter(lines.get, None) for line in batch]
+    assert output == ['first', 'second line', '\u2713 third', 'last']
+
+
+def test_run_streams_large_output():
+    mock_logger = Mock()
+    command = 'seq 1 100000'
+
+    result = run(mock_logger, command, max_lines=1000)
+
+    assert result == 0
+    # the output and the resource usage
+    assert mock_logger.info.call_count == 1002
+    mock_logger.info.assert_any_call('500')
+    mock_logger.info.assert_any_call('... 99000 lines omitted ...')
+    mock_logger.info.assert_any_call('99501')
+    mock_logger.info.assert_any_call('100000')
+
+
+def test_run_filters_output():
+    mock_logger = Mock()
+    command = ['printf', r'\033[1mstart\033[0m\n10%%\r100%%\nsame\nsame\nsame\n\nend']
+
+    run(mock_logger, command)
+
+    assert mock_logger.info.call_args_list[:-1] == [
+        call('start'), call('100%'), call('same'), call('(repeated 2 times)'), call('end')
+    ]
+
+
+def test_run_records_resource_usage():
+    mock_logger = Mock()
+    mock_logger.name = 'build-step'
+
+    result = run(mock_logger, ['sh', '-c', 'exit 3'])
+
+    assert result == 3
+
+    record = usage_records()[-1]
+    assert record['step'] == 'build-step'
+    assert record['program'] == 'sh'
+    assert record['returncode'] == 3
+    assert record['wall_seconds'] > 0
+    assert record['max_rss_kb'] > 0
+
+    mock_logger.info.assert_called_once_with(format_usage(record))
+
+
+def test_run_returns_signal_exit_code():
+    assert run(Mock(), ['sh', '-c', 'kill -9 $$']) == -9
+
+
+def test_output_filter_keeps_head_and_tail():
+    output_filter = OutputFilter(max_lines=5)
+
+    output = output_filter.filter([str(i) for i in range(1, 11)])
+    output += output_filter.close()
+
+    assert output == ['1', '2', '3', '... 5 lines omitted ...', '9', '10']
+
+
+def test_output_filter_summarizes_repeats_across_batches():
+    output_filter = OutputFilter()
+
+    output = output_filter.filter(['\x1b[33mwaiting\x1b[0m', 'waiting'])
+    output += output_filter.filter(['waiting\r', 'done'])
+    output += output_filter.close()
+
+    assert output == ['waiting', '(repeated 2 times)', 'done']
+
+
+def test_write_usage_records(tmpdir):
+    run(Mock(), ['true'])
+
+    usage_file = tmpdir.join('usage.json')
+    write_usage_records(str(usage_file))
+
+    records = json.loads(usage_file.read())
+    assert records[-1]['program'] == 'true'
+    assert records[-1]['returncode'] == 0
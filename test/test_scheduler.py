@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+
+import pytest
+
+import runner
+from runner import run
+from steps import Step, StepException, run_steps
+
+
+@pytest.fixture(autouse=True)
+def resume_commands():
+    yield
+    runner.STOPPED.clear()
+
+
+def test_it_runs_independent_steps_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+
+    def step(name, wait=False):
+        def func():
+            if wait:
+                # fails unless both steps are running at the same time
+                barrier.wait()
+            order.append(name)
+            return 0
+        return func
+
+    run_steps([
+        Step('node', step('node', wait=True), 'node failed'),
+        Step('ruby', step('ruby', wait=True), 'ruby failed'),
+        Step('bundler', step('bundler'), 'bundler failed', requires=['ruby']),
+        Step('build', step('build'), 'build failed', requires=['node', 'bundler']),
+    ])
+
+    assert sorted(order) == ['build', 'bundler', 'node', 'ruby']
+    assert order.index('ruby') < order.index('bundler')
+    assert order[-1] == 'build'
+
+
+def test_it_fails_fast():
+    started = []
+
+    def fail():
+        return 1
+
+    def slow():
+        time.sleep(5)
+        return 0
+
+    def dependent():
+        started.append('dependent')
+        return 0
+
+    start = time.time()
+
+    with pytest.raises(StepException, match='node failed'):
+        run_steps([
+            Step('node', fail, 'node failed'),
+            Step('ruby', slow, 'ruby failed'),
+            Step('build', dependent, 'build failed', requires=['node']),
+        ])
+
+    assert time.time() - start < 5
+    assert started == []
+
+
+def test_it_stops_the_running_steps_on_failure(tmp_path):
+    logger = logging.getLogger('test-scheduler')
+    returncodes = []
+
+    def slow():
+        returncodes.append(run(logger, 'sleep 30'))
+        # the step goes on, but its commands are no longer run
+        returncodes.append(run(logger, f'touch {tmp_path / "written"}'))
+        return 0
+
+    def fail():
+        deadline = time.monotonic() + 5
+        while not runner.RUNNING_PROCESSES and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return 1
+
+    start = time.monotonic()
+
+    with pytest.raises(StepException, match='build script failed'):
+        run_steps([
+            Step('setup-ruby', slow, 'ruby failed'),
+            Step('run-build-script', fail, 'build script failed'),
+        ])
+
+    sibling = next(t for t in threading.enumerate() if t.name == 'step-setup-ruby')
+    sibling.join(timeout=5)
+
+    assert not sibling.is_alive()
+    assert time.monotonic() - start < 10
+    assert returncodes == [-9, 1]
+    assert not (tmp_path / 'written').exists()
+    assert not runner.RUNNING_PROCESSES
+
+
+def test_it_raises_step_exceptions():
+    def broken():
+        raise RuntimeError('Invalid .bundler-version')
+
+    with pytest.raises(RuntimeError, match='Invalid .bundler-version'):
+        run_steps([Step('bundler', broken, 'bundler failed')])
+
+
+def test_it_rejects_invalid_requirements():
+    with pytest.raises(ValueError, match='unknown steps: ruby'):
+        run_steps([Step('bundler', lambda: 0, 'bundler failed', requires=['ruby'])])
+
+    with pytest.raises(ValueError, match='circular'):
+        run_steps([
+            Step('a', lambda: 0, 'a failed', requires=['b']),
+            Step('b', lambda: 0, 'b failed', requires=['a']),
+        ])
+
+
+def test_it_reports_the_running_steps():
+    reports = []
+
+    run_steps([
+        Step('ruby', lambda: 0, 'ruby failed'),
+        Step('bundler', lambda: 0, 'bundler failed', requires=['ruby']),
+    ], on_running=reports.append)
+
+    assert reports == [['ruby'], ['bundler']]